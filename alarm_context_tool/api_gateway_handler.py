@@ -3,7 +3,11 @@ import botocore
 
 from functions import get_dashboard_button
 from functions import get_html_table
-from functions_logs import get_last_10_events
+from functions_logs import get_log_insights_query_results
+from functions_logs import LOG_EVENTS_PER_GROUP
+from functions_logs import LOG_INSIGHTS_ROWS_PER_GROUP
+from functions_logs import MAX_LOG_INSIGHTS_QUERY_LIMIT
+from functions_logs import check_log_group_exists
 from functions_xray import process_traces
 from functions_logs import get_log_insights_link
 from functions_metrics import build_dashboard
@@ -236,21 +240,34 @@ def process_api_gateway(dimensions, region, account_id, namespace, change_time,
                 resource_information_object = response  
 
 
+                log_information = None
+                log_events = None
+                log_inputs = []
                 destination_arn = None
                 if "accessLogSettings" in response and "destinationArn" in response["accessLogSettings"]:
                     destination_arn = response["accessLogSettings"]["destinationArn"]
                     log_group_name = destination_arn.split(":log-group:")[1]     
+                    log_inputs.append({"logGroupName": log_group_name})
 
-                    # Get the last 10 log events
-                    log_input = {"logGroupName": log_group_name}
-                    log_information, log_events =  get_last_10_events(log_input, change_time, region)                                              
-                         
+                # Execution logs are only written if enabled for the stage
+                execution_log_group_name = f"API-Gateway-Execution-Logs_{api_id}/{api_stage}"
+                if check_log_group_exists(execution_log_group_name, region):
+                    log_inputs.append({"logGroupName": execution_log_group_name})
+
+                if log_inputs:
+                    # Get the last 10 log events for the access and execution logs in a single query
+                    log_groups = [log_input['logGroupName'] for log_input in log_inputs]
+                    log_insights_query = f"""fields @timestamp, @message, @log
+                        | filter @timestamp <= {int(change_time.timestamp() * 1000)}
+                        | sort @timestamp desc
+                        | limit {min(LOG_INSIGHTS_ROWS_PER_GROUP * len(log_groups), MAX_LOG_INSIGHTS_QUERY_LIMIT)}"""
+                    log_information, log_events = get_log_insights_query_results(log_groups, log_insights_query, region, start, end, LOG_EVENTS_PER_GROUP)
 
                     # Log Insights Link
                     log_insights_query = f"""fields @timestamp, @message
                         | sort @timestamp desc
                         | limit 200"""
-                    log_insights_link = get_log_insights_link(log_input, log_insights_query, region, start_time, end_time)
+                    log_insights_link = get_log_insights_link(log_inputs, log_insights_query, region, start_time, end_time)
                     contextual_links += get_dashboard_button("Log Insights" , log_insights_link)                   
   
                 # Get Trace information            
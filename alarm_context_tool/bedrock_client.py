@@ -0,0 +1,182 @@
+import os
+import re
+import time
+import random
+import threading
+
+import boto3
+import botocore
+from botocore.config import Config
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Tracer
+logger = Logger()
+tracer = Tracer()
+
+# Error codes that are retried with backoff, and count towards opening the circuit breaker of a target.
+# Errors in response streams have lower camel case codes.
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException', 'throttlingException',
+    'ServiceUnavailableException', 'serviceUnavailableException',
+    'ModelNotReadyException', 'TooManyRequestsException'
+}
+
+# Error codes of requests that are malformed, which would fail on every target, so they are not failed over
+REQUEST_ERROR_CODES = {'ValidationException', 'validationException'}
+
+REGION_PATTERN = re.compile(r'^[a-z]{2}(-gov)?-[a-z]+-\d$')
+
+class BedrockUnavailableError(Exception):
+    """Raised when every Bedrock region and model is throttled or its circuit breaker is open"""
+    pass
+
+class BedrockClient:
+    """
+    Invokes Bedrock with jittered exponential backoff and failover to other regions or models.
+
+    The targets are BEDROCK_REGION with the requested model, followed by BEDROCK_FALLBACKS, a comma separated
+    list of regions, model IDs or region/model ID pairs. A target is retried while it is throttled, up to
+    BEDROCK_MAX_ATTEMPTS times, and then the next target is tried, as it is when a target fails with any other
+    error. After BEDROCK_CIRCUIT_BREAKER_FAILURES consecutive throttled attempts, across requests, a target is
+    skipped by later requests for BEDROCK_CIRCUIT_BREAKER_SECONDS. Opening the circuit breaker does not cut
+    short the attempts of the request that opened it, so the two settings are independent. The clients and
+    circuit breakers persist across warm invocations.
+
+    Each call is given the time left until the deadline as its read timeout, so that a call that hangs does
+    not use up the time of the remaining attempts and targets.
+
+    An execution environment handles one alarm at a time, so the number of concurrent Bedrock requests is
+    limited by the ReservedConcurrentExecutions of the function, and by batching alarm storms into incidents.
+    """
+    __clients = {}
+    __circuit_breakers = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    def client(region, deadline=None):
+        """
+        Returns the client of a region, with a read timeout that ends by the deadline.
+
+        The read timeout of a botocore client is fixed when it is created, so clients are kept for read
+        timeouts rounded down to 10 seconds, which bounds the number of clients of a region.
+        """
+        read_timeout = int(os.environ.get('BEDROCK_TIMEOUT', 300))
+        if deadline is not None:
+            remaining = max(int(deadline - time.monotonic()), 1)
+            read_timeout = min(read_timeout, remaining if remaining < 10 else remaining // 10 * 10)
+        with BedrockClient.__lock:
+            if (region, read_timeout) not in BedrockClient.__clients:
+                # Retries are made by invoke, so that they can move on to the next target. 
+                # BEDROCK_ENDPOINT_URL points the client at a stand-in, such as tools/bedrock_stand_in.py
+                BedrockClient.__clients[(region, read_timeout)] = boto3.client(
+                    service_name="bedrock-runtime",
+                    region_name=region,
+                    endpoint_url=os.environ.get('BEDROCK_ENDPOINT_URL') or None,
+                    config=Config(retries={'total_max_attempts': 1}, connect_timeout=min(read_timeout, 10), read_timeout=read_timeout)
+                )
+            return BedrockClient.__clients[(region, read_timeout)]
+
+    @staticmethod
+    def targets(model_id):
+        """
+        Returns the regions and model IDs to try, in order.
+        """
+        region = os.environ.get('BEDROCK_REGION')
+        targets = [(region, model_id)]
+        for fallback in os.environ.get('BEDROCK_FALLBACKS', '').split(','):
+            fallback = fallback.strip()
+            if not fallback:
+                continue
+            if '/' in fallback:
+                target = tuple(fallback.split('/', 1))
+            elif REGION_PATTERN.match(fallback):
+                target = (fallback, model_id)
+            else:
+                target = (region, fallback)
+            if target not in targets:
+                targets.append(target)
+        return targets
+
+    @staticmethod
+    @tracer.capture_method
+    def invoke(operation, request, deadline, read_response):
+        """
+        Calls a Bedrock runtime operation and reads its response, failing over to the next target while throttled
+        or when a target fails.
+
+        Args:
+            operation (str): The operation, e.g. converse or invoke_model.
+            request (dict): The request parameters, modelId is replaced with the model ID of each target.
+            deadline (float): The time.monotonic() value after which no more attempts are made.
+            read_response (function): Reads the response, e.g. consumes a response stream, so that 
+            throttling errors in the stream are retried too.
+
+        Returns:
+            The result of read_response and the model ID that was used.
+
+        Raises:
+            botocore.exceptions.ClientError: If the first target rejects the request as malformed.
+            BedrockUnavailableError: If every target fails, is throttled or has an open circuit breaker, until the deadline.
+        """
+        max_attempts = int(os.environ.get('BEDROCK_MAX_ATTEMPTS', 4))
+        base_delay = float(os.environ.get('BEDROCK_BACKOFF_SECONDS', 1))
+        last_error = None
+
+        for index, (region, model_id) in enumerate(BedrockClient.targets(request['modelId'])):
+            if not BedrockClient.__is_closed(region, model_id):
+                logger.info("Bedrock circuit breaker is open, skipping", region=region, model_id=model_id)
+                continue
+
+            for attempt in range(max_attempts):
+                if time.monotonic() >= deadline:
+                    raise BedrockUnavailableError(f"Bedrock did not respond before the deadline, last error: {last_error}")
+                try:
+                    response = getattr(BedrockClient.client(region, deadline), operation)(**dict(request, modelId=model_id))
+                    result = read_response(response)
+                except botocore.exceptions.ClientError as error:
+                    last_error = error
+                    error_code = error.response.get('Error', {}).get('Code')
+                    if error_code not in RETRYABLE_ERROR_CODES:
+                        # A fallback that is misconfigured, e.g. a model that is not enabled, does not stop failover
+                        if index == 0 and error_code in REQUEST_ERROR_CODES:
+                            raise
+                        logger.warning("Bedrock request failed, trying the next target", region=region, model_id=model_id, error=str(error))
+                        break
+                    logger.warning("Bedrock is throttled", region=region, model_id=model_id, attempt=attempt + 1, error=str(error))
+                    BedrockClient.__record_failure(region, model_id)
+
+                    # Full jitter backoff, within the deadline
+                    delay = random.uniform(0, base_delay * 2 ** attempt)
+                    if attempt + 1 < max_attempts:
+                        time.sleep(max(min(delay, deadline - time.monotonic()), 0))
+                    continue
+
+                BedrockClient.__record_success(region, model_id)
+                if (region, model_id) != (os.environ.get('BEDROCK_REGION'), request['modelId']):
+                    logger.warning("Bedrock request failed over", region=region, model_id=model_id)
+                return result, model_id
+
+        raise BedrockUnavailableError(f"Every Bedrock region and model failed, is throttled or is unavailable, last error: {last_error}")
+
+    @staticmethod
+    def __is_closed(region, model_id):
+        # A circuit breaker that has been open for long enough lets a request through
+        circuit_breaker = BedrockClient.__circuit_breakers.get((region, model_id))
+        return not circuit_breaker or circuit_breaker['open_until'] <= time.time()
+
+    @staticmethod
+    def __record_failure(region, model_id):
+        """
+        Records a throttled attempt, opening the circuit breaker after BEDROCK_CIRCUIT_BREAKER_FAILURES in a row.
+        """
+        with BedrockClient.__lock:
+            circuit_breaker = BedrockClient.__circuit_breakers.setdefault((region, model_id), {'failures': 0, 'open_until': 0})
+            circuit_breaker['failures'] += 1
+            if circuit_breaker['failures'] >= int(os.environ.get('BEDROCK_CIRCUIT_BREAKER_FAILURES', 3)):
+                circuit_breaker['open_until'] = time.time() + int(os.environ.get('BEDROCK_CIRCUIT_BREAKER_SECONDS', 60))
+                logger.warning("Bedrock circuit breaker opened", region=region, model_id=model_id, failures=circuit_breaker['failures'])
+
+    @staticmethod
+    def __record_success(region, model_id):
+        with BedrockClient.__lock:
+            BedrockClient.__circuit_breakers.pop((region, model_id), None)
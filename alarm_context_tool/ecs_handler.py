@@ -3,7 +3,10 @@ import botocore
 
 from functions import get_dashboard_button
 from functions import get_html_table
-from functions_logs import get_last_10_events
+from functions_logs import get_log_insights_query_results
+from functions_logs import LOG_EVENTS_PER_GROUP
+from functions_logs import LOG_INSIGHTS_ROWS_PER_GROUP
+from functions_logs import MAX_LOG_INSIGHTS_QUERY_LIMIT
 from functions_logs import get_log_insights_link
 from functions_metrics import build_dashboard
 from functions_metrics import get_metrics_from_dashboard_metrics
@@ -257,10 +260,18 @@ def process_ecs(dimensions, region, account_id, namespace, change_time, annotati
             
             log_inputs = []
             for container_definition in response['taskDefinition']['containerDefinitions']:
-                if container_definition['logConfiguration']['logDriver'] == "awslogs":
+                if container_definition.get('logConfiguration', {}).get('logDriver') == "awslogs":
                     log_input = {"logGroupName": container_definition['logConfiguration']['options']['awslogs-group']}
                     log_inputs.append(log_input)
-                    log_information, log_events =  get_last_10_events(log_input, change_time, region) 
+
+            # Get the last 10 log events for each container log group in a single query
+            log_groups = list(dict.fromkeys(log_input['logGroupName'] for log_input in log_inputs))
+            if log_groups:
+                log_insights_query = f"""fields @timestamp, @message, @log
+                    | filter @timestamp <= {int(change_time.timestamp() * 1000)}
+                    | sort @timestamp desc
+                    | limit {min(LOG_INSIGHTS_ROWS_PER_GROUP * len(log_groups), MAX_LOG_INSIGHTS_QUERY_LIMIT)}"""
+                log_information, log_events = get_log_insights_query_results(log_groups, log_insights_query, region, start, end, LOG_EVENTS_PER_GROUP)
                     
             # Log Insights Link
             log_insights_query = """fields @timestamp, @message
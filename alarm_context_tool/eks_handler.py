@@ -50,6 +50,8 @@ def process_eks(metric_name, dimensions, region, account_id, namespace, change_t
     widget_images = []
     additional_metrics_with_timestamps_removed = []
     notifications = ""
+    log_information = None
+    log_events = None
 
     if dimensions:
         dimension_values = {element['name']: element['value'] for element in dimensions}
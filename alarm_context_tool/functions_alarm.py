@@ -16,7 +16,7 @@ def get_alarm_history(region, alarm_name):
         alarm_name (str): The name of the alarm to retrieve the history for.
     
     Returns:
-        str: The alarm history in string format.
+        dict: The alarm history items.
     """
     cloudwatch = boto3.client('cloudwatch', region_name=region)
     try:
@@ -45,5 +45,4 @@ def get_alarm_history(region, alarm_name):
         AlarmHistoryItem.pop('AlarmType', None)
         AlarmHistoryItem.pop('HistoryData', None)
         AlarmHistoryItem.pop('HistoryItemType', None) 
-    alarm_history = str(response) 
-    return alarm_history   
\ No newline at end of file
+    return response   
\ No newline at end of file
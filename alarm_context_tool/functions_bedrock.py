@@ -1,9 +1,17 @@
-import boto3
+import ast
 import json
 import os
+import re
+import math
+import time
+import hashlib
+import datetime
 import botocore
 
 from functions import get_information_panel
+from functions_logs import normalize_log_message
+from bedrock_client import BedrockClient
+from bedrock_client import BedrockUnavailableError
 
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools import Tracer
@@ -11,6 +19,120 @@ from aws_lambda_powertools import Tracer
 logger = Logger()
 tracer = Tracer()
 
+# Prompt sections that are trimmed or omitted when the prompt exceeds BEDROCK_MAX_INPUT_TOKENS, lowest value first.
+# Each section gets a share of the prompt weighted by its position. The alarm message is never trimmed.
+PROMPT_SECTION_TRIM_ORDER = [
+    'text_summary',
+    'truncated_cloudformation_template',
+    'resource_information_object',
+    'additional_metrics_with_timestamps_removed',
+    'alarm_history',
+    'health_events',
+    'log_events',
+    'trace_summary',
+    'metric_data'
+]
+
+# Sections that would have fewer tokens of information than this after trimming are omitted
+MIN_PROMPT_SECTION_TOKENS = 100
+
+# Splits text into words, runs of digits and punctuation, to estimate the number of tokens
+TOKEN_PATTERN = re.compile(r'[A-Za-z]+|\d+|[^\sA-Za-z\d]')
+
+# Keys of context objects that carry no information about the alarm, and are dropped when the prompt is compacted
+PROMPT_OMITTED_KEYS = {'ResponseMetadata', 'NextToken', 'nextToken', 'RetryAttempts'}
+
+# Lists of records are converted to tables if at least this fraction of the cells would have a value
+MIN_PROMPT_TABLE_FILL = 0.5
+
+# Sections whose structure is kept when the prompt is compacted, as the model is asked to return a corrected template
+PROMPT_STRUCTURED_SECTIONS = {'truncated_cloudformation_template'}
+
+# ARNs that occur more than once in the prompt are replaced with references
+ARN_PATTERN = re.compile(r"arn:aws[a-z-]*:[a-z0-9-]+:[a-z0-9-]*:\d{0,12}:[^\s\"'<>,\]\}]+")
+
+# Context sections that add to the complexity score of a prompt, and the maximum score for error signals
+COMPLEX_PROMPT_SECTIONS = ['health_events', 'truncated_cloudformation_template', 'resource_information_object', 'log_events', 'additional_metrics_with_timestamps_removed', 'trace_summary']
+MAX_ERROR_SIGNAL_SCORE = 5
+
+# Log messages that are error signals
+LOG_ERROR_PATTERN = re.compile(r'\b(?:error|errors|exception|fault|fatal|panic|traceback|critical|failed|failure)\b|\w(?:Error|Exception)\b', re.IGNORECASE)
+
+# Models that support prompt caching with the Converse API, other models are invoked with invoke_model
+PROMPT_CACHING_MODELS = ('claude-3-7-sonnet', 'claude-3-5-haiku', 'claude-sonnet-4', 'claude-opus-4', 'claude-haiku-4', 'amazon.nova-')
+
+# Geographic prefixes of cross-region inference profile IDs, e.g. us.anthropic.claude-3-7-sonnet-20250219-v1:0
+INFERENCE_PROFILE_PREFIXES = ('us', 'us-gov', 'eu', 'apac', 'ca', 'jp', 'au', 'global')
+
+# Bedrock analyses by alarm and state, with the context fingerprint they were generated for, persisted across warm invocations
+bedrock_response_cache = {}
+MAX_CACHED_RESPONSES_PER_ALARM = 5
+MAX_CACHED_ALARMS = 100
+
+# Instructions for each prompt section, in prompt order. The instructions are part of the static prefix of 
+# the prompt, so that they can be cached, and the sections contain only the information for the alarm.
+PROMPT_SECTION_INSTRUCTIONS = {
+    'alarm_history': '''
+        Alarm history is contained in the <alarm_history> tag. 
+        Use this information to understand the frequency of the alarm and describe this to the reader.
+        ''',
+    'message': '''
+        The CloudWatch alarm message is contained in the <message> tag.
+        ''',
+    'metric_data': '''
+        Metric data for the metric that triggered the alarm is contained in the <metric_data> tag. The metric will be graphed below your response. 
+        The metric data contains 25 hours of data, comment on the last 24 hours of data and do a comparison with the last hour with the day before at the same time.
+        ''',
+    'text_summary': '''
+        A human readable message for the alarm is contained in the <text_summary> tag. 
+        The email  to the end user will already contain this summary above your response.
+        ''',
+    'health_events': '''
+        AWS Health events are contained in the <health_events> tag.
+        See if there are events in <health_events> that may be impacting the resources.
+        Warn the reader if there are upcoming events for related resources.    
+        ''',
+    'truncated_cloudformation_template': '''
+        The CloudFormation template used to create this resource is in the <truncated_cloudformation_template> tag.
+        It contains the alarmed resource and the resources it directly depends on, and the resources of the root cause types in the traces, by logical ID. Resources in nested stacks are prefixed with the logical ID of the nested stack, such as NetworkStack/LoadBalancer.
+        If none of these were found, it contains the whole template and values have been truncated to minimize token usage.
+        Use the cloudformation_template and if there is a fix that can be made, call it out and tell the reader which code they need to change to resolve the issue.
+        If this is identifiable, it will be the most important information that the reader will want to see.
+        ''',
+    'resource_information_object': '''
+        Information about the resource related to the metric is contained in the <resource_information_object> tag.
+        Use the resource_information_object as additional context, but also summarize or highlight any relevant data as well.
+        ''',
+    'log_events': '''
+        If there are any relevant logs, the last 10 log events will be contained within the <log_events> tag.
+        Repeated log events have been deduplicated, count is the number of occurrences between firstTimestamp and lastTimestamp.
+        ''',
+    'additional_metrics_with_timestamps_removed': '''
+        Also use related metrics contained in the <additional_metrics_with_timestamps_removed> tag they are from 60 minutes before the time of the alarm. They have had the timestamps removed. 
+        Comment on each of the additional_metrics and it's relevance to the root cause.
+        ''',
+    'trace_summary': '''
+        Also use the following trace summary contained in the <trace_summary> tag, it's likely to be the best source of information.
+        Comment on how the trace_summary shows the potential root cause. 
+        TraceProfile aggregates all of the fetched traces per node: calls, fault, error and throttle rates, latency percentiles in milliseconds and the mean time spent in the node itself (SelfMs) versus downstream calls (DownstreamMs).
+        SampledTraces summarizes a sample of traces, faults and errors first and then the slowest, with the nodes that had issues in each trace.
+        ServiceGraph lists the calls between services upstream and downstream of the alarmed service, with the number of hops from it, the number of requests, fault, error and throttle rates and the mean and p99 response time in milliseconds.
+        Use the ServiceGraph to explain whether the issue is likely to originate in the alarmed service, in a dependency it calls or in a caller.
+        Do not output the trace to the reader in JSON format, if you quote it, it must be in human readable format.
+        When correlating the trace data with the alarm and metrics, be mindful that the trace may not have occurred at the same time as the alarm.
+        If necessary, explain that the trace may not have occurred at the same time as the alarm and any root cause may be correlated.
+        ''',
+    'incident_alarms': '''
+        If several related alarms fired together, the information for each alarm is in an <alarm> tag within the <incident_alarms> tag, with the sections described above.
+        Analyse them as a single incident: identify the alarm closest to the root cause, explain how the other alarms follow from it and refer to each alarm by name.
+        ARN references within an <alarm> tag are listed in the <arn_references> tag of that alarm.
+        ''',
+    'arn_references': '''
+        ARNs that occur more than once have been replaced with references such as [ARN1], the ARN for each reference is in the <arn_references> tag.
+        Use the full ARN when you refer to a resource in your response.
+        '''
+}
+
 @tracer.capture_method
 def build_prompt_start():
     return '''
@@ -21,15 +143,16 @@ def build_prompt_start():
     Using all of the available data, describe to the reader your interpretation of the immediacy that action is required to address the root cause.
     The response needs to be in HTML format, maximum header size should be h3. 
     Add headers to make the response more readable.
+    The information about the alarm follows these instructions. Each of the tags below is only included if that information is available.
+    The information is in minified JSON and empty fields have been omitted. Lists of records are in tabular form, an object with the field names in "columns" and a list of values for each record in "rows".
 
     '''
 
 @tracer.capture_method
-def build_section(instructions, tag_name, information):
+def build_section(tag_name, information):
     return f'''
-    {instructions}
     <{tag_name}>
-    {information}
+    {serialize_prompt_information(information)}
     </{tag_name}>
     '''
 
@@ -43,129 +166,747 @@ def build_prompt_end():
     If <cloudformation_template> exists, attempt to highlight a fix via changing the template in JSON format, presented in HTML, make the code change stand out.
     '''
 
+@tracer.capture_method
+def build_prompt_instructions():
+    """
+    Returns the static instructions of the prompt, which are the same for every alarm.
+    """
+    return build_prompt_start() + ''.join(PROMPT_SECTION_INSTRUCTIONS.values()) + build_prompt_end()
+
 @tracer.capture_method
 def construct_prompt(alarm_history, message, metric_data, text_summary, health_events, truncated_cloudformation_template, resource_information_object, log_events, additional_metrics_with_timestamps_removed, trace_summary):
-    prompt = build_prompt_start()
-    
+    """
+    Constructs the dynamic part of the prompt, the information about the alarm that follows the static instructions 
+    returned by build_prompt_instructions.
+
+    Returns:
+        str: The sections of information about the alarm, fitted into BEDROCK_MAX_INPUT_TOKENS.
+    """
+    return build_prompt(construct_prompt_sections(alarm_history, message, metric_data, text_summary, health_events, truncated_cloudformation_template, 
+                                                  resource_information_object, log_events, additional_metrics_with_timestamps_removed, trace_summary))
+
+@tracer.capture_method
+def build_prompt(sections):
+    """
+    Fits the compacted prompt sections into BEDROCK_MAX_INPUT_TOKENS and builds the dynamic part of the prompt.
+
+    Args:
+        sections (list): The compacted sections, as returned by construct_prompt_sections.
+
+    Returns:
+        str: The sections of information about the alarm.
+    """
+    return ''.join(build_section(tag_name, section_information) for tag_name, section_information in fit_prompt_sections(sections))
+
+@tracer.capture_method
+def construct_prompt_sections(alarm_history, message, metric_data, text_summary, health_events, truncated_cloudformation_template, resource_information_object, log_events, additional_metrics_with_timestamps_removed, trace_summary):
+    """
+    Collects and compacts the sections of information about the alarm, before they are fitted into the prompt.
+
+    Returns:
+        list: A tuple of tag name and compacted information for each section, as returned by compact_prompt_sections.
+    """
+    # The compact trace profile replaces the raw trace summaries
+    if trace_summary and trace_summary.get("TraceProfile"):
+        trace_summary = {key: trace_summary[key] for key in ("TraceProfile", "SampledTraces", "ServiceGraph") if key in trace_summary}
+
+    information = {
+        'alarm_history': alarm_history,
+        'message': message,
+        'metric_data': metric_data,
+        'text_summary': text_summary,
+        'health_events': health_events,
+        'truncated_cloudformation_template': truncated_cloudformation_template,
+        'resource_information_object': resource_information_object,
+        'log_events': log_events,
+        'additional_metrics_with_timestamps_removed': additional_metrics_with_timestamps_removed,
+        'trace_summary': trace_summary
+    }
+
     # Add sections dynamically based on content
-    if alarm_history:
-        instructions = f'''
+    sections = [(tag_name, information[tag_name]) for tag_name in PROMPT_SECTION_INSTRUCTIONS if information.get(tag_name)]
+    return compact_prompt_sections(sections)
 
-        Alarm history is contained in the <alarm_history> tag. 
-        Use this information to understand the frequency of the alarm and describe this to the reader.
-        '''
-        prompt += build_section(instructions, 'alarm_history', alarm_history)
-    
-    if message:
-        instructions = f'''
+@tracer.capture_method
+def construct_incident_prompt(alarm_sections):
+    """
+    Merges the prompt sections of related alarms into the prompt for a single analysis of the incident. 
 
-        The CloudWatch alarm message is contained in the <message> tag.
-        '''
-        prompt += build_section(instructions, 'message', message)
-    
-    if metric_data:
-        instructions = f'''
+    The sections of each alarm are fitted into an equal share of BEDROCK_MAX_INPUT_TOKENS, with 
+    fit_prompt_sections, and keep their own arn_references section.
 
-        Metric data for the metric that triggered the alarm is contained in the <metric_data> tag. The metric will be graphed below your response. 
-        The metric data contains 25 hours of data, comment on the last 24 hours of data and do a comparison with the last hour with the day before at the same time.
-        '''
-        prompt += build_section(instructions, 'metric_data', metric_data)
-    
-    if text_summary:
-        instructions = f'''
+    Args:
+        alarm_sections (list): A tuple of alarm name and prompt sections, as returned by construct_prompt_sections, for each alarm.
 
-        A human readable message for the alarm is contained in the <text_summary> tag. 
-        The email  to the end user will already contain this summary above your response.
-        '''
-        prompt += build_section(instructions, 'text_summary', text_summary)
-    
-    if health_events:
-        instructions = f'''
+    Returns:
+        str: The incident_alarms section.
+    """
+    max_tokens = int(os.environ.get('BEDROCK_MAX_INPUT_TOKENS', 30000)) - estimate_tokens(build_prompt_instructions())
+    max_alarm_tokens = max(max_tokens // len(alarm_sections), MIN_PROMPT_SECTION_TOKENS)
 
-        AWS Health events are contained in the <health_events> tag.
-        See if there are events in <health_events> that may be impacting the resources.
-        Warn the reader if there are upcoming events for related resources.    
-        '''
-        prompt += build_section(instructions, 'health_events', health_events)
-    
-    if truncated_cloudformation_template:
-        instructions = f'''
+    alarms = ''
+    for alarm_name, sections in alarm_sections:
+        fitted_sections = fit_prompt_sections(sections, max_alarm_tokens)
+        alarms += f'<alarm name="{alarm_name}">' + ''.join(build_section(tag_name, information) for tag_name, information in fitted_sections) + '</alarm>'
+    return build_section('incident_alarms', alarms)
 
-        The CloudFormation template used to create this resource is in the <truncated_cloudformation_template> tag.
-        Values have been truncated to minimize token usage.
-        Use the cloudformation_template and if there is a fix that can be made, call it out and tell the reader which code they need to change to resolve the issue.
-        If this is identifiable, it will be the most important information that the reader will want to see.
-        '''
-        prompt += build_section(instructions, 'truncated_cloudformation_template', truncated_cloudformation_template)
-    
-    if resource_information_object:
-        instructions = f'''
+@tracer.capture_method
+def compact_prompt_sections(sections):
+    """
+    Compacts the information of the prompt sections, keeping its structure. 
 
-        Information about the resource related to the metric is contained in the <resource_information_object> tag.
-        Use the resource_information_object as additional context, but also summarize or highlight any relevant data as well.
-        '''
-        prompt += build_section(instructions, 'resource_information_object', resource_information_object)                                        
-    
-    if log_events:
-        instructions = f'''
+    Context objects, and strings that contain JSON or Python literals, are converted to minified JSON when 
+    the prompt is built. Empty fields and the keys in PROMPT_OMITTED_KEYS are dropped and lists of records are 
+    converted to tables, except in PROMPT_STRUCTURED_SECTIONS. ARNs that occur more than once, in values or 
+    keys, are replaced with references, which are listed in an arn_references section. The token reduction 
+    of each section is logged.
 
-        If there are any relevant logs, the last 10 log events will be contained within the <log_events> tag.
-        '''
-        prompt += build_section(instructions, 'log_events', log_events)   
-    
-    if additional_metrics_with_timestamps_removed:
-        instructions = f'''
+    Args:
+        sections (list): A tuple of tag name and information for each section, in prompt order.
 
-        Also use related metrics contained in the <additional_metrics> tag they are from 60 minutes before the time of the alarm. They have had the timestamps removed. 
-        Comment on each of the additional_metrics and it's relevance to the root cause.
-        '''
-        prompt += build_section(instructions, 'additional_metrics_with_timestamps_removed', additional_metrics_with_timestamps_removed)   
-    
-    if trace_summary:
-        instructions = f'''
+    Returns:
+        list: The compacted sections that are not empty, in prompt order, followed by the arn_references section 
+        if there are references.
+    """
+    compacted_sections = [(tag_name, compact_prompt_information(information, tag_name in PROMPT_STRUCTURED_SECTIONS)) for tag_name, information in sections]
 
-        Also use the following trace summary contained in the <trace_summary> tag, it's likely to be the best source of information.
-        Comment on how the trace_summary shows the potential root cause. 
-        Do not output the trace to the reader in JSON format, if you quote it, it must be in human readable format.
-        When correlating the trace data with the alarm and metrics, be mindful that the trace may not have occurred at the same time as the alarm.
-        If necessary, explain that the trace may not have occurred at the same time as the alarm and any root cause may be correlated.
-        '''
-        prompt += build_section(instructions, 'trace_summary', trace_summary)   
-                            
-    prompt += build_prompt_end()
-    return prompt
+    # Reference the ARNs that occur more than once, in order of first occurrence
+    arn_counts = {}
+    for _, information in compacted_sections:
+        for arn in ARN_PATTERN.findall(serialize_prompt_information(information)):
+            arn_counts[arn] = arn_counts.get(arn, 0) + 1
+    arn_references = {}
+    for arn, count in arn_counts.items():
+        if count > 1:
+            arn_references[arn] = f"[ARN{len(arn_references) + 1}]"
+    if arn_references:
+        compacted_sections = [(tag_name, replace_prompt_arns(information, arn_references)) for tag_name, information in compacted_sections]
+        compacted_sections.append(('arn_references', {reference: arn for arn, reference in arn_references.items()}))
+
+    section_tokens = {}
+    for (tag_name, information), (_, compacted_information) in zip(sections, compacted_sections):
+        tokens, compacted_tokens = estimate_tokens(str(information)), estimate_tokens(serialize_prompt_information(compacted_information))
+        section_tokens[tag_name] = {"tokens": tokens, "compacted_tokens": compacted_tokens, "reduction": round(1 - compacted_tokens / tokens, 2) if tokens else 0}
+    logger.info("Prompt compaction", arn_references=len(arn_references), sections=section_tokens)
+
+    # Sections with only empty fields are omitted
+    return [(tag_name, information) for tag_name, information in compacted_sections if information not in ([], {})]
+
+@tracer.capture_method
+def compact_prompt_information(information, keep_structure=False):
+    """
+    Compacts the information of a prompt section.
+
+    Args:
+        information: The information. Strings that contain a JSON or Python literal, optionally after a label 
+        such as "CPUUtilization - Metric Data: ", are parsed and compacted. Other strings are unchanged.
+        keep_structure (bool, optional): Whether to keep every field and list, and only convert dates, e.g. for templates.
+
+    Returns:
+        The compacted information, a string or a JSON serializable object.
+    """
+    if not isinstance(information, str):
+        return compact_prompt_value(information, keep_structure)
+
+    match = re.match(r'([^\[{\n]{0,200}?:\s*)?([\[{].*[\]}])\s*$', information, re.DOTALL)
+    if not match:
+        return information
+    label, literal = match.group(1) or '', match.group(2)
+    for parse in (json.loads, ast.literal_eval):
+        try:
+            value = parse(literal)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            continue
+        if label:
+            return label + serialize_prompt_information(compact_prompt_value(value, keep_structure))
+        return compact_prompt_value(value, keep_structure)
+    return information
+
+# Not traced, as it is called for every value of every section
+def compact_prompt_value(value, keep_structure=False):
+    """
+    Drops null and empty fields and the keys in PROMPT_OMITTED_KEYS, converts dates to ISO 8601 and lists of records to tables.
+    If keep_structure is set, only dates are converted.
+    """
+    if isinstance(value, dict):
+        compacted = {}
+        for key, item in value.items():
+            if key in PROMPT_OMITTED_KEYS and not keep_structure:
+                continue
+            # Empty strings are kept, as they are meaningful in templates, e.g. Fn::GetAZs: ""
+            item = compact_prompt_value(item, keep_structure)
+            if keep_structure or (item is not None and item != [] and item != {}):
+                compacted[str(key)] = item
+        return compacted
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [compact_prompt_value(item, keep_structure) for item in value]
+        if len(items) > 1 and not keep_structure and all(isinstance(item, dict) for item in items):
+            columns = list(dict.fromkeys(key for item in items for key in item))
+            cells = sum(len(item) for item in items)
+            if columns and cells >= MIN_PROMPT_TABLE_FILL * len(columns) * len(items):
+                return {"columns": columns, "rows": [[item.get(column) for column in columns] for item in items]}
+        return items
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+# Not traced, as it is called for every value of every section
+def replace_prompt_arns(value, arn_references):
+    """
+    Replaces the ARNs in the strings and keys of a compacted value with their references.
+    """
+    if isinstance(value, str):
+        return ARN_PATTERN.sub(lambda match: arn_references.get(match.group(0), match.group(0)), value)
+    if isinstance(value, dict):
+        return {replace_prompt_arns(key, arn_references): replace_prompt_arns(item, arn_references) for key, item in value.items()}
+    if isinstance(value, list):
+        return [replace_prompt_arns(item, arn_references) for item in value]
+    return value
+
+# Not traced, as it is called repeatedly while the prompt is fitted
+def is_prompt_table(information):
+    return isinstance(information, dict) and information.keys() == {"columns", "rows"}
+
+# Not traced, as it is called repeatedly while the prompt is fitted
+def serialize_prompt_information(information):
+    """
+    Returns strings unchanged and anything else as minified JSON.
+    """
+    if isinstance(information, str):
+        return information
+    return json.dumps(information, separators=(',', ':'), ensure_ascii=False, default=str)
+
+@tracer.capture_method
+def fit_prompt_sections(sections, max_section_tokens=None):
+    """
+    Fits the prompt sections into BEDROCK_MAX_INPUT_TOKENS, together with the static instructions of the prompt,
+    or into max_section_tokens on their own.
+
+    The tokens left by the sections that are not trimmed, such as the alarm message, are shared between the 
+    sections in PROMPT_SECTION_TRIM_ORDER, so that every kind of evidence keeps a part of the prompt. Each share
+    is weighted by the position of the section in PROMPT_SECTION_TRIM_ORDER, and the tokens that a section 
+    does not need are shared between the rest. A list is trimmed to the items that fit its share, with a note 
+    of how many were omitted, and anything else is truncated. While a share leaves fewer than 
+    MIN_PROMPT_SECTION_TOKENS tokens of information, the lowest value of those sections is omitted and the 
+    tokens are shared again. The number of tokens in each section is logged.
+
+    Args:
+        sections (list): A tuple of tag name and information for each section, in prompt order.
+        max_section_tokens (int, optional): The number of tokens to fit the sections into, without the instructions.
+
+    Returns:
+        list: The sections that fit, in prompt order.
+    """
+    if max_section_tokens is None:
+        max_tokens = int(os.environ.get('BEDROCK_MAX_INPUT_TOKENS', 30000))
+        instruction_tokens = estimate_tokens(build_prompt_instructions())
+    else:
+        max_tokens, instruction_tokens = max_section_tokens, 0
+
+    section_tokens = {tag_name: estimate_tokens(build_section(tag_name, information)) for tag_name, information in sections}
+    section_status = dict.fromkeys(section_tokens, "kept")
+    total_tokens = instruction_tokens + sum(section_tokens.values())
+
+    fitted_sections = dict(sections)
+    if total_tokens > max_tokens:
+        weights = {tag_name: index + 1 for index, tag_name in enumerate(PROMPT_SECTION_TRIM_ORDER) if tag_name in fitted_sections}
+        available_tokens = max_tokens - (total_tokens - sum(section_tokens[tag_name] for tag_name in weights))
+        while True:
+            shares = share_prompt_tokens({tag_name: section_tokens[tag_name] for tag_name in weights}, weights, available_tokens)
+            too_small = [tag_name for tag_name in weights if shares[tag_name] < section_tokens[tag_name]
+                         and shares[tag_name] - estimate_tokens(build_section(tag_name, '')) < MIN_PROMPT_SECTION_TOKENS]
+            if not too_small:
+                break
+            # The lowest value section that does not get enough tokens is omitted, and the tokens are shared again
+            tag_name = min(too_small, key=weights.get)
+            del weights[tag_name], fitted_sections[tag_name]
+            section_tokens[tag_name] = 0
+            section_status[tag_name] = "omitted"
+
+        for tag_name, share in shares.items():
+            if share >= section_tokens[tag_name]:
+                continue
+            information_tokens = share - estimate_tokens(build_section(tag_name, ''))
+            fitted_sections[tag_name] = trim_prompt_information(fitted_sections[tag_name], information_tokens)
+            section_tokens[tag_name] = estimate_tokens(build_section(tag_name, fitted_sections[tag_name]))
+            section_status[tag_name] = "trimmed"
+        total_tokens = instruction_tokens + sum(section_tokens.values())
+
+    logger.info("Prompt tokens", max_tokens=max_tokens, estimated_tokens=total_tokens, sections={
+        tag_name: {"tokens": section_tokens[tag_name], "status": section_status[tag_name]} for tag_name in section_tokens
+    })
+    if total_tokens > max_tokens:
+        logger.warning("Prompt exceeds the maximum number of input tokens", max_tokens=max_tokens, estimated_tokens=total_tokens)
+
+    return list(fitted_sections.items())
+
+# Not traced, as it is called repeatedly while the prompt is fitted
+def share_prompt_tokens(section_tokens, weights, available_tokens):
+    """
+    Shares the available tokens between sections in proportion to their weights. A section that needs less 
+    than its share gets what it needs, and the rest is shared again between the other sections.
+    """
+    shares = {}
+    pending = dict(section_tokens)
+    while pending:
+        total_weight = sum(weights[tag_name] for tag_name in pending)
+        fitting = {tag_name: tokens for tag_name, tokens in pending.items() if tokens <= max(available_tokens, 0) * weights[tag_name] / total_weight}
+        if not fitting:
+            shares.update({tag_name: int(max(available_tokens, 0) * weights[tag_name] / total_weight) for tag_name in pending})
+            break
+        for tag_name, tokens in fitting.items():
+            shares[tag_name] = tokens
+            available_tokens -= tokens
+            del pending[tag_name]
+    return shares
+
+@tracer.capture_method
+def trim_prompt_information(information, max_tokens):
+    """
+    Trims the information of a prompt section to approximately max_tokens tokens.
+
+    Args:
+        information: The information, a list is trimmed to the leading items that fit and anything else is truncated.
+        max_tokens (int): The number of tokens to trim the information to.
+
+    Returns:
+        str: The trimmed information.
+    """
+    # Tables are trimmed to the leading rows that fit
+    if is_prompt_table(information):
+        items, rebuild = information["rows"], lambda rows: dict(information, rows=rows)
+    else:
+        items, rebuild = information, lambda items: items
+
+    if isinstance(items, list) and len(items) > 1:
+        # Find the most leading items that fit, leaving room for the note
+        note_tokens = 20
+        fitting_items, too_many_items = 0, len(items)
+        while too_many_items - fitting_items > 1:
+            middle = (fitting_items + too_many_items) // 2
+            if estimate_tokens(serialize_prompt_information(rebuild(items[:middle]))) <= max_tokens - note_tokens:
+                fitting_items = middle
+            else:
+                too_many_items = middle
+        if fitting_items:
+            return f"{serialize_prompt_information(rebuild(items[:fitting_items]))}\n({len(items) - fitting_items} more items were omitted to fit the prompt)"
+
+    text = serialize_prompt_information(information)
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:int(len(text) * max_tokens / tokens * 0.95)] + "\n(the rest was truncated to fit the prompt)"
+
+# Not traced, as it is called repeatedly while the prompt is fitted
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in text, without a model specific tokenizer. Words count as a token per 
+    4 letters, runs of digits as a token per 3 digits and other characters as a token each.
+    """
+    tokens = 0
+    for match in TOKEN_PATTERN.findall(text):
+        if match[0].isalpha():
+            tokens += (len(match) + 3) // 4
+        elif match[0].isdigit():
+            tokens += (len(match) + 2) // 3
+        else:
+            tokens += 1
+    return tokens
+
+@tracer.capture_method
+def get_context_fingerprint(message, metric_data, log_events, trace_summary):
+    """
+    Creates a fingerprint of the alarm context, so that Bedrock analyses can be reused when an alarm flaps 
+    with essentially the same context.
+
+    Volatile values are stripped: the state reason and log messages are normalized, metric values are 
+    bucketed into half powers of two and traces are reduced to the services and exceptions with issues.
+
+    Args:
+        message (dict): The CloudWatch alarm message.
+        metric_data (str): The metric data, as returned by get_metric_data.
+        log_events (list): The log events, as returned by get_last_10_events or get_log_insights_query_results.
+        trace_summary (dict): The trace summary, as returned by process_traces.
+
+    Returns:
+        dict: The identity of the alarm, its ARN and state, and a set of context features.
+    """
+    features = set()
+    # The state reason quotes the datapoints, which are covered by the bucketed metric features
+    features.add("reason:" + re.sub(r'\d+(?:\.\d+)?', '<n>', normalize_log_message(message.get('NewStateReason', ''))))
+
+    # Bucketed features of each metric, values are in descending time order
+    def bucket(value):
+        return int(math.copysign(round(math.log2(abs(value) + 1) * 2), value))
+    for index, values in enumerate(re.findall(r"'Values': \[([^\]]*)\]", metric_data or '')):
+        values = [float(value) for value in values.split(',') if value.strip()]
+        if values:
+            features.update([
+                f"metric{index}:last:{bucket(values[0])}",
+                f"metric{index}:max:{bucket(max(values))}",
+                f"metric{index}:mean:{bucket(sum(values) / len(values))}"
+            ])
+
+    # Log template IDs, from filter_log_events messages or Logs Insights @message fields
+    log_messages = []
+    for log_event in log_events or []:
+        if isinstance(log_event, dict) and isinstance(log_event.get('message'), str):
+            log_messages.append(log_event['message'])
+        elif isinstance(log_event, list):
+            log_messages.extend(field['value'] for field in log_event if isinstance(field, dict) and field.get('field') == '@message')
+    # Templates of error messages are marked, as they are error signals
+    for log_message in log_messages:
+        template_id = hashlib.sha1(normalize_log_message(log_message).encode()).hexdigest()[:12]
+        features.add(("log-error:" if LOG_ERROR_PATTERN.search(log_message) else "log:") + template_id)
+
+    # Trace root causes and the nodes and exceptions with issues
+    trace_summary = trace_summary or {}
+    for summary in trace_summary.get('TraceSummaries', []):
+        for root_cause in summary.get('FaultRootCauses', []) + summary.get('ErrorRootCauses', []):
+            for service in root_cause.get('Services', [])[-1:]:
+                features.add(f"rootcause:{service.get('Name')}:{service.get('Type')}")
+                for entity in service.get('EntityPath', []):
+                    features.update(f"exception:{exception.get('Name')}" for exception in entity.get('Exceptions', []))
+    for node in trace_summary.get('TraceProfile', []):
+        if node.get('FaultRate') or node.get('ErrorRate') or node.get('ThrottleRate'):
+            features.add(f"node:{node['Node']}:{node['Type']}")
+    for sampled_trace in trace_summary.get('SampledTraces', []):
+        for issue in sampled_trace.get('Issues', []):
+            features.add(f"issue:{issue['Name']}:{issue['Status']}")
+            features.update(f"exception:{normalize_log_message(exception)}" for exception in issue.get('Exceptions', []))
+
+    return {"identity": (message.get('AlarmArn'), message.get('NewStateValue')), "features": frozenset(features)}
+
+@tracer.capture_method
+def get_cached_response(fingerprint):
+    """
+    Returns the most similar cached Bedrock analysis for the same alarm and state, if it is less than 
+    BEDROCK_CACHE_TTL seconds old and the Jaccard similarity of the context features is at least 
+    BEDROCK_CACHE_SIMILARITY.
+
+    Args:
+        fingerprint (dict): The context fingerprint, as returned by get_context_fingerprint.
+
+    Returns:
+        tuple: The cached response and the similarity, or None if there is no match.
+    """
+    ttl = int(os.environ.get('BEDROCK_CACHE_TTL', 3600))
+    threshold = float(os.environ.get('BEDROCK_CACHE_SIMILARITY', 0.8))
+
+    # Drop expired analyses
+    responses = [response for response in bedrock_response_cache.get(fingerprint["identity"], []) if time.time() - response["created"] < ttl]
+    if responses:
+        bedrock_response_cache[fingerprint["identity"]] = responses
+    else:
+        bedrock_response_cache.pop(fingerprint["identity"], None)
+
+    best_match = None
+    for response in responses:
+        union = fingerprint["features"] | response["features"]
+        similarity = len(fingerprint["features"] & response["features"]) / len(union) if union else 1
+        if similarity >= threshold and (best_match is None or similarity > best_match[1]):
+            best_match = (response, similarity)
+    return best_match
+
+@tracer.capture_method
+def put_cached_response(fingerprint, model_name, text):
+    """
+    Caches a Bedrock analysis with the fingerprint of the context it was generated for.
+
+    Args:
+        fingerprint (dict): The context fingerprint, as returned by get_context_fingerprint.
+        model_name (str): The name of the model that generated the analysis.
+        text (str): The analysis.
+    """
+    responses = bedrock_response_cache.pop(fingerprint["identity"], [])
+    responses.append({"features": fingerprint["features"], "model_name": model_name, "text": text, "created": time.time()})
+    bedrock_response_cache[fingerprint["identity"]] = responses[-MAX_CACHED_RESPONSES_PER_ALARM:]
+    if len(bedrock_response_cache) > MAX_CACHED_ALARMS:
+        del bedrock_response_cache[next(iter(bedrock_response_cache))]
+
+@tracer.capture_method
+def score_prompt_complexity(prompt, fingerprint=None):
+    """
+    Scores the complexity of the context of an alarm, to choose the model that analyses it.
+
+    A point is scored for each context section beyond the alarm itself (health events, CloudFormation 
+    template, resource information, log events, additional metrics and traces), for every 
+    BEDROCK_COMPLEXITY_TOKENS estimated tokens and for each error signal, up to MAX_ERROR_SIGNAL_SCORE. 
+    Error signals are the trace root causes, exceptions, faulty nodes and templates of error log messages in 
+    the context fingerprint, or mentions of faults, errors and exceptions in the prompt if there is no fingerprint.
+
+    Args:
+        prompt (str): The prompt, as returned by construct_prompt.
+        fingerprint (dict, optional): The context fingerprint, as returned by get_context_fingerprint.
+
+    Returns:
+        score (int): The complexity score.
+        factors (dict): The points scored for sections, tokens and error signals.
+    """
+    tokens_per_point = int(os.environ.get('BEDROCK_COMPLEXITY_TOKENS', 5000))
+
+    sections = [tag_name for tag_name in COMPLEX_PROMPT_SECTIONS if f'<{tag_name}>' in prompt]
+    if fingerprint:
+        error_signals = len([feature for feature in fingerprint["features"] if feature.split(':')[0] in ('rootcause', 'exception', 'node', 'issue', 'log-error')])
+    else:
+        error_signals = len(set(re.findall(r'\b\w*(?:Fault|Exception|Error)\b', prompt)))
+
+    factors = {
+        "sections": len(sections),
+        "tokens": estimate_tokens(prompt) // tokens_per_point,
+        "error_signals": min(error_signals, MAX_ERROR_SIGNAL_SCORE)
+    }
+    return sum(factors.values()), factors
+
+@tracer.capture_method
+def route_prompt(prompt, fingerprint=None):
+    """
+    Chooses the model for a prompt. If BEDROCK_SMALL_MODEL_ID is set, prompts with a complexity score below 
+    BEDROCK_COMPLEXITY_THRESHOLD are routed to it, and other prompts to BEDROCK_MODEL_ID.
+
+    Args:
+        prompt (str): The prompt, as returned by construct_prompt.
+        fingerprint (dict, optional): The context fingerprint, as returned by get_context_fingerprint.
+
+    Returns:
+        tier (str): small or large.
+        model_id (str): The model ID.
+    """
+    small_model_id = os.environ.get('BEDROCK_SMALL_MODEL_ID', '')
+    threshold = int(os.environ.get('BEDROCK_COMPLEXITY_THRESHOLD', 4))
+
+    score, factors = score_prompt_complexity(prompt, fingerprint)
+    if small_model_id and score < threshold:
+        tier, model_id = "small", small_model_id
+    else:
+        tier, model_id = "large", os.environ.get('BEDROCK_MODEL_ID')
+    logger.info("Bedrock routing", tier=tier, model_id=model_id, score=score, threshold=threshold, factors=factors)
+    return tier, model_id
 
 @tracer.capture_method
-def execute_prompt(prompt):
+def execute_prompt(prompt, fingerprint=None, stream=False):
+    """
+    Executes the prompt with Bedrock, or reuses a cached analysis of the same alarm with similar context.
+
+    Bedrock is invoked through BedrockClient, which retries throttled requests and fails over to 
+    BEDROCK_FALLBACKS, within BEDROCK_TIMEOUT seconds. If Bedrock is still throttled at the deadline, 
+    an analysis unavailable panel is returned so that the email is still sent.
+
+    Args:
+        prompt (str): The prompt, as returned by construct_prompt. It follows the instructions returned by build_prompt_instructions.
+        fingerprint (dict, optional): The context fingerprint, as returned by get_context_fingerprint. 
+        Analyses are only cached and reused if it is provided and BEDROCK_CACHE_TTL is not 0.
+        stream (bool, optional): Whether to stream the response with invoke_model_with_response_stream.
+
+    Returns:
+        str: The analysis in an HTML information panel.
+    """
     if os.environ.get('USE_BEDROCK'):
-        model_name = os.environ.get('BEDROCK_MODEL_ID').split('.')[1].split('-v')[0].capitalize()
-        bedrock = boto3.client(service_name="bedrock-runtime",region_name=os.environ.get('BEDROCK_REGION'))
+        use_cache = fingerprint is not None and int(os.environ.get('BEDROCK_CACHE_TTL', 3600)) > 0
+        cached_response = get_cached_response(fingerprint) if use_cache else None
+        if cached_response:
+            response, similarity = cached_response
+            created = datetime.datetime.fromtimestamp(response["created"], tz=datetime.timezone.utc).strftime("%H:%M:%S %Z")
+            logger.info("Reusing cached Bedrock response", similarity=similarity, generated_at=created)
+            note = f'<p><i>This analysis was generated for an earlier occurrence of this alarm at {created} with {similarity:.0%} similar context, and has been reused.</i></p>'
+            return get_information_panel(response["model_name"] + " says (cached analysis):", note + response["text"])
+
+        # Simple alarms are analysed by the small model and complex alarms by the large model
+        tier, model_id = route_prompt(prompt, fingerprint)
+        invoke_time = time.monotonic()
+        deadline = invoke_time + int(os.environ.get('BEDROCK_TIMEOUT', 300))
+
         system_prompt = "You are a devops engineer providing guidance about how to do root cause analysis. Your response will be displayed in an email to a user where a CloudWatch alarm has been triggered."
         max_tokens = int(os.environ.get('BEDROCK_MAX_TOKENS'))
-        user_message =  {"role": "user", "content": prompt}
-        messages = [user_message]
-        body=json.dumps(
-            {
-                "anthropic_version": os.environ.get('ANTHROPIC_VERSION'),
-                "max_tokens": max_tokens,
-                "system": system_prompt,
-                "messages": messages,
-                "temperature": 0.5,
-                "top_k": 250,
-                "top_p": 0.999                
-            }  
-        )                       
+        instructions = build_prompt_instructions()
+
         try:
-            response = bedrock.invoke_model(body=body, modelId=os.environ.get('BEDROCK_MODEL_ID'))
-        except botocore.exceptions.ClientError as error:
-            logger.exception("Error calling Bedrock")
-            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
-        except botocore.exceptions.ParamValidationError as error:
-            raise ValueError('The parameters you provided are incorrect: {}'.format(error))   
-        
-        response_body = json.loads(response.get("body").read())
-        logger.debug("Bedrock Response", extra=response_body) 
-        ai_response = get_information_panel(model_name + " says:", response_body["content"][0]["text"])
+            # The static instructions are a cacheable prefix for models that support prompt caching
+            response_text = None
+            if any(model in model_id for model in PROMPT_CACHING_MODELS):
+                response_text, model_id = converse(model_id, system_prompt, instructions, prompt, max_tokens, deadline, stream)
+
+            # Otherwise the static instructions are sent with the prompt to invoke_model
+            if response_text is None:
+                user_message =  {"role": "user", "content": instructions + prompt}
+                messages = [user_message]
+                body=json.dumps(
+                    {
+                        "anthropic_version": os.environ.get('ANTHROPIC_VERSION'),
+                        "max_tokens": max_tokens,
+                        "system": system_prompt,
+                        "messages": messages,
+                        "temperature": 0.5,
+                        "top_k": 250,
+                        "top_p": 0.999                
+                    }  
+                )                       
+                if stream:
+                    response_text, model_id = invoke_model_with_response_stream(body, model_id, deadline)
+                else:
+                    response_text, model_id = invoke_model(body, model_id, deadline)
+        except BedrockUnavailableError:
+            logger.exception("Bedrock is unavailable, sending the email without an analysis")
+            return get_information_panel("Analysis unavailable", "Bedrock was throttled or unavailable in every configured region and model, so this alarm has not been analysed.")
+
+        logger.info("Bedrock latency", tier=tier, model_id=model_id, total_seconds=round(time.monotonic() - invoke_time, 2))
+        model_name = get_model_name(model_id)
+        ai_response = get_information_panel(model_name + " says:", response_text)
+        if use_cache:
+            put_cached_response(fingerprint, model_name, response_text)
     else:
         ai_response = get_information_panel("Bedrock says:", "Bedrock analysis is disabled.")    
     return ai_response
+
+# Not traced, as it is called for every analysis
+def get_model_name(model_id):
+    """
+    Returns the display name of a model, e.g. Claude-3-7-sonnet-20250219, from a model ID, an inference profile 
+    ID or the ARN of either.
+    """
+    if model_id.startswith('arn:'):
+        model_id = model_id.split('/')[-1]
+    parts = model_id.split(':')[0].split('.')
+    if len(parts) > 2 and parts[0] in INFERENCE_PROFILE_PREFIXES:
+        parts = parts[1:]
+    # The vendor prefix, e.g. anthropic., is dropped
+    name = '.'.join(parts[1:]) if len(parts) > 1 else parts[0]
+    return name.split('-v')[0].capitalize()
+
+@tracer.capture_method
+def invoke_model(body, model_id, deadline):
+    """
+    Invokes a model with invoke_model.
+
+    Args:
+        body (str): The request body.
+        model_id (str): The model ID.
+        deadline (float): The time.monotonic() value after which no more attempts are made.
+
+    Returns:
+        response_text (str): The response text.
+        model_id (str): The model ID that was used, which differs from model_id after failing over to another model.
+
+    Raises:
+        BedrockUnavailableError: If every Bedrock region and model fails or is throttled until the deadline.
+    """
+    def read_response(response):
+        response_body = json.loads(response.get("body").read())
+        logger.debug("Bedrock Response", extra=response_body) 
+        return response_body["content"][0]["text"]
+
+    try:
+        return BedrockClient.invoke('invoke_model', {"body": body, "modelId": model_id}, deadline, read_response)
+    except botocore.exceptions.ClientError as error:
+        logger.exception("Error calling Bedrock")
+        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+    except botocore.exceptions.ParamValidationError as error:
+        raise ValueError('The parameters you provided are incorrect: {}'.format(error))   
+
+@tracer.capture_method
+def invoke_model_with_response_stream(body, model_id, deadline):
+    """
+    Invokes a model with invoke_model_with_response_stream and collects the streamed text.
+
+    Args:
+        body (str): The request body.
+        model_id (str): The model ID.
+        deadline (float): The time.monotonic() value after which no more attempts are made.
+
+    Returns:
+        response_text (str): The response text.
+        model_id (str): The model ID that was used, which differs from model_id after failing over to another model.
+
+    Raises:
+        BedrockUnavailableError: If every Bedrock region and model fails or is throttled until the deadline.
+    """
+    invoke_time = time.monotonic()
+    first_token_times = []
+
+    def read_response(response):
+        response_text = []
+        for event in response.get("body"):
+            chunk = json.loads(event["chunk"]["bytes"])
+            if chunk.get("type") == "content_block_delta":
+                if not first_token_times:
+                    first_token_times.append(time.monotonic())
+                response_text.append(chunk["delta"].get("text", ""))
+        return ''.join(response_text)
+
+    try:
+        response_text, model_id = BedrockClient.invoke('invoke_model_with_response_stream', {"body": body, "modelId": model_id}, deadline, read_response)
+    except botocore.exceptions.ClientError as error:
+        logger.exception("Error calling Bedrock")
+        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+    except botocore.exceptions.ParamValidationError as error:
+        raise ValueError('The parameters you provided are incorrect: {}'.format(error))   
+
+    logger.info("Bedrock response stream", 
+                first_token_seconds=round(first_token_times[0] - invoke_time, 2) if first_token_times else None, 
+                total_seconds=round(time.monotonic() - invoke_time, 2))
+    return response_text, model_id
+
+@tracer.capture_method
+def converse(model_id, system_prompt, instructions, prompt, max_tokens, deadline, stream=False):
+    """
+    Executes the prompt with the Converse API, with a prompt cache checkpoint after the static instructions 
+    so that they are only processed once while the cache is warm.
+
+    Args:
+        model_id (str): The model ID.
+        system_prompt (str): The system prompt.
+        instructions (str): The static instructions, as returned by build_prompt_instructions.
+        prompt (str): The prompt, as returned by construct_prompt.
+        max_tokens (int): The maximum number of tokens to generate.
+        deadline (float): The time.monotonic() value after which no more attempts are made.
+        stream (bool, optional): Whether to stream the response with converse_stream.
+
+    Returns:
+        response_text (str): The response text, or None if the request to an Anthropic model was rejected and invoke_model should be used instead.
+        model_id (str): The model ID that was used, which differs from model_id after failing over to another model.
+
+    Raises:
+        BedrockUnavailableError: If every Bedrock region and model fails or is throttled until the deadline.
+    """
+    request = {
+        "modelId": model_id,
+        "system": [{"text": system_prompt}, {"text": instructions}, {"cachePoint": {"type": "default"}}],
+        "messages": [{"role": "user", "content": [{"text": prompt}]}],
+        "inferenceConfig": {"maxTokens": max_tokens, "temperature": 0.5, "topP": 0.999}
+    }
+    if 'anthropic' in model_id:
+        request["additionalModelRequestFields"] = {"top_k": 250}
+
+    usage = {}
+    def read_response(response):
+        if not stream:
+            usage.update(response.get("usage", {}))
+            return ''.join(block.get("text", "") for block in response["output"]["message"]["content"])
+        response_text = []
+        for event in response.get("stream"):
+            if "contentBlockDelta" in event:
+                response_text.append(event["contentBlockDelta"]["delta"].get("text", ""))
+            elif "metadata" in event:
+                usage.update(event["metadata"].get("usage", {}))
+        return ''.join(response_text)
+
+    invoke_time = time.monotonic()
+    try:
+        response_text, model_id = BedrockClient.invoke('converse_stream' if stream else 'converse', request, deadline, read_response)
+    except botocore.exceptions.ClientError as error:
+        # invoke_model is called with an Anthropic request body, so other models cannot fall back to it
+        if error.response.get("Error", {}).get("Code") == "ValidationException" and 'anthropic' in model_id:
+            logger.warning("Converse request was rejected, falling back to invoke_model", error=str(error))
+            return None, model_id
+        logger.exception("Error calling Bedrock")
+        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+    except botocore.exceptions.ParamValidationError as error:
+        raise ValueError('The parameters you provided are incorrect: {}'.format(error))   
+
+    logger.info("Bedrock converse", 
+                input_tokens=usage.get("inputTokens"), 
+                cache_read_input_tokens=usage.get("cacheReadInputTokens"), 
+                cache_write_input_tokens=usage.get("cacheWriteInputTokens"), 
+                output_tokens=usage.get("outputTokens"),
+                total_seconds=round(time.monotonic() - invoke_time, 2))
+    return response_text, model_id
@@ -1,9 +1,12 @@
 import json
+import os
 import re
 import yaml
 import boto3
+import hashlib
 import botocore
 from collections import OrderedDict
+from collections.abc import Mapping
 from cfn_flip import to_json
 from datetime import date
 
@@ -13,32 +16,192 @@ from aws_lambda_powertools import Tracer
 logger = Logger()
 tracer = Tracer()
 
-@tracer.capture_method
-def process_cloudformation_template(cloudformation_template, trace_summary, max_length=100):
-    if 'trace_summary' not in locals() or not trace_summary or 'TraceSummaries' not in trace_summary:
-        # No trace summary or no traces available, return the entire truncated template
-        preprocessed_template = truncate_template(cloudformation_template, max_length)
-        return preprocessed_template
-
-    fault_root_cause_types = set()
-    error_root_cause_types = set()
+# Parsed templates by stack ID and last update time, persisted across warm invocations
+cloudformation_template_cache = OrderedDict()
+
+# The maximum number of resources in the slice of the template around the alarmed resource
+MAX_TEMPLATE_SLICE_RESOURCES = 25
+
+# The maximum depth of nested stacks searched for the alarmed resource
+MAX_NESTED_STACK_DEPTH = 5
+
+# Dimensions whose values are the end of the physical ID, such as a load balancer ARN or a queue URL
+SUFFIX_MATCHED_DIMENSIONS = ('LoadBalancer', 'TargetGroup', 'QueueName')
+
+# Dimensions whose values are of the form app/<name>/<id> or targetgroup/<name>/<id>, whose name may be the physical ID in the template
+PATH_DIMENSIONS = ('LoadBalancer', 'TargetGroup')
+
+# Matches the variables in Fn::Sub strings, excluding ${!Literal}
+SUB_REFERENCE_PATTERN = re.compile(r'\$\{([^!}][^}]*)\}')
+
+# Matches the top level keys of a block style YAML template, such as Resources:
+TOP_LEVEL_KEY_PATTERN = re.compile(r'^([A-Za-z][\w]*)\s*:')
+
+# Matches YAML anchors and aliases, such as &defaults or *defaults, which may refer across top level sections
+YAML_ANCHOR_PATTERN = re.compile(r'(?:^|[\s\[{,])[&*][\w-]+', re.MULTILINE)
+
+# Short form intrinsic function tags that are not prefixed with Fn:: in the long form
+UNPREFIXED_TAGS = ('Ref', 'Condition')
+
+class CloudFormationLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    """
+    A YAML loader for CloudFormation templates, which uses the LibYAML C parser if it is available. Short form 
+    intrinsic functions, such as !Ref or !GetAtt, are constructed in their long form and timestamps are 
+    kept as strings, as they are by cfn_flip.
+    """
+    pass
+
+def construct_intrinsic_function(loader, tag_suffix, node):
+    name = tag_suffix if tag_suffix in UNPREFIXED_TAGS else f'Fn::{tag_suffix}'
+    if name == 'Fn::GetAtt' and isinstance(node, yaml.ScalarNode):
+        return {name: loader.construct_scalar(node).split('.', 1)}
+    if isinstance(node, yaml.ScalarNode):
+        return {name: loader.construct_scalar(node)}
+    if isinstance(node, yaml.SequenceNode):
+        return {name: loader.construct_sequence(node, deep=True)}
+    return {name: loader.construct_mapping(node, deep=True)}
+
+CloudFormationLoader.add_multi_constructor('!', construct_intrinsic_function)
+CloudFormationLoader.add_constructor('tag:yaml.org,2002:timestamp', lambda loader, node: loader.construct_scalar(node))
+
+class LazyTemplate(Mapping):
+    """
+    A parsed template whose top level sections, such as Resources or Outputs, are only parsed when they are used.
+    """
+    def __init__(self, sections):
+        self.__sections = sections
+        self.__parsed = {}
+
+    def __getitem__(self, key):
+        if key not in self.__parsed:
+            section = self.__sections[key]
+            try:
+                self.__parsed[key] = yaml.load(section, Loader=CloudFormationLoader)[key]
+            except yaml.YAMLError:
+                # The section may not parse on its own, so the whole template is parsed instead
+                logger.warning("Parsing the whole template, as a section could not be parsed on its own", section=key)
+                self.__parsed.update(load_yaml_template(''.join(self.__sections.values())))
+        return self.__parsed[key]
+
+    def __iter__(self):
+        return iter(self.__sections)
+
+    def __len__(self):
+        return len(self.__sections)
+
+    def get_sections(self):
+        """
+        Returns the unparsed sections by key.
+        """
+        return self.__sections
 
-    for trace in trace_summary['TraceSummaries']:
-        fault_root_causes = trace.get('FaultRootCauses', [])
-        fault_root_cause_types.update(get_root_cause_service_types(fault_root_causes))
+@tracer.capture_method
+def parse_cloudformation_template(template_body):
+    """
+    Parses a template, as returned by get_template, without a JSON round trip.
+
+    JSON templates are parsed by botocore, or with json. Block style YAML templates without anchors are split 
+    into their top level sections, which are parsed with CloudFormationLoader when they are first used. Other 
+    YAML templates are parsed in full.
+
+    Args:
+        template_body (str or dict): The template body.
+
+    Returns:
+        Mapping: The parsed template.
+    """
+    if isinstance(template_body, Mapping):
+        return template_body
+    if template_body.lstrip().startswith('{'):
+        try:
+            return json.loads(template_body, object_pairs_hook=OrderedDict)
+        except ValueError:
+            pass
+
+    if YAML_ANCHOR_PATTERN.search(template_body):
+        return load_yaml_template(template_body)
+
+    sections, key = {}, None
+    for line in template_body.splitlines(keepends=True):
+        match = TOP_LEVEL_KEY_PATTERN.match(line)
+        if match:
+            key = match.group(1)
+            sections[key] = line
+        elif key and (line[:1] in (' ', '\t', '#', '\r', '\n', '-') and not line.startswith(('---', '...'))):
+            sections[key] += line
+        elif line.strip() and not line.startswith(('#', '---', '%')):
+            # Not block style, such as a flow style mapping
+            sections = None
+            break
+
+    if not sections:
+        return load_yaml_template(template_body)
+    return LazyTemplate(sections)
 
-        error_root_causes = trace.get('ErrorRootCauses', [])
-        error_root_cause_types.update(get_root_cause_service_types(error_root_causes))
+@tracer.capture_method
+def load_yaml_template(template_body):
+    """
+    Parses a whole YAML template with CloudFormationLoader, or with cfn_flip if it cannot be parsed.
+
+    Args:
+        template_body (str): The template body.
+
+    Returns:
+        dict: The parsed template.
+    """
+    try:
+        return yaml.load(template_body, Loader=CloudFormationLoader)
+    except yaml.YAMLError:
+        # Fall back to cfn_flip, which is slower but more lenient
+        logger.warning("Falling back to cfn_flip to parse template")
+        return json.loads(to_json(template_body), object_pairs_hook=OrderedDict)
 
-    combined_root_cause_types = fault_root_cause_types | error_root_cause_types
+@tracer.capture_method
+def process_cloudformation_template(cloudformation_template, trace_summary, max_length=100, truncated_templates=None, template_index=None, dimensions=None, alarmed_resources=None):
+    """
+    Selects the resources of the template that are relevant to the alarm: the resources of the root cause types 
+    in the trace summary, and the alarmed resource with the resources it directly depends on. If there are none, 
+    the whole template is truncated instead.
+
+    Args:
+        cloudformation_template (dict): The parsed template.
+        trace_summary (dict): The trace summary, as returned by process_traces.
+        max_length (int): The maximum length of values in the truncated template.
+        truncated_templates (dict, optional): Truncated templates by max_length, which are reused and added to.
+        template_index (dict, optional): The index of the template, as returned by build_template_index.
+        dimensions (list, optional): The dimensions of the alarm metric, used to find the alarmed resource by the 
+        names in the template if alarmed_resources is not provided.
+        alarmed_resources (dict, optional): The alarmed resources and their dependencies, as found by get_alarmed_stack_resources.
+
+    Returns:
+        str: The selected resources or truncated template, as JSON.
+    """
+    if truncated_templates is None:
+        truncated_templates = {}
+    if template_index is None:
+        template_index = build_template_index(cloudformation_template)
+
+    combined_root_cause_types = set()
+    for trace in (trace_summary or {}).get('TraceSummaries', []):
+        combined_root_cause_types.update(get_root_cause_service_types(trace.get('FaultRootCauses', [])))
+        combined_root_cause_types.update(get_root_cause_service_types(trace.get('ErrorRootCauses', [])))
+
+    filtered_resources = filter_resources_from_template(cloudformation_template, combined_root_cause_types, template_index)
+
+    # The alarmed resource and the resources it depends on
+    if not alarmed_resources:
+        alarmed_resources = get_resource_neighbourhood(cloudformation_template, template_index, find_alarmed_resources(template_index, dimensions))
+    filtered_resources.update(alarmed_resources)
+    logger.info("CloudFormation resources", root_cause_types=sorted(combined_root_cause_types), alarmed_resources=list(alarmed_resources), resources=list(filtered_resources))
 
-    filtered_resources = filter_resources_from_template(cloudformation_template, combined_root_cause_types)
     if filtered_resources:
-        # If resources are filtered based on root cause types, return the filtered resources
-        preprocessed_template = json.dumps(filtered_resources, indent=2)
+        # If resources are filtered based on root cause types or the alarmed resource, return the filtered resources
+        preprocessed_template = json.dumps(filtered_resources, indent=2, cls=CustomJSONEncoder)
     else:
         # If no resources are filtered, return the entire truncated template
-        preprocessed_template = truncate_template(cloudformation_template, max_length)
+        if max_length not in truncated_templates:
+            truncated_templates[max_length] = truncate_template(cloudformation_template, max_length)
+        preprocessed_template = truncated_templates[max_length]
 
     return preprocessed_template
 
@@ -63,22 +226,135 @@ def get_root_cause_service_types(root_causes):
     return root_cause_types
 
 @tracer.capture_method
-def filter_resources_from_template(template_str, root_cause_types):
-    template_dict = json.loads(template_str)
+def filter_resources_from_template(template_dict, root_cause_types, template_index=None):
+    if template_index is None:
+        template_index = build_template_index(template_dict)
 
-    # Filter resources
+    # Filter resources by looking up the logical IDs of each type
+    resources = template_dict.get('Resources', {})
     filtered_resources = {}
-    for resource_id, resource_details in template_dict.get('Resources', {}).items():
-        resource_type = resource_details.get('Type')
-        if resource_type in root_cause_types:
-            filtered_resources[resource_id] = resource_details
+    for resource_type in root_cause_types:
+        for resource_id in template_index['resource_types'].get(resource_type, []):
+            filtered_resources[resource_id] = resources[resource_id]
 
     return filtered_resources
 
 @tracer.capture_method
-def truncate_template(template_str, max_length):
-    template_obj = json.loads(template_str, object_pairs_hook=OrderedDict)
+def build_template_index(template_dict):
+    """
+    Indexes the resources of a parsed template, once per stack revision.
+
+    Args:
+        template_dict (dict): The parsed template.
+
+    Returns:
+        dict: The logical IDs by resource type, the logical IDs that each resource depends on through Ref, 
+        Fn::GetAtt, Fn::Sub and DependsOn, and the logical IDs by physical ID, for resources that are 
+        named in the template.
+    """
+    resources = template_dict.get('Resources', {})
+    template_index = {'resource_types': {}, 'dependencies': {}, 'physical_ids': {}}
+
+    for resource_id, resource_details in resources.items():
+        if not isinstance(resource_details, dict):
+            continue
+        resource_type = resource_details.get('Type', '')
+        template_index['resource_types'].setdefault(resource_type, []).append(resource_id)
+
+        # Dependencies on other resources, parameters and pseudo parameters are ignored
+        references = get_template_references(resource_details.get('Properties', {}))
+        depends_on = resource_details.get('DependsOn', [])
+        references.update([depends_on] if isinstance(depends_on, str) else depends_on)
+        template_index['dependencies'][resource_id] = sorted(reference for reference in references if reference in resources and reference != resource_id)
+
+        # Physical IDs of resources with a name property, such as FunctionName or DBInstanceIdentifier
+        properties = resource_details.get('Properties', {})
+        type_name = resource_type.split('::')[-1]
+        for name_property in (f'{type_name}Name', f'{type_name}Identifier', 'Name'):
+            if isinstance(properties, dict) and isinstance(properties.get(name_property), str):
+                template_index['physical_ids'][properties[name_property]] = resource_id
+                break
+
+    return template_index
+
+# Not traced, as it is called for every value of every resource
+def get_template_references(value):
+    """
+    Returns the logical IDs referenced by Ref, Fn::GetAtt and Fn::Sub in a template value.
+    """
+    references = set()
+    pending = [value]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key == 'Ref' and isinstance(item, str):
+                    references.add(item)
+                elif key == 'Fn::GetAtt':
+                    attribute = item.split('.')[0] if isinstance(item, str) else item[0] if isinstance(item, list) and item else None
+                    if isinstance(attribute, str):
+                        references.add(attribute)
+                elif key == 'Fn::Sub':
+                    text = item if isinstance(item, str) else item[0] if isinstance(item, list) and item else ''
+                    if isinstance(text, str):
+                        references.update(match.split('.')[0] for match in SUB_REFERENCE_PATTERN.findall(text))
+                    if isinstance(item, list):
+                        pending.extend(item[1:])
+                else:
+                    pending.append(item)
+        elif isinstance(value, list):
+            pending.extend(value)
+    return references
+
+@tracer.capture_method
+def find_alarmed_resources(template_index, dimensions):
+    """
+    Finds the logical IDs of the resources named by the dimensions of the alarm metric. The values of the 
+    dimensions in PATH_DIMENSIONS also match by the name in their path, such as the name of a load balancer.
+
+    Args:
+        template_index (dict): The index of the template, as returned by build_template_index.
+        dimensions (list): The dimensions of the alarm metric, with name and value.
+
+    Returns:
+        list: The logical IDs of the alarmed resources.
+    """
+    alarmed_logical_ids = []
+    for dimension in dimensions or []:
+        name, value = dimension.get('name') or dimension.get('Name'), dimension.get('value') or dimension.get('Value')
+        if not value:
+            continue
+        candidates = [value] + value.split('/')[1:2] if name in PATH_DIMENSIONS else [value]
+        for candidate in candidates:
+            logical_id = template_index['physical_ids'].get(candidate)
+            if logical_id and logical_id not in alarmed_logical_ids:
+                alarmed_logical_ids.append(logical_id)
+    return alarmed_logical_ids
 
+@tracer.capture_method
+def get_resource_neighbourhood(template_dict, template_index, logical_ids):
+    """
+    Returns the resources with the given logical IDs and the resources they directly depend on, up to 
+    MAX_TEMPLATE_SLICE_RESOURCES resources.
+
+    Args:
+        template_dict (dict): The parsed template.
+        template_index (dict): The index of the template, as returned by build_template_index.
+        logical_ids (list): The logical IDs of the resources.
+
+    Returns:
+        dict: The resources by logical ID.
+    """
+    resources = template_dict.get('Resources', {})
+    neighbourhood = list(dict.fromkeys(logical_ids))
+    for resource_id in list(neighbourhood):
+        for dependency in template_index['dependencies'].get(resource_id, []):
+            if dependency not in neighbourhood:
+                neighbourhood.append(dependency)
+    return {resource_id: resources[resource_id] for resource_id in neighbourhood[:MAX_TEMPLATE_SLICE_RESOURCES]}
+
+@tracer.capture_method
+def truncate_template(template_obj, max_length):
     # Truncate values in the template object
     truncated_obj = truncate_values(template_obj, max_length)
 
@@ -109,7 +385,7 @@ def remove_comments(template_str):
 def truncate_values(obj, max_length=100):
     if isinstance(obj, str):
         return obj[:max_length]
-    elif isinstance(obj, dict):
+    elif isinstance(obj, Mapping):
         return {k: truncate_values(v, max_length) for k, v in obj.items()}
     elif isinstance(obj, list):
         return [truncate_values(item, max_length) for item in obj]
@@ -121,6 +397,8 @@ class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, date):
             return obj.isoformat()
+        if isinstance(obj, Mapping):
+            return dict(obj)
         return super().default(obj)
 
 @tracer.capture_method
@@ -142,7 +420,25 @@ def find_cloudformation_arn(tags):
     return cloudformation_arn
 
 @tracer.capture_method
-def get_cloudformation_template(tags, region, trace_summary, max_length=100):
+def get_cloudformation_template(tags, region, trace_summary, max_length=100, dimensions=None):
+    """
+    Returns the resources of the stack that created the resource that are relevant to the alarm, or the 
+    truncated template.
+
+    Templates are parsed and indexed once per stack revision, see get_stack_template. The alarmed resource is 
+    found by matching the dimensions of the alarm metric to the physical IDs of the stack resources, including 
+    the resources of nested stacks, see get_alarmed_stack_resources.
+
+    Args:
+        tags (list or dict): The tags of the resource, which include the aws:cloudformation:stack-id tag.
+        region (str): The region of the stack.
+        trace_summary (dict): The trace summary, as returned by process_traces.
+        max_length (int): The maximum length of values in the truncated template.
+        dimensions (list, optional): The dimensions of the alarm metric, used to find the alarmed resource.
+
+    Returns:
+        str: The filtered or truncated template as JSON, or None if the resource has no stack.
+    """
     preprocessed_template = None
 
     if not tags:
@@ -152,9 +448,42 @@ def get_cloudformation_template(tags, region, trace_summary, max_length=100):
 
     if cloudformation_arn:      
         cloudformation = boto3.client('cloudformation', region_name=region)
+        cached_template = get_stack_template(cloudformation, cloudformation_arn)
+        alarmed_resources = get_alarmed_stack_resources(cloudformation, cached_template, dimensions)
+        preprocessed_template = process_cloudformation_template(cached_template["template"], trace_summary, max_length, 
+                                                                cached_template["truncated"], cached_template["index"], dimensions, alarmed_resources)
+
+    return preprocessed_template
+
+@tracer.capture_method
+def get_stack_template(cloudformation, stack_name):
+    """
+    Returns the parsed and indexed template of a stack. 
+
+    Templates are cached by stack ID and last update time, which are found with describe_stacks, in memory 
+    and, if CLOUDFORMATION_TEMPLATE_CACHE_DIR is set, in that directory.
+
+    Args:
+        cloudformation (boto3.client): A CloudFormation client.
+        stack_name (str): The stack name or ID.
+
+    Returns:
+        dict: The stack ID and last update time, the parsed template, its index and the truncated templates by max_length.
+    """
+    try:
+        stack = cloudformation.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as error:
+        logger.exception("Error describing CloudFormation stack")
+        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+    except botocore.exceptions.ParamValidationError as error:
+        raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+    last_updated = (stack.get('LastUpdatedTime') or stack['CreationTime']).isoformat()
+
+    cached_template = get_cached_template(stack['StackId'], last_updated)
+    if cached_template is None:
         try:
             response = cloudformation.get_template(
-                StackName=cloudformation_arn,
+                StackName=stack['StackId'],
                 TemplateStage='Processed'
             )
         except botocore.exceptions.ClientError as error:
@@ -163,16 +492,192 @@ def get_cloudformation_template(tags, region, trace_summary, max_length=100):
         except botocore.exceptions.ParamValidationError as error:
             raise ValueError('The parameters you provided are incorrect: {}'.format(error))
         
-        cloudformation_template = response['TemplateBody']
         logger.info ("Cloudformation Template", extra=response)                 
 
+        cached_template = {"template": parse_cloudformation_template(response['TemplateBody']), "truncated": {}}
+        cached_template["index"] = build_template_index(cached_template["template"])
+        put_cached_template(stack['StackId'], last_updated, cached_template)
+
+    cached_template["stack_id"], cached_template["last_updated"] = stack['StackId'], last_updated
+    return cached_template
+
+@tracer.capture_method
+def get_stack_resources(cloudformation, cached_template):
+    """
+    Returns the resources of a stack and its nested stacks by physical ID. They are cached with the template 
+    of the stack revision.
+
+    Args:
+        cloudformation (boto3.client): A CloudFormation client.
+        cached_template (dict): The cached template of the stack, as returned by get_stack_template.
+
+    Returns:
+        dict: The stack ID, the logical ID and the logical IDs of the nested stacks it is in, by physical ID.
+    """
+    if "resources" in cached_template:
+        return cached_template["resources"]
+
+    stack_resources = {}
+    pending = [(cached_template["stack_id"], [])]
+    while pending:
+        stack_id, stack_path = pending.pop(0)
         try:
-            # Attempt to treat the string as YAML and convert to JSON
-            cloudformation_template = to_json(cloudformation_template)
-        except Exception as e:
-            # The template is in JSON, conver to string
-            cloudformation_template = json.dumps(cloudformation_template)
-            
-        preprocessed_template = process_cloudformation_template(cloudformation_template, trace_summary, max_length)
-
-    return preprocessed_template
\ No newline at end of file
+            paginator = cloudformation.get_paginator('list_stack_resources')
+            for page in paginator.paginate(StackName=stack_id):
+                for resource in page['StackResourceSummaries']:
+                    physical_id = resource.get('PhysicalResourceId')
+                    if not physical_id:
+                        continue
+                    stack_resources[physical_id] = {"stack_id": stack_id, "logical_id": resource['LogicalResourceId'], "stack_path": stack_path}
+                    if resource['ResourceType'] == 'AWS::CloudFormation::Stack' and len(stack_path) < MAX_NESTED_STACK_DEPTH:
+                        pending.append((physical_id, stack_path + [resource['LogicalResourceId']]))
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error listing CloudFormation stack resources")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+
+    cached_template["resources"] = stack_resources
+    return stack_resources
+
+@tracer.capture_method
+def get_alarmed_stack_resources(cloudformation, cached_template, dimensions):
+    """
+    Finds the alarmed resources by matching the dimensions of the alarm metric to the physical IDs of the 
+    resources of a stack and its nested stacks, and returns them with the resources they directly depend on.
+
+    A dimension matches a physical ID that is equal to it. The dimensions in SUFFIX_MATCHED_DIMENSIONS also 
+    match a physical ID that ends with them after a / or :, such as the ARN of a load balancer for its 
+    LoadBalancer dimension or the URL of a queue for its QueueName dimension.
+
+    Args:
+        cloudformation (boto3.client): A CloudFormation client.
+        cached_template (dict): The cached template of the stack, as returned by get_stack_template.
+        dimensions (list): The dimensions of the alarm metric, with name and value.
+
+    Returns:
+        dict: The resources by logical ID, prefixed with the logical IDs of the nested stacks they are in, 
+        such as NetworkStack/LoadBalancer.
+    """
+    dimension_values = [(dimension.get('name') or dimension.get('Name'), dimension.get('value') or dimension.get('Value')) for dimension in dimensions or []]
+    dimension_values = [(name, value) for name, value in dimension_values if value]
+    if not dimension_values:
+        return {}
+
+    stack_resources = get_stack_resources(cloudformation, cached_template)
+    alarmed_logical_ids = {}
+    for name, value in dimension_values:
+        if value in stack_resources:
+            matches = [stack_resources[value]]
+        elif name in SUFFIX_MATCHED_DIMENSIONS:
+            matches = [stack_resource for physical_id, stack_resource in stack_resources.items() if physical_id.endswith(('/' + value, ':' + value))]
+        else:
+            matches = []
+        for stack_resource in matches:
+            logical_ids = alarmed_logical_ids.setdefault(stack_resource["stack_id"], {"stack_path": stack_resource["stack_path"], "logical_ids": []})["logical_ids"]
+            if stack_resource["logical_id"] not in logical_ids:
+                logical_ids.append(stack_resource["logical_id"])
+
+    alarmed_resources = {}
+    for stack_id, alarmed in alarmed_logical_ids.items():
+        stack_template = cached_template if stack_id == cached_template["stack_id"] else get_stack_template(cloudformation, stack_id)
+        prefix = ''.join(f'{logical_id}/' for logical_id in alarmed["stack_path"])
+        for logical_id, resource in get_resource_neighbourhood(stack_template["template"], stack_template["index"], alarmed["logical_ids"]).items():
+            alarmed_resources[prefix + logical_id] = resource
+    logger.info("Alarmed CloudFormation resources", dimensions=[value for _, value in dimension_values], stacks=len(alarmed_logical_ids), resources=list(alarmed_resources))
+    return alarmed_resources
+
+@tracer.capture_method
+def get_cached_template(stack_id, last_updated):
+    """
+    Returns the cached template of a stack revision, from memory or the cache directory.
+
+    Args:
+        stack_id (str): The stack ID.
+        last_updated (str): The time the stack was last updated, or created if it has not been updated.
+
+    Returns:
+        dict: The parsed template, its index and the truncated templates by max_length, or None if it is not cached.
+    """
+    cache_key = (stack_id, last_updated)
+    cached_template = cloudformation_template_cache.pop(cache_key, None)
+    if cached_template is None:
+        cache_file = get_template_cache_file(stack_id, last_updated)
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as file:
+                    content = json.load(file, object_pairs_hook=OrderedDict)
+                # The modification time orders the files for eviction, so it is updated when a file is used
+                os.utime(cache_file)
+                template = LazyTemplate(content["sections"]) if "sections" in content else content["template"]
+                cached_template = {"template": template, "truncated": {}}
+                cached_template["index"] = build_template_index(cached_template["template"])
+            except (OSError, ValueError):
+                logger.exception("Error reading template from the template cache directory", stack_id=stack_id)
+    if cached_template is not None:
+        cloudformation_template_cache[cache_key] = cached_template
+    logger.info("CloudFormation template cache", stack_id=stack_id, last_updated=last_updated, hit=cached_template is not None)
+    return cached_template
+
+@tracer.capture_method
+def put_cached_template(stack_id, last_updated, cached_template):
+    """
+    Caches the template of a stack revision, in memory and in the cache directory, replacing earlier revisions.
+    YAML templates are cached in the directory unparsed, as they are quick to parse with CloudFormationLoader.
+    The least recently used files are evicted from the directory to keep it within CLOUDFORMATION_TEMPLATE_CACHE_DIR_BYTES.
+
+    Args:
+        stack_id (str): The stack ID.
+        last_updated (str): The time the stack was last updated, or created if it has not been updated.
+        cached_template (dict): The parsed template, its index and the truncated templates by max_length.
+    """
+    for cache_key in [cache_key for cache_key in cloudformation_template_cache if cache_key[0] == stack_id]:
+        del cloudformation_template_cache[cache_key]
+    cloudformation_template_cache[(stack_id, last_updated)] = cached_template
+    while len(cloudformation_template_cache) > int(os.environ.get('CLOUDFORMATION_TEMPLATE_CACHE_SIZE', 20)):
+        cloudformation_template_cache.popitem(last=False)
+
+    cache_file = get_template_cache_file(stack_id, last_updated)
+    if not cache_file:
+        return
+    max_bytes = int(os.environ.get('CLOUDFORMATION_TEMPLATE_CACHE_DIR_BYTES', 67108864))
+    # YAML templates are written unparsed, so that they are still parsed lazily when read
+    template = cached_template["template"]
+    content = json.dumps({"sections": template.get_sections()} if isinstance(template, LazyTemplate) else {"template": template}, separators=(',', ':'), cls=CustomJSONEncoder)
+    if len(content) > max_bytes:
+        return
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        stack_prefix = os.path.basename(cache_file).split('-')[0]
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.startswith(stack_prefix + '-'):
+                os.remove(entry.path)
+            elif entry.name.endswith('.json'):
+                entries.append(entry)
+
+        # Evict the least recently used templates of other stacks
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        cache_bytes = sum(entry.stat().st_size for entry in entries)
+        while entries and cache_bytes + len(content) > max_bytes:
+            entry = entries.pop(0)
+            cache_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+
+        with open(cache_file, 'w') as file:
+            file.write(content)
+    except OSError:
+        logger.exception("Error writing template to the template cache directory", stack_id=stack_id)
+
+# Not traced, as it is called for every template cache lookup
+def get_template_cache_file(stack_id, last_updated):
+    """
+    Returns the cache file of a stack revision, or None if CLOUDFORMATION_TEMPLATE_CACHE_DIR is not set.
+    """
+    cache_dir = os.environ.get('CLOUDFORMATION_TEMPLATE_CACHE_DIR', '')
+    if not cache_dir:
+        return None
+    stack_hash = hashlib.sha1(stack_id.encode()).hexdigest()
+    revision_hash = hashlib.sha1(last_updated.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{stack_hash}-{revision_hash}.json")
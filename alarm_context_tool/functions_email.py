@@ -73,7 +73,7 @@ def build_email_summary(alarm_name, region_name, new_state, reason, display_chan
     return summary
 
 @tracer.capture_method
-def send_email(sender, recipient, subject, body_text, body_html, attachments=None, charset="UTF-8"):
+def send_email(sender, recipient, subject, body_text, body_html, attachments=None, charset="UTF-8", in_reply_to=None):
     """
     Send an email using AWS SES.
     
@@ -85,12 +85,19 @@ def send_email(sender, recipient, subject, body_text, body_html, attachments=Non
     - body_html (str): HTML body of the email.
     - attachments (list of dicts): Files to attach to the email. Each dict must have 'filename' and 'data' keys.
     - charset (str): Character set for the text encoding.
+    - in_reply_to (str): Message-ID of the email that this email replies to, so that they are threaded.
+
+    Returns:
+    - str: The Message-ID of the email, as assigned by SES.
     """   
     # Create a multipart/mixed parent container.
     msg = MIMEMultipart('mixed')
     msg['Subject'] = subject
     msg['From'] = sender
     msg['To'] = recipient
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+        msg['References'] = in_reply_to
 
     # Create a multipart/alternative part for the text and HTML content.
     msg_body = MIMEMultipart('alternative')
@@ -121,6 +128,10 @@ def send_email(sender, recipient, subject, body_text, body_html, attachments=Non
     except botocore.exceptions.ParamValidationError as error:
         raise ValueError('The parameters you provided are incorrect: {}'.format(error))        
 
+    # SES replaces the Message-ID header with one based on the SES message ID
+    ses_domain = 'email.amazonses.com' if os.environ['AWS_REGION'] == 'us-east-1' else f"{os.environ['AWS_REGION']}.amazonses.com"
+    return f"<{response['MessageId']}@{ses_domain}>"
+
 @tracer.capture_method
 def build_html_body(subject, summary, ai_response, widget_images, trace_html, additional_information, alarm_details, metric_details):
     
@@ -225,3 +236,37 @@ def build_html_body(subject, summary, ai_response, widget_images, trace_html, ad
 
     return BODY_HTML
 
+
+@tracer.capture_method
+def build_analysis_html_body(subject, ai_response):
+    """
+    Builds the HTML body of the follow-up email that contains the Bedrock analysis, when the context email is sent first.
+
+    Parameters:
+    - subject (str): Subject line of the email.
+    - ai_response (str): The Bedrock analysis, in an HTML information panel.
+
+    Returns:
+    - str: The HTML body.
+    """
+    return f'''
+    <!DOCTYPE htmlPUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+    <html xmlns="http://www.w3.org/1999/xhtml" lang="en">
+        <head>
+            <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+            <meta http-equiv="X-UA-Compatible" content="IE=edge">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>{subject}</title>
+        </head>
+        <body>
+            <center>
+                <table style="word-wrap: break-all; width:100%;max-width:640px;margin: 0 auto;" width="100%" width="640" cellpadding="0" cellspacing="0" border="0">
+                    <tr><td></td><td width="640" style="max-width:640px; padding:9px; color: rgb(255, 255, 255) !important; -webkit-text-fill-color: rgb(255, 255, 255) !important; margin-bottom:10px; text-align:left; background: rgb(35,47,62); background: linear-gradient(135deg, rgba(35,47,62,1) 0%, rgba(0,49,129,1) 25%, rgba(0,49,129,1) 50%, rgba(32,116,213,1) 90%, rgba(255,153,0,1) 100%);">
+                    {subject}</td><td></td></tr>
+                    <tr><td></td><td width="100%" style="text-align:left; line-height: 10px;">&nbsp;</td><td></td></tr>
+                    <tr><td></td><td width="640" style="max-width:640px; text-align:left;">{ai_response}</td><td></td></tr>
+                </table>
+            </center>
+        </body>
+    </html>
+    '''
@@ -1,5 +1,11 @@
+import os
+import json
+import time
+import zlib
 import datetime
+import boto3
 import botocore
+from collections import OrderedDict
 
 from  health_client import HealthClient
 
@@ -8,10 +14,49 @@ from aws_lambda_powertools import Tracer
 logger = Logger()
 tracer = Tracer()
 
+# The open and upcoming events of each region, with the time they were described, kept for HEALTH_CACHE_TTL seconds
+health_events_cache = {}
+
+# The descriptions of events by event ARN, kept until the event is updated
+health_event_details_cache = OrderedDict()
+MAX_CACHED_HEALTH_EVENT_DETAILS = 1000
+
+# Event descriptions are kept in HEALTH_CACHE_TABLE_NAME for this long after they were last written
+HEALTH_EVENT_DETAILS_RETENTION_SECONDS = 8 * 24 * 3600
+
+health_cache_table_client = None
+
 # AWS Health Event Details
 @tracer.capture_method
-def event_details(event_arns):
+def event_details(events, region):
+    """
+    Returns the descriptions of AWS Health events.
+
+    Descriptions are cached by event ARN, in memory and in HEALTH_CACHE_TABLE_NAME if it is set, and are
+    only described again when the last updated time of the event changes.
+
+    Args:
+        events (dict): The last updated times of the events by event ARN, as returned by list_health_events.
+        region (str): The region of the events.
+
+    Returns:
+        dict: The event descriptions by event ARN.
+    """
     event_descriptions = {}
+
+    def get_uncached_event_arns():
+        for event_arn, last_updated in events.items():
+            cached = health_event_details_cache.get(event_arn)
+            if cached and cached['last_updated'] == last_updated:
+                event_descriptions[event_arn] = cached['description']
+        return [event_arn for event_arn in events if event_arn not in event_descriptions]
+
+    event_arns = get_uncached_event_arns()
+    if event_arns and os.environ.get('HEALTH_CACHE_TABLE_NAME'):
+        get_shared_event_details(region)
+        event_arns = get_uncached_event_arns()
+    logger.info("AWS Health event details cache", events=len(events), described=len(event_arns))
+
     batch_size = 10
     batches = [event_arns[i:i + batch_size] for i in range(0, len(event_arns), batch_size)]
 
@@ -21,12 +66,50 @@ def event_details(event_arns):
             event_arn = event_details['event']['arn']
             event_description = event_details['eventDescription']['latestDescription']
             event_descriptions[event_arn] = event_description
+            put_cached_event_details(region, event_arn, events[event_arn], event_description)
 
     return event_descriptions
 
 # AWS Health Events
 @tracer.capture_method
 def describe_events(region):
+    """
+    Returns the descriptions of the open and upcoming AWS Health events of the past 7 days in a region.
+
+    The events are the same for every alarm in the region, so they are cached for HEALTH_CACHE_TTL seconds,
+    in memory and in HEALTH_CACHE_TABLE_NAME if it is set, so that they are shared by every Lambda
+    execution environment during an alarm storm.
+
+    Args:
+        region (str): The region of the events.
+
+    Returns:
+        dict: The event descriptions by event ARN.
+    """
+    events = get_cached_health_events(region)
+    if events is None:
+        events = list_health_events(region)
+        put_cached_health_events(region, events)
+
+    if events:
+        event_descriptions = event_details(events, region)
+        return event_descriptions
+    else:
+        logger.info('There are no AWS Health events that match the given filters')
+        return {}
+
+@tracer.capture_method
+def list_health_events(region):
+    """
+    Lists the open and upcoming AWS Health events of the past 7 days in a region.
+
+    Args:
+        region (str): The region of the events.
+
+    Returns:
+        dict: The last updated times of the events by event ARN. Empty if the account does not have the
+        support plan needed to use the AWS Health API.
+    """
     events_paginator = HealthClient.client().get_paginator('describe_events')
 
     try:
@@ -42,11 +125,11 @@ def describe_events(region):
             'eventStatusCodes': ['open', 'upcoming']
         })
 
-        event_arns = []
+        events = {}
         for events_page in events_pages:
             for event in events_page['events']:
-                event_arns.append(event['arn'])
-
+                last_updated = event.get('lastUpdatedTime')
+                events[event['arn']] = last_updated.isoformat() if last_updated else None
 
     except botocore.exceptions.ClientError as error:
         error_code = error.response['Error']['Code']
@@ -58,10 +141,143 @@ def describe_events(region):
             raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
     except botocore.exceptions.ParamValidationError as error:
         raise ValueError('The parameters you provided are incorrect: {}'.format(error))
-    else:
-        if event_arns:
-            event_descriptions = event_details(event_arns)         
-            return event_descriptions
-        else:
-            logger.info('There are no AWS Health events that match the given filters')
-            return {}
\ No newline at end of file
+    return events
+
+@tracer.capture_method
+def get_cached_health_events(region):
+    """
+    Returns the cached events of a region, from memory or HEALTH_CACHE_TABLE_NAME, if they were described
+    less than HEALTH_CACHE_TTL seconds ago.
+
+    Args:
+        region (str): The region of the events.
+
+    Returns:
+        dict: The last updated times of the events by event ARN, or None if they are not cached.
+    """
+    ttl = int(os.environ.get('HEALTH_CACHE_TTL', 300))
+    now = time.time()
+
+    cached = health_events_cache.get(region)
+    if cached and now - cached['described'] < ttl:
+        logger.info("AWS Health events cache", region=region, hit="memory")
+        return cached['events']
+
+    table_name = os.environ.get('HEALTH_CACHE_TABLE_NAME')
+    if ttl > 0 and table_name:
+        try:
+            item = get_health_cache_table_client().get_item(
+                TableName=table_name,
+                Key={'pk': {'S': f'health#{region}'}, 'sk': {'S': '#events'}}
+            ).get('Item')
+        except botocore.exceptions.ClientError:
+            logger.exception("Error getting AWS Health events from the health cache table")
+            item = None
+        if item and now - float(item['described']['N']) < ttl:
+            events = json.loads(zlib.decompress(item['events']['B']))
+            health_events_cache[region] = {'events': events, 'described': float(item['described']['N'])}
+            logger.info("AWS Health events cache", region=region, hit="table")
+            return events
+
+    logger.info("AWS Health events cache", region=region, hit=None)
+    return None
+
+@tracer.capture_method
+def put_cached_health_events(region, events):
+    """
+    Caches the events of a region in memory and in HEALTH_CACHE_TABLE_NAME, if it is set.
+
+    Args:
+        region (str): The region of the events.
+        events (dict): The last updated times of the events by event ARN.
+    """
+    ttl = int(os.environ.get('HEALTH_CACHE_TTL', 300))
+    if ttl <= 0:
+        return
+    described = time.time()
+    health_events_cache[region] = {'events': events, 'described': described}
+
+    table_name = os.environ.get('HEALTH_CACHE_TABLE_NAME')
+    if table_name:
+        try:
+            get_health_cache_table_client().put_item(
+                TableName=table_name,
+                Item={
+                    'pk': {'S': f'health#{region}'},
+                    'sk': {'S': '#events'},
+                    'events': {'B': zlib.compress(json.dumps(events).encode())},
+                    'described': {'N': str(described)},
+                    'expires': {'N': str(int(described + ttl))}
+                }
+            )
+        except botocore.exceptions.ClientError:
+            logger.exception("Error putting AWS Health events in the health cache table")
+
+@tracer.capture_method
+def get_shared_event_details(region):
+    """
+    Loads the event descriptions of a region from HEALTH_CACHE_TABLE_NAME into the in-memory cache.
+
+    Args:
+        region (str): The region of the events.
+    """
+    try:
+        paginator = get_health_cache_table_client().get_paginator('query')
+        for page in paginator.paginate(
+            TableName=os.environ.get('HEALTH_CACHE_TABLE_NAME'),
+            KeyConditionExpression='pk = :pk AND begins_with(sk, :prefix)',
+            ExpressionAttributeValues={':pk': {'S': f'health#{region}'}, ':prefix': {'S': 'event#'}}
+        ):
+            for item in page['Items']:
+                cache_event_details(item['event_arn']['S'], item.get('last_updated', {}).get('S'), zlib.decompress(item['description']['B']).decode())
+    except botocore.exceptions.ClientError:
+        logger.exception("Error getting AWS Health event details from the health cache table")
+
+@tracer.capture_method
+def put_cached_event_details(region, event_arn, last_updated, description):
+    """
+    Caches the description of an event in memory and in HEALTH_CACHE_TABLE_NAME, if it is set.
+
+    Args:
+        region (str): The region of the event.
+        event_arn (str): The event ARN.
+        last_updated (str): The time the event was last updated.
+        description (str): The latest description of the event.
+    """
+    cache_event_details(event_arn, last_updated, description)
+
+    table_name = os.environ.get('HEALTH_CACHE_TABLE_NAME')
+    if table_name:
+        item = {
+            'pk': {'S': f'health#{region}'},
+            'sk': {'S': f'event#{event_arn}'},
+            'event_arn': {'S': event_arn},
+            'description': {'B': zlib.compress(description.encode())},
+            'expires': {'N': str(int(time.time() + HEALTH_EVENT_DETAILS_RETENTION_SECONDS))}
+        }
+        if last_updated:
+            item['last_updated'] = {'S': last_updated}
+        try:
+            get_health_cache_table_client().put_item(TableName=table_name, Item=item)
+        except botocore.exceptions.ClientError:
+            logger.exception("Error putting AWS Health event details in the health cache table")
+
+# Not traced, as it is called for every event description
+def cache_event_details(event_arn, last_updated, description):
+    """
+    Caches the description of an event in memory, evicting the least recently cached descriptions.
+    """
+    health_event_details_cache.pop(event_arn, None)
+    health_event_details_cache[event_arn] = {'last_updated': last_updated, 'description': description}
+    while len(health_event_details_cache) > MAX_CACHED_HEALTH_EVENT_DETAILS:
+        health_event_details_cache.popitem(last=False)
+
+# Not traced, as it is called for every health cache table request
+def get_health_cache_table_client():
+    """
+    Returns the DynamoDB client for HEALTH_CACHE_TABLE_NAME, created on first use.
+    """
+    global health_cache_table_client
+    if not health_cache_table_client:
+        health_cache_table_client = boto3.client('dynamodb')
+    return health_cache_table_client
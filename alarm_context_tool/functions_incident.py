@@ -0,0 +1,148 @@
+import os
+import time
+import html
+
+from functions import get_information_panel
+from functions_bedrock import execute_prompt
+from functions_bedrock import construct_incident_prompt
+from functions_bedrock import get_cached_response
+from incident_store import get_incident_store
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Tracer
+logger = Logger()
+tracer = Tracer()
+
+@tracer.capture_method
+def analyse_incident(message, prompt, prompt_sections, fingerprint=None, stream=False):
+    """
+    Analyses an alarm, together with the related alarms that fire within INCIDENT_WINDOW_SECONDS of it.
+
+    The first alarm for an account and region opens an incident and becomes its leader. Alarms that fire
+    while the incident is open join it and wait. When the window closes, the leader merges the prompts of
+    every alarm that joined, executes a single prompt and stores the analysis, which every alarm then
+    includes in its email. Alarms that were not included in the analysis, or that wait longer than the
+    window plus BEDROCK_TIMEOUT, are analysed on their own. If the analysis of the incident fails, every 
+    alarm in it reports the failure, instead of sending its own prompt to Bedrock.
+
+    If INCIDENT_WINDOW_SECONDS is 0, or an analysis of an earlier occurrence of the alarm can be reused,
+    the alarm is analysed on its own.
+
+    Args:
+        message (dict): The CloudWatch alarm message.
+        prompt (str): The prompt, as returned by build_prompt.
+        prompt_sections (list): The compacted prompt sections, as returned by construct_prompt_sections, which are 
+        fitted together with the sections of the other alarms in the incident.
+        fingerprint (dict, optional): The context fingerprint, as returned by get_context_fingerprint.
+        stream (bool, optional): Whether to stream the response.
+
+    Returns:
+        str: The analysis in an HTML information panel.
+    """
+    window_seconds = int(os.environ.get('INCIDENT_WINDOW_SECONDS', 0))
+    use_cache = fingerprint is not None and int(os.environ.get('BEDROCK_CACHE_TTL', 3600)) > 0
+    if not window_seconds or not os.environ.get('USE_BEDROCK') or (use_cache and get_cached_response(fingerprint)):
+        return execute_prompt(prompt, fingerprint, stream)
+
+    # Alarms in the same account and region are batched together
+    arn_elements = message['AlarmArn'].split(':')
+    incident_key = f"{arn_elements[4]}:{arn_elements[3]}"
+    member_id = f"{message['AlarmArn']}#{message['StateChangeTime']}"
+    store = get_incident_store()
+
+    # Only failures to share the incident are retried on their own, not failures to analyse it
+    try:
+        incident_id, window_end, is_leader = store.join(incident_key, member_id, {"alarm_name": message['AlarmName'], "prompt_sections": prompt_sections}, window_seconds)
+        logger.info("Joined incident", incident_id=incident_id, is_leader=is_leader, window_seconds=round(window_end - time.time(), 1))
+
+        if is_leader:
+            time.sleep(max(window_end - time.time(), 0))
+            members = store.get_members(incident_key, incident_id)
+        else:
+            analysis = wait_for_incident_analysis(store, incident_key, incident_id, window_end)
+    except RuntimeError:
+        logger.exception("Error batching alarm into an incident, analysing it on its own")
+        return execute_prompt(prompt, fingerprint, stream)
+
+    if is_leader:
+        analysis = analyse_incident_members(store, incident_key, incident_id, members, prompt, fingerprint, stream)
+
+    if not analysis or member_id not in analysis["member_ids"]:
+        logger.info("Alarm is not included in the incident analysis, analysing it on its own", incident_id=incident_id)
+        return execute_prompt(prompt, fingerprint, stream)
+
+    logger.info("Incident analysis", incident_id=incident_id, alarms=len(analysis["alarm_names"]), failed=analysis.get("failed", False))
+    if len(analysis["alarm_names"]) == 1:
+        return analysis["ai_response"]
+    alarm_names = ', '.join(html.escape(alarm_name) for alarm_name in analysis["alarm_names"])
+    note = get_information_panel("Incident", f"This analysis covers {len(analysis['alarm_names'])} related alarms that fired within {window_seconds} seconds of each other: {alarm_names}.")
+    return note + analysis["ai_response"]
+
+@tracer.capture_method
+def analyse_incident_members(store, incident_key, incident_id, members, prompt, fingerprint=None, stream=False):
+    """
+    Analyses the alarms of an incident, as its leader, and stores the analysis for the other alarms. 
+
+    A failed analysis is stored too, with the failed flag, so that the other alarms stop waiting for it 
+    and report the failure rather than each sending their own prompt to Bedrock.
+
+    Args:
+        store: The incident store, as returned by get_incident_store.
+        incident_key (str): The key of the alarms that are batched together.
+        incident_id (str): The incident ID.
+        members (list): The alarms that joined the incident, as returned by get_members.
+        prompt (str): The prompt of the leader, used if it is the only alarm in the incident.
+        fingerprint (dict, optional): The context fingerprint of the leader.
+        stream (bool, optional): Whether to stream the response.
+
+    Returns:
+        dict: The analysis, with ai_response, member_ids, alarm_names and failed.
+    """
+    failed = False
+    try:
+        if len(members) > 1:
+            incident_prompt = construct_incident_prompt([(member["alarm_name"], member["prompt_sections"]) for member in members])
+            ai_response = execute_prompt(incident_prompt, stream=stream)
+        else:
+            ai_response = execute_prompt(prompt, fingerprint, stream)
+    except (RuntimeError, ValueError):
+        logger.exception("Error analysing incident", incident_id=incident_id)
+        ai_response = get_information_panel("Analysis failed", "The Bedrock analysis of this incident could not be completed. See the logs of the Alarm Context Tool function for details.")
+        failed = True
+
+    analysis = {
+        "ai_response": ai_response,
+        "member_ids": [member["member_id"] for member in members],
+        "alarm_names": [member["alarm_name"] for member in members],
+        "failed": failed
+    }
+    try:
+        store.put_analysis(incident_key, incident_id, analysis)
+    except RuntimeError:
+        logger.exception("Error putting incident analysis, the other alarms will analyse themselves once they stop waiting", incident_id=incident_id)
+    return analysis
+
+@tracer.capture_method
+def wait_for_incident_analysis(store, incident_key, incident_id, window_end):
+    """
+    Waits for the leader of an incident to store its analysis, or a failed analysis, for up to BEDROCK_TIMEOUT 
+    seconds after the window closes.
+
+    Args:
+        store: The incident store, as returned by get_incident_store.
+        incident_key (str): The key of the alarms that are batched together.
+        incident_id (str): The incident ID.
+        window_end (float): The time at which the incident closes.
+
+    Returns:
+        dict: The analysis, or None if it was not stored in time.
+    """
+    poll_seconds = float(os.environ.get('INCIDENT_POLL_SECONDS', 2))
+    deadline = window_end + int(os.environ.get('BEDROCK_TIMEOUT', 300))
+
+    time.sleep(max(window_end - time.time(), 0))
+    while True:
+        analysis = store.get_analysis(incident_key, incident_id)
+        if analysis or time.time() >= deadline:
+            return analysis
+        time.sleep(min(poll_seconds, max(deadline - time.time(), 0)))
@@ -1,10 +1,16 @@
 import boto3
 import botocore
 
+import os
+import re
+import hashlib
 import datetime
 from datetime import timedelta
 import time
+import queue
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 from aws_lambda_powertools import Logger
@@ -12,6 +18,41 @@ from aws_lambda_powertools import Tracer
 logger = Logger()
 tracer = Tracer()
 
+# CloudWatch Logs Insights accepts up to 50 log groups in a single query
+MAX_LOG_GROUPS_PER_QUERY = 50
+
+# Number of log events to return for each log group and the number of log groups to fetch concurrently
+LOG_EVENTS_PER_GROUP = 10
+MAX_LOG_GROUP_WORKERS = 8
+
+# Rows fetched for each log group when several are queried together, so that a noisy log group leaves rows for
+# the others once the results are capped per log group, up to the maximum limit of a Logs Insights query
+LOG_INSIGHTS_ROWS_PER_GROUP = 100
+MAX_LOG_INSIGHTS_QUERY_LIMIT = 10000
+
+# Commands after which the fields of log events, such as @log, are no longer in the results
+LOG_INSIGHTS_FIELD_DROPPING_PATTERN = re.compile(r'\|\s*(?:stats|display)\b')
+
+# describe_log_groups accepts up to 50 log group names in logGroupIdentifiers
+MAX_LOG_GROUP_IDENTIFIERS = 50
+
+# Volatile tokens that are replaced before log messages are hashed for deduplication
+LOG_MESSAGE_VOLATILE_PATTERNS = [
+    (re.compile(r'\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?'), '<timestamp>'),
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'), '<id>'),
+    (re.compile(r'\b1-[0-9a-fA-F]{8}-[0-9a-fA-F]{24}\b'), '<trace-id>'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'), '<address>'),
+    (re.compile(r'\b[0-9a-fA-F]{16,}\b'), '<hex>'),
+]
+
+# Whether log groups exist, keyed by (region, log group name).
+# Kept at module level so that it persists across warm invocations.
+log_group_exists_cache = {}
+
+# Reverse index from (metricNamespace, metricName) to the metric filters that publish the metric, per region.
+# Kept at module level so that it persists across warm invocations.
+metric_filter_index = {}
+
 @tracer.capture_method
 def get_log_insights_link(log_input, log_insights_query, region, start_time, end_time):
     """
@@ -59,67 +100,155 @@ def get_log_insights_link(log_input, log_insights_query, region, start_time, end
     return log_insights_link
 
 @tracer.capture_method
-def get_log_insights_query_results(log_group, log_insights_query, region):
+def get_log_insights_query_results(log_group, log_insights_query, region, start_time=None, end_time=None, max_results_per_log_group=None):
     """
-    Retrieves the results of a CloudWatch Logs Insights query for a given log group.
+    Retrieves the results of a CloudWatch Logs Insights query for one or more log groups.
+
+    A single query is run across up to 50 log groups using logGroupNames. Larger sets of log groups are split 
+    into shards of 50 which are started together and polled until they have all completed. When more than one 
+    log group is queried, each result is attributed back to its log group using the @log field, unless the 
+    query aggregates or selects fields with stats or display without keeping @log, in which case the results 
+    are returned ungrouped.
 
     Args:
-        log_group (str): The name of the log group to query.
+        log_group (str or list): The name of the log group, or a list of log group names, to query.
         log_insights_query (str): The query to execute on the logs.
         region (str): The AWS region of the logs.
+        start_time (datetime, optional): The start time of the query. Defaults to 3 hours ago.
+        end_time (datetime, optional): The end time of the query. Defaults to now.
+        max_results_per_log_group (int, optional): The number of results to keep for each log group, when the results are grouped.
 
     Returns:
         log_insights_query_results_html
         log_insights_query_results_json
     """
+    if isinstance(log_group, str):
+        log_groups = [log_group]
+    else:
+        # Remove duplicates but keep the order
+        log_groups = list(dict.fromkeys(log_group))
 
-    logs = boto3.client('logs', region_name=region)
+    if start_time is None:
+        start_time = datetime.datetime.today() - timedelta(hours=3)
+    if end_time is None:
+        end_time = datetime.datetime.now()
 
-    try:
-        start_query_response = logs.start_query(
-            logGroupName=log_group,
-            startTime=int((datetime.datetime.today() - timedelta(hours=3)).timestamp()),
-            endTime=int(datetime.datetime.now().timestamp()),
-            queryString=log_insights_query,
-        )
-    except botocore.exceptions.ClientError as error:
-        logger.exception("Error starting query")
-        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
-    except botocore.exceptions.ParamValidationError as error:
-        raise ValueError('The parameters you provided are incorrect: {}'.format(error)) 
+    # @log is needed to attribute results to a log group when several are queried together, 
+    # but it is dropped by stats and display unless the query names it
+    group_by_log_group = len(log_groups) > 1 and ('@log' in log_insights_query or not LOG_INSIGHTS_FIELD_DROPPING_PATTERN.search(log_insights_query))
+    if group_by_log_group and '@log' not in log_insights_query:
+        log_insights_query = 'fields @log\n| ' + log_insights_query.strip()
 
-    query_id = start_query_response['queryId']
+    logs = boto3.client('logs', region_name=region)
 
-    response = None
+    # Start one query per shard of up to 50 log groups
+    query_ids = []
+    for i in range(0, len(log_groups), MAX_LOG_GROUPS_PER_QUERY):
+        shard = log_groups[i:i + MAX_LOG_GROUPS_PER_QUERY]
+        try:
+            start_query_response = logs.start_query(
+                logGroupNames=shard,
+                startTime=int(start_time.timestamp()),
+                endTime=int(end_time.timestamp()),
+                queryString=log_insights_query,
+            )
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error starting query")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error)) 
+        query_ids.append(start_query_response['queryId'])
+
+    logger.info("Log Insights queries started", log_groups=len(log_groups), queries=len(query_ids))
 
+    # Poll the shards together until they have all completed
+    log_insights_query_results_json = []
+    pending_query_ids = list(query_ids)
     try:
-        while response is None or response['status'] == 'Running': 
+        while pending_query_ids:
             time.sleep(1) # nosemgrep
-            response = logs.get_query_results(
-                queryId=query_id
-            )
-    except botocore.exceptions.WaiterError as error:
-        logger.warning("Error waiting for query to complete")
+            for query_id in list(pending_query_ids):
+                response = logs.get_query_results(
+                    queryId=query_id
+                )
+                if response['status'] not in ('Scheduled', 'Running'):
+                    log_insights_query_results_json.extend(response['results'])
+                    pending_query_ids.remove(query_id)
+    except botocore.exceptions.ClientError as error:
+        logger.exception("Error getting query results")
         raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error    
 
-    log_insights_query_results_json = response['results']
+    log_insights_query_results_json = deduplicate_log_events(log_insights_query_results_json)
+
+    if group_by_log_group:
+        results_by_log_group = group_log_insights_results_by_log_group(log_insights_query_results_json)
+        # Requested log groups first, then results that could not be attributed to one of them
+        ordered_log_group_names = [name for name in log_groups if name in results_by_log_group]
+        ordered_log_group_names += [name for name in results_by_log_group if name not in ordered_log_group_names]
+        log_insights_query_results_html = ''
+        log_insights_query_results_json = []
+        for log_group_name in ordered_log_group_names:
+            results = results_by_log_group[log_group_name][:max_results_per_log_group]
+            log_insights_query_results_html += get_log_insights_results_html(results, f"Log group: {log_group_name or 'Unknown'}")
+            log_insights_query_results_json.extend(results)
+    else:
+        log_insights_query_results_html = get_log_insights_results_html(log_insights_query_results_json)
+
+    return log_insights_query_results_html, log_insights_query_results_json
+
+@tracer.capture_method
+def group_log_insights_results_by_log_group(log_insights_query_results_json):
+    """
+    Groups CloudWatch Logs Insights results by the log group in their @log field.
+
+    Args:
+        log_insights_query_results_json (list): The results returned by get_query_results.
+
+    Returns:
+        dict: The results keyed by log group name, in the order the log groups were first seen. 
+        Results without an @log field are keyed by None.
+    """
+    results_by_log_group = {}
+    for result in log_insights_query_results_json:
+        log_group_name = None
+        for entry in result:
+            if entry['field'] == '@log':
+                # @log is in the format account-id:log-group-name
+                log_group_name = entry['value'].split(':', 1)[-1]
+                break
+        results_by_log_group.setdefault(log_group_name, []).append(result)
+    return results_by_log_group
+
+@tracer.capture_method
+def get_log_insights_results_html(log_insights_query_results_json, title=None):
+    """
+    Creates an HTML table from CloudWatch Logs Insights results.
 
+    Args:
+        log_insights_query_results_json (list): The results returned by get_query_results.
+        title (str, optional): A title to display above the results.
+
+    Returns:
+        str: An HTML table containing the results.
+    """
     # Step 1: Extract all unique field names
-    fields = set()
+    fields = []
     for result in log_insights_query_results_json:
         for entry in result:
-            fields.add(entry['field'])
+            if entry['field'] not in fields and entry['field'] != '@ptr':
+                fields.append(entry['field'])
 
     # Step 2: Construct rows
     rows = []
     for result in log_insights_query_results_json:
         row = {field: '' for field in fields}  # Initialize all fields with empty string
         for entry in result:
-            row[entry['field']] = entry['value']
+            if entry['field'] in row:
+                row[entry['field']] = entry['value']
         rows.append(row)
 
     # Step 3: Create DataFrame
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame(rows, columns=fields)
 
     # Step 4: Convert DataFrame to HTML table
     log_insights_query_results_html = df.to_html(index=False, escape=False)
@@ -127,87 +256,275 @@ def get_log_insights_query_results(log_group, log_insights_query, region):
     # Adjust the table
     new_table_tag = '<table id="info" width="640" style="max-width:640px !important; border-collapse: collapse; margin-bottom:10px;" cellpadding="2" cellspacing="0" width="100%" align="center" border="0">'
     log_insights_query_results_html = log_insights_query_results_html.replace('<table border="1" class="dataframe">', new_table_tag)    
+    if title:
+        log_insights_query_results_html = log_insights_query_results_html.replace('<thead>', f'<thead><tr><th colspan="{max(len(fields), 1)}">{title}</th></tr>', 1)
 
-    return log_insights_query_results_html, log_insights_query_results_json
+    return log_insights_query_results_html
 
 
 @tracer.capture_method
-def get_last_10_events(log_input, timestamp, region):
+def get_last_10_events(log_input, timestamp, region, filter_pattern=None):
     """
-    Retrieves the last 10 log events for a given log stream and creates an HTML table to display the results.
+    Retrieves the last 10 log events for a given log stream or log group and creates an HTML table to display the results.
+
+    When the log stream is found in several log groups, or a list of log groups is provided, the log groups are 
+    fetched concurrently by stream_log_events.
 
     Args:
-        log_input (dict): A dictionary containing information about the log stream to query. Must contain the key 'logStreamName'.
+        log_input (dict or list): A dictionary containing information about the log stream to query. Must contain the key 'logStreamName' or 'logGroupName'.
+            A list of dictionaries containing the key 'logGroupName' can be provided to query several log groups.
         timestamp (datetime): The timestamp to use as the end time for the log event query.
+        filter_pattern (str, optional): A CloudWatch Logs filter pattern to match events against, e.g. the pattern of a metric filter.
     
     Returns:
         html_table (str): A string containing an HTML table with the last 10 log events for the specified log stream.   
+        log_events (list): The log events.
     """
-    html_table = ''
-    logs = boto3.client('logs', region_name=region)
-    if 'logStreamName' in log_input:
+    log_stream_name = None
+    if isinstance(log_input, list):
+        log_groups = [log_dict['logGroupName'] for log_dict in log_input if 'logGroupName' in log_dict]
+    elif 'logStreamName' in log_input:
         log_stream_name = log_input['logStreamName']
         log_groups = search_log_groups(log_stream_name, region)
-        log_events = []
-        for log_group in log_groups:
-            try:
-                response = logs.filter_log_events(
-                    logGroupName=log_group, 
-                    logStreamNames=[log_stream_name], 
-                    limit=10, 
-                    endTime=int(timestamp.timestamp() * 1000)
-                )
-            except botocore.exceptions.ClientError as error:
-                logger.exception("Error filtering log events")
-                raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
-            except botocore.exceptions.ParamValidationError as error:
-                raise ValueError('The parameters you provided are incorrect: {}'.format(error))            
-
-            log_events.extend(response['events'])
-
-            if not log_events:
-                html_table = '<p>No log events found.</p>'
-            else:
-                html_table += '<table id="info" width="640" style="max-width:640px !important; border-collapse: collapse; margin-bottom:10px;" cellpadding="2" cellspacing="0" width="100%" align="center" border="0">'
-                html_table += f'<tr><th colspan="2">Log group: {log_group}<br>Log stream: {log_stream_name}</th></tr>'
-                html_table += '<tr><th>Timestamp</th><th>Message</th></tr>'
-                for event in log_events:
-                    timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + 'Z'                  
-                    message = event['message'].replace('\n', '<br>')
-                    html_table += f'<tr><td>{timestamp_str}</td><td style="word-break:break-all;">{message}</td></tr>'
-                html_table += '</table>'
-
     elif 'logGroupName' in log_input:
-        log_group_name = log_input['logGroupName']
+        log_groups = [log_input['logGroupName']]
+    else:
+        log_groups = []
+
+    # Fetching is decoupled from rendering, events are grouped as they are streamed
+    events_by_log_group = {log_group: [] for log_group in log_groups}
+    for log_group, event in stream_log_events(log_groups, timestamp, region, log_stream_name=log_stream_name, filter_pattern=filter_pattern):
+        events_by_log_group[log_group].append(event)
+
+    html_table = ''
+    log_events = []
+    for log_group, events in events_by_log_group.items():
+        events = deduplicate_log_events(events)
+        html_table += get_log_events_html(log_group, log_stream_name, events)
+        log_events.extend(events)
+
+    if log_stream_name and not log_events:
+        html_table = '<p>No log events found.</p>'
+
+    return html_table, log_events
+
+@tracer.capture_method
+def stream_log_events(log_groups, timestamp, region, max_events_per_group=LOG_EVENTS_PER_GROUP, log_stream_name=None, filter_pattern=None):
+    """
+    Streams log events from several log groups, fetching the log groups concurrently.
+
+    Each log group is paged lazily by iter_log_group_events until max_events_per_group events have been found. 
+    Events are passed through a bounded queue, so pages are not held in memory before they are consumed.
+
+    Args:
+        log_groups (list): The names of the log groups to query.
+        timestamp (datetime): The timestamp to use as the end time for the log event query.
+        region (str): The AWS region of the logs.
+        max_events_per_group (int, optional): The maximum number of events to return for each log group.
+        log_stream_name (str, optional): Only return events from this log stream.
+        filter_pattern (str, optional): A CloudWatch Logs filter pattern to match events against.
 
+    Yields:
+        tuple: The log group name and the log event, in the order they are received.
+    """
+    if not log_groups:
+        return
+
+    logs = boto3.client('logs', region_name=region)
+    end_time = int(timestamp.timestamp() * 1000)
+    events_queue = queue.Queue(maxsize=max(max_events_per_group, 1) * 2)
+    stop = threading.Event()
+    finished = object()
+
+    def fetch(log_group):
+        try:
+            for event in iter_log_group_events(logs, log_group, end_time, max_events_per_group, log_stream_name, filter_pattern):
+                if stop.is_set():
+                    return
+                events_queue.put((log_group, event))
+            events_queue.put((log_group, finished))
+        except Exception as error:
+            events_queue.put((log_group, error))
+
+    max_workers = min(len(log_groups), MAX_LOG_GROUP_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, log_group) for log_group in log_groups]
         try:
-            response = logs.filter_log_events(logGroupName=log_group_name, limit=10, endTime=int(timestamp.timestamp() * 1000))
+            remaining_log_groups = len(log_groups)
+            while remaining_log_groups:
+                log_group, item = events_queue.get()
+                if item is finished:
+                    remaining_log_groups -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield log_group, item
+        finally:
+            # Stop the workers if there was an error or the consumer stopped early, 
+            # draining the queue so that no worker is left blocked
+            stop.set()
+            while not all(future.done() for future in futures):
+                try:
+                    events_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+@tracer.capture_method
+def iter_log_group_events(logs, log_group_name, end_time, max_events, log_stream_name=None, filter_pattern=None):
+    """
+    Lazily pages through filter_log_events for a log group, following nextToken until max_events have been returned.
+
+    Args:
+        logs (boto3.client): A CloudWatch Logs client.
+        log_group_name (str): The name of the log group to query.
+        end_time (int): The end time of the query, in milliseconds since the epoch.
+        max_events (int): The maximum number of events to return.
+        log_stream_name (str, optional): Only return events from this log stream.
+        filter_pattern (str, optional): A CloudWatch Logs filter pattern to match events against.
+
+    Yields:
+        dict: Log events as returned by filter_log_events.
+    """
+    request = {'logGroupName': log_group_name, 'endTime': end_time}
+    if log_stream_name:
+        request['logStreamNames'] = [log_stream_name]
+    if filter_pattern:
+        request['filterPattern'] = filter_pattern
+
+    remaining = max_events
+    while remaining > 0:
+        try:
+            response = logs.filter_log_events(limit=remaining, **request)
         except botocore.exceptions.ClientError as error:
             logger.exception("Error filtering log events")
             raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
         except botocore.exceptions.ParamValidationError as error:
             raise ValueError('The parameters you provided are incorrect: {}'.format(error)) 
-        
-        log_events = response['events']
-        
-        if not log_events:
-            html_table += '<table id="info"width="640" style="max-width:640px !important; border-collapse: collapse; margin-bottom:10px;" cellpadding="2" cellspacing="0" width="100%" align="center" border="0">'
-            html_table += f'<tr><th colspan="2">Log group: {log_group_name}<br>Log stream: N/A</th></tr>'
-            html_table += '<tr><th>Timestamp</th><th>Message</th></tr>'
-            html_table += f'<tr><td colspan="2"><p>No log events found in the time period specified.</p></td></tr>'
-            html_table += '</table>'            
+
+        for event in response['events'][:remaining]:
+            yield event
+        remaining -= len(response['events'])
+
+        # A page can contain fewer events than the limit while there is more to search
+        if 'nextToken' not in response:
+            break
+        request['nextToken'] = response['nextToken']
+
+@tracer.capture_method
+def get_log_events_html(log_group_name, log_stream_name, log_events):
+    """
+    Creates an HTML table to display the log events of a log group.
+
+    Args:
+        log_group_name (str): The name of the log group.
+        log_stream_name (str): The name of the log stream, if the events were filtered by log stream.
+        log_events (list): The log events to display.
+
+    Returns:
+        html_table (str): A string containing an HTML table with the log events.
+    """
+    if log_stream_name is None and log_events:
+        log_stream_name = log_events[0]['logStreamName']
+
+    html_table = ['<table id="info" width="640" style="max-width:640px !important; border-collapse: collapse; margin-bottom:10px;" cellpadding="2" cellspacing="0" width="100%" align="center" border="0">']
+    html_table.append(f'<tr><th colspan="2">Log group: {log_group_name}<br>Log stream: {log_stream_name or "N/A"}</th></tr>')
+    html_table.append('<tr><th>Timestamp</th><th>Message</th></tr>')
+    if not log_events:
+        html_table.append('<tr><td colspan="2"><p>No log events found in the time period specified.</p></td></tr>')
+    for event in log_events:
+        timestamp_str = format_log_event_timestamp(event['timestamp'])
+        if event.get('count', 1) > 1:
+            timestamp_str = f"{format_log_event_timestamp(event['firstTimestamp'])} to<br>{format_log_event_timestamp(event['lastTimestamp'])}<br>({event['count']} events)"
+        message = event['message'].replace('\n', '<br>')
+        html_table.append(f'<tr><td>{timestamp_str}</td><td style="word-break:break-all;">{message}</td></tr>')
+    html_table.append('</table>')
+    return ''.join(html_table)
+
+@tracer.capture_method
+def format_log_event_timestamp(timestamp):
+    """
+    Formats a log event timestamp in milliseconds since the epoch as a UTC string.
+    """
+    event_time = datetime.datetime.fromtimestamp(timestamp / 1000, tz=datetime.timezone.utc)
+    return event_time.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + 'Z'
+
+@tracer.capture_method
+def normalize_log_message(message):
+    """
+    Replaces volatile tokens such as timestamps, request IDs, trace IDs and hex addresses in a log message,
+    so that repeated messages have the same normalized form. Other numbers, such as status codes, are kept.
+
+    Args:
+        message (str): The log message.
+
+    Returns:
+        str: The normalized log message.
+    """
+    for pattern, replacement in LOG_MESSAGE_VOLATILE_PATTERNS:
+        message = pattern.sub(replacement, message)
+    return message.strip()
+
+@tracer.capture_method
+def deduplicate_log_events(log_events):
+    """
+    Removes repeated log events, keeping one representative for each normalized message together with the number 
+    of occurrences and the time range they cover.
+
+    Supports log events returned by filter_log_events, and Logs Insights results with an @message field. Events that 
+    were repeated gain 'count', 'firstTimestamp' and 'lastTimestamp' keys or fields. Insights results from different 
+    log groups are never merged, and results without @message or with stats fields, such as count(*) or bin(5m), are 
+    kept as they are.
+
+    Args:
+        log_events (list): Log events from filter_log_events or results from get_query_results.
+
+    Returns:
+        list: The deduplicated log events, in the order each message was first seen.
+    """
+    if not log_events:
+        return log_events
+
+    deduplicated = {}
+    for index, event in enumerate(log_events):
+        if isinstance(event, dict):
+            message = event.get('message', '')
+            timestamp = event.get('timestamp')
+            log_group_name = ''
+        else:
+            fields = {entry['field']: entry['value'] for entry in event}
+            if '@message' not in fields or any('(' in field for field in fields):
+                deduplicated[index] = {'event': event, 'count': 1}
+                continue
+            message = fields['@message']
+            timestamp = fields.get('@timestamp')
+            log_group_name = fields.get('@log', '')
+
+        fingerprint = hashlib.sha1(f"{log_group_name}\n{normalize_log_message(message)}".encode('utf-8')).hexdigest()
+        if fingerprint not in deduplicated:
+            deduplicated[fingerprint] = {'event': event, 'count': 0, 'first': timestamp, 'last': timestamp}
+        entry = deduplicated[fingerprint]
+        entry['count'] += 1
+        if timestamp is not None:
+            if entry['first'] is None or timestamp < entry['first']:
+                entry['first'] = timestamp
+            if entry['last'] is None or timestamp > entry['last']:
+                entry['last'] = timestamp
+
+    deduplicated_events = []
+    for entry in deduplicated.values():
+        if entry['count'] == 1:
+            deduplicated_events.append(entry['event'])
+        elif isinstance(entry['event'], dict):
+            deduplicated_events.append({**entry['event'], 'count': entry['count'], 'firstTimestamp': entry['first'], 'lastTimestamp': entry['last']})
         else:
-            log_stream_name = log_events[0]['logStreamName']
-            html_table += '<table id="info"width="640" style="max-width:640px !important; border-collapse: collapse; margin-bottom:10px;" cellpadding="2" cellspacing="0" width="100%" align="center" border="0">'
-            html_table += f'<tr><th colspan="2">Log group: {log_group_name}<br>Log stream: {log_stream_name}</th></tr>'
-            html_table += '<tr><th>Timestamp</th><th>Message</th></tr>'
-            for event in log_events:
-                timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + 'Z'                  
-                message = event['message'].replace('\n', '<br>')
-                html_table += f'<tr><td>{timestamp_str}</td><td style="word-break:break-all;">{message}</td></tr>'
-            html_table += '</table>'
+            deduplicated_events.append(entry['event'] + [
+                {'field': 'count', 'value': str(entry['count'])},
+                {'field': 'firstTimestamp', 'value': entry['first'] or ''},
+                {'field': 'lastTimestamp', 'value': entry['last'] or ''}
+            ])
 
-    return html_table, log_events
+    logger.info("Log events deduplicated", log_events=len(log_events), deduplicated_log_events=len(deduplicated_events))
+    return deduplicated_events
 
 @tracer.capture_method
 def search_log_groups(log_stream_name, region):
@@ -261,22 +578,148 @@ def check_log_group_exists(log_group_name, region):
     Returns:
     - A boolean value indicating whether the log group exists (True) or not (False).
     """    
+    return check_log_groups_exist([log_group_name], region)[log_group_name]
+
+@tracer.capture_method
+def check_log_groups_exist(log_group_names, region):
+    """
+    Checks whether each of the specified log groups exists in AWS CloudWatch Logs.
+
+    Results are cached across warm invocations, including log groups that do not exist. Existing log groups are 
+    cached for LOG_GROUP_CACHE_TTL seconds and missing log groups for LOG_GROUP_NEGATIVE_CACHE_TTL seconds. 
+    Log groups that are not cached are looked up by exact name, up to MAX_LOG_GROUP_IDENTIFIERS per request.
+
+    Args:
+    - log_group_names: The names of the log groups to check.
+    - region: The AWS region of the log groups.
+
+    Returns:
+    - A dictionary of log group names and a boolean value indicating whether the log group exists (True) or not (False).
+    """
+    exists_ttl = int(os.environ.get('LOG_GROUP_CACHE_TTL', 3600))
+    missing_ttl = int(os.environ.get('LOG_GROUP_NEGATIVE_CACHE_TTL', 300))
+    now = time.time()
+
+    results = {}
+    uncached_log_group_names = []
+    for log_group_name in dict.fromkeys(log_group_names):
+        cached = log_group_exists_cache.get((region, log_group_name))
+        if cached and now - cached['checked'] < (exists_ttl if cached['exists'] else missing_ttl):
+            results[log_group_name] = cached['exists']
+        else:
+            uncached_log_group_names.append(log_group_name)
+
+    if uncached_log_group_names:
+        logs = boto3.client('logs', region_name=region)
+        paginator = logs.get_paginator('describe_log_groups')
+
+    for i in range(0, len(uncached_log_group_names), MAX_LOG_GROUP_IDENTIFIERS):
+        names = uncached_log_group_names[i:i + MAX_LOG_GROUP_IDENTIFIERS]
+        found = set()
+        try:
+            for page in paginator.paginate(logGroupIdentifiers=names):
+                found.update(log_group['logGroupName'] for log_group in page['logGroups'])
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error describing log groups")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))          
+
+        for log_group_name in names:
+            results[log_group_name] = log_group_name in found
+            log_group_exists_cache[(region, log_group_name)] = {'exists': results[log_group_name], 'checked': now}
+
+    return results
+
+@tracer.capture_method
+def build_metric_filter_index(region):
+    """
+    Builds a reverse index of all metric filters in a region, from (metricNamespace, metricName) to the 
+    log groups and filter patterns that publish the metric.
+
+    Args:
+    - region: The AWS region to index.
+
+    Returns:
+    - A dictionary containing the time the index was built and the filters keyed by (metricNamespace, metricName).
+    """
     logs = boto3.client('logs', region_name=region)
 
+    filters = {}
     try:
-        paginator = logs.get_paginator('describe_log_groups')
-        log_groups_list = []
-        for page in paginator.paginate(logGroupNamePrefix=log_group_name):
-            log_groups_list.extend(page['logGroups'])
-        response = {'logGroups': log_groups_list}        
+        paginator = logs.get_paginator('describe_metric_filters')
+        for page in paginator.paginate():
+            for metric_filter in page['metricFilters']:
+                add_metric_filter_to_index(filters, metric_filter)
     except botocore.exceptions.ClientError as error:
-        logger.exception("Error describing log groups")
+        logger.exception("Error describing metric filters")
         raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
     except botocore.exceptions.ParamValidationError as error:
-        raise ValueError('The parameters you provided are incorrect: {}'.format(error))          
+        raise ValueError('The parameters you provided are incorrect: {}'.format(error))
 
-    if not response['logGroups']:
-        return False
-    else:
-        return True    
-        
\ No newline at end of file
+    index = {'built': time.time(), 'filters': filters}
+    metric_filter_index[region] = index
+    logger.info("Metric filter index built", region=region, metrics=len(filters))
+    return index
+
+@tracer.capture_method
+def add_metric_filter_to_index(filters, metric_filter):
+    """
+    Adds each metric transformation of a metric filter to the reverse index.
+
+    Args:
+    - filters: The reverse index, keyed by (metricNamespace, metricName).
+    - metric_filter: A metric filter as returned by describe_metric_filters.
+    """
+    for metric_transformation in metric_filter.get('metricTransformations', []):
+        key = (metric_transformation['metricNamespace'], metric_transformation['metricName'])
+        entries = filters.setdefault(key, [])
+        entry = {
+            'filterName': metric_filter['filterName'],
+            'filterPattern': metric_filter.get('filterPattern', ''),
+            'logGroupName': metric_filter['logGroupName']
+        }
+        if entry not in entries:
+            entries.append(entry)
+
+@tracer.capture_method
+def find_metric_filters(namespace, metric_name, region):
+    """
+    Finds the metric filters that publish a metric, using the cached reverse index.
+
+    The index is rebuilt when it is older than METRIC_FILTER_INDEX_TTL seconds. Metrics that are not in the 
+    index are looked up individually, so filters created since the index was built are added incrementally. 
+    Metrics without a metric filter are cached as well, so repeat lookups do not call the API.
+
+    Args:
+    - namespace: The namespace of the metric.
+    - metric_name: The name of the metric.
+    - region: The AWS region of the metric.
+
+    Returns:
+    - A list of dictionaries containing the filterName, filterPattern and logGroupName of each matching metric filter.
+    """
+    if not namespace or not metric_name:
+        return []
+
+    ttl = int(os.environ.get('METRIC_FILTER_INDEX_TTL', 900))
+    index = metric_filter_index.get(region)
+    if index is None or time.time() - index['built'] > ttl:
+        index = build_metric_filter_index(region)
+
+    key = (namespace, metric_name)
+    if key not in index['filters']:
+        logs = boto3.client('logs', region_name=region)
+        index['filters'][key] = []
+        try:
+            paginator = logs.get_paginator('describe_metric_filters')
+            for page in paginator.paginate(metricNamespace=namespace, metricName=metric_name):
+                for metric_filter in page['metricFilters']:
+                    add_metric_filter_to_index(index['filters'], metric_filter)
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error describing metric filters")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+
+    return index['filters'][key]
@@ -1,65 +1,743 @@
 import boto3
 import botocore
 
+import os
+import re
 import json
+import time
 import datetime
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 
 from functions import json_serial
 from functions import get_dashboard_button
+from functions import get_html_table_with_fields
+from trace_cache import TraceCache
 
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools import Tracer
 logger = Logger()
 tracer = Tracer()
 
+# Number of trace summaries included in the prompt and the maximum number of trace IDs per batch_get_traces call
+MAX_TRACE_SUMMARIES = 3
+MAX_TRACE_IDS_PER_BATCH = 5
+MAX_TRACE_BATCH_WORKERS = 10
+
+# Number of traces summarized individually, all of the fetched traces are included in the trace profile
+MAX_SAMPLED_TRACES = 10
+
+# Maximum number of rows and depth of subsegments rendered for a trace
+MAX_TRACE_ROWS = 150
+MAX_TRACE_DEPTH = 6
+
+# Hours that the start of the alarm window is widened by, in turn, while no traces are found.
+# get_trace_summaries does not accept a time range of more than 24 hours.
+TRACE_SEARCH_WIDENING_HOURS = [0, 1, 6, 21]
+
+# The service graph is limited to a 6 hour time range, and the edges included in the report and prompt
+MAX_SERVICE_GRAPH_HOURS = 6
+MAX_SERVICE_GRAPH_EDGES = 25
+MAX_SERVICE_GRAPH_CACHE_ENTRIES = 16
+
+# Service graphs by region and window bucket, persisted across warm invocations
+service_graph_cache = {}
+
+# The segment document fields kept in the trace cache, as well as http.response.status, cause.exceptions and subsegments
+SEGMENT_DOCUMENT_FIELDS = ('id', 'name', 'origin', 'namespace', 'parent_id', 'start_time', 'end_time', 'fault', 'error', 'throttle')
+
+SEGMENT_STATUS_COLORS = {
+    "Fault": "#fe6e73",     # Reddish for fault
+    "Error": "#c59600",     # Yellowish for error
+    "Throttle": "#b088f5",  # Purplish for throttle
+    "OK": "#4CAF50"         # Green for OK
+}
+
 @tracer.capture_method
 def process_traces(filter_expression, region, trace_start_time, trace_end_time):
+    """
+    Retrieves X-Ray traces matching a filter expression and creates the trace report.
+
+    Trace summaries are found by search_trace_summaries and a sample of traces is fetched, faults and errors 
+    first and then the slowest traces, so that the failing paths are not missed. The sample is fetched 
+    concurrently by get_traces. Searching, fetching and retrieving the service graph must all end within 
+    XRAY_TIMEOUT seconds.
+
+    Args:
+        filter_expression (str): The X-Ray filter expression.
+        region (str): The AWS region of the traces.
+        trace_start_time (str): The start time, in ISO format with timezone information.
+        trace_end_time (str): The end time, in ISO format with timezone information.
+
+    Returns:
+        trace_summary (dict): The trace summaries and a summary of the sampled traces, for the prompt.
+        minimized_trace_html_content (str): The HTML trace report.
+    """
+    timeout = int(os.environ.get('XRAY_TIMEOUT', 30))
+    sample_size = int(os.environ.get('XRAY_TRACE_SAMPLE_SIZE', 50))
+
     # Initialize the boto3 client for AWS X-Ray
     xray = boto3.client('xray', region_name=region)   
 
-    # Sometimes alarms are triggered by issues where there is no error or fault in the trace
-    # Subtract another 21 hours
-    start_datetime = datetime.datetime.strptime(trace_start_time, '%Y-%m-%dT%H:%M:%S.%f%z')
-    adjusted_datetime = start_datetime - datetime.timedelta(hours=21)
-    trace_start_time = adjusted_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + adjusted_datetime.strftime('%z')          
-
-    try:
-        # Retrieve the trace summaries
-        response = xray.get_trace_summaries(
-            StartTime=trace_start_time,
-            EndTime=trace_end_time,
-            TimeRangeType='Event',
-            Sampling=False,
-            FilterExpression=filter_expression
-        )       
-    except botocore.exceptions.ClientError as error:
-        logger.exception("Error getting trace summaries")
-        raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
-    except botocore.exceptions.ParamValidationError as error:
-        raise ValueError('The parameters you provided are incorrect: {}'.format(error))
-
-    MAX_TRACE_SUMMARIES = 3
-    limited_trace_summaries = response.get('TraceSummaries', [])[:MAX_TRACE_SUMMARIES]
+    # Searching, fetching and the service graph share a single deadline
+    deadline = time.monotonic() + timeout
+
+    # Fetch the service graph of the alarm window while the trace summaries are searched for
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        service_graph_future = executor.submit(get_service_graph, xray, trace_start_time, trace_end_time, deadline)
+
+        # Start at the alarm window and widen it only if no traces are found
+        trace_summaries, trace_start_time = search_trace_summaries(xray, filter_expression, trace_start_time, trace_end_time, sample_size, deadline)
+
+        # The traces are still reported without the service graph
+        try:
+            service_graph = service_graph_future.result()
+        except Exception:
+            logger.exception("Error retrieving the service graph, continuing without it")
+            service_graph = {"nodes": {}, "edges": []}
+
+    # Faults and errors first, then the slowest traces
+    sampled_trace_summaries = select_trace_summaries(trace_summaries, sample_size)
+    limited_trace_summaries = sampled_trace_summaries[:MAX_TRACE_SUMMARIES]
 
     trace_summary = {
         "TraceSummaries": limited_trace_summaries,
-        # Include other keys from the original response if necessary
-        # "UnprocessedTraceIds": response.get("UnprocessedTraceIds", []),
-        # "NextToken": response.get("NextToken", None),
-        # "ApproximateTime": response.get("ApproximateTime", None),
-        # "TracesProcessedCount": len(limited_trace_summaries),
     }
 
+    # The neighbourhood of the alarmed service in the service graph
+    service_graph_edges = prune_service_graph(service_graph, get_alarm_services(filter_expression, sampled_trace_summaries))
+    service_graph_html = ""
+    if service_graph_edges:
+        trace_summary["ServiceGraph"] = service_graph_edges
+        service_graph_html = get_html_table_with_fields("Service graph", service_graph_edges)
+
     logger.info("Trace Summary", extra=trace_summary)        
     
+    if not trace_summaries:
+        logger.info("No trace ID found in the summary.")
+        return trace_summary, service_graph_html
 
     # Create a table containing the resources in the trace
+    html_combined = get_trace_resources_html(trace_summaries) + service_graph_html
+
+    # Fetch the sampled traces concurrently
+    traces = get_traces(xray, [summary['Id'] for summary in sampled_trace_summaries], deadline)
+    logger.info("Traces", trace_ids=[trace['Id'] for trace in traces])
+
+    if traces:
+        # Profile every node across all of the traces, and summarize the highest priority traces
+        trace_summary["TraceProfile"] = build_trace_profile(traces)
+        trace_summary["SampledTraces"] = summarize_traces(traces[:MAX_SAMPLED_TRACES])
+
+        # Render the highest priority trace in full and list the rest of the sample
+        html = generate_trace_html({'Traces': traces[:1]}, region, trace_start_time, trace_end_time)  
+        html += get_sampled_traces_html(trace_summary["SampledTraces"], region, trace_start_time, trace_end_time)
+        html += get_html_table_with_fields(f"Service profile of {len(traces)} traces", trace_summary["TraceProfile"])
+        
+        # Minimize the HTML content by removing newlines and redundant whitespace
+        minimized_trace_html_content = html_combined
+        minimized_trace_html_content += ' '.join(html.split())
+        
+        # Log the minimized HTML content to the logs in one line
+        logger.info("Trace HTML", html=minimized_trace_html_content)                
+    else:
+        logger.info("No traces were retrieved.")
+        minimized_trace_html_content = html_combined
+    
+    return trace_summary, minimized_trace_html_content
+
+@tracer.capture_method
+def search_trace_summaries(xray, filter_expression, trace_start_time, trace_end_time, max_traces, deadline):
+    """
+    Progressively searches for trace summaries, starting with the alarm window.
+
+    Sometimes alarms are triggered by issues where there is no error or fault in the trace, or the traces 
+    happened before the alarm window, so the window is widened in steps (TRACE_SEARCH_WIDENING_HOURS) only 
+    while nothing has been found. Each step only searches the time that has not been searched yet. 
+    Within a step, the filter expressions from get_prioritized_filter_expressions are tried in turn and 
+    NextToken is followed until max_traces traces have been found or the deadline has passed.
+
+    Args:
+        xray (boto3.client): An X-Ray client.
+        filter_expression (str): The X-Ray filter expression.
+        trace_start_time (str): The start time of the alarm window, in ISO format with timezone information.
+        trace_end_time (str): The end time of the alarm window, in ISO format with timezone information.
+        max_traces (int): The number of trace summaries to stop searching at.
+        deadline (float): The time.monotonic() value by which the search must end.
+
+    Returns:
+        trace_summaries (list): The trace summaries found.
+        trace_start_time (str): The start time of the time range that was searched, in ISO format with timezone information.
+    """
+    start_datetime = datetime.datetime.strptime(trace_start_time, '%Y-%m-%dT%H:%M:%S.%f%z')
+    end_datetime = datetime.datetime.strptime(trace_end_time, '%Y-%m-%dT%H:%M:%S.%f%z')
+
+    trace_summaries = {}
+    searched_start = start_datetime
+    window_end = end_datetime
+    for widening_hours in TRACE_SEARCH_WIDENING_HOURS:
+        window_start = start_datetime - datetime.timedelta(hours=widening_hours)
+        if window_start >= window_end:
+            continue
+
+        for expression in get_prioritized_filter_expressions(filter_expression):
+            request = {
+                'StartTime': window_start,
+                'EndTime': window_end,
+                'TimeRangeType': 'Event',
+                'Sampling': False,
+                'FilterExpression': expression
+            }
+            while len(trace_summaries) < max_traces and time.monotonic() < deadline:
+                try:
+                    # Retrieve the trace summaries
+                    response = xray.get_trace_summaries(**request)
+                except botocore.exceptions.ClientError as error:
+                    logger.exception("Error getting trace summaries")
+                    raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+                except botocore.exceptions.ParamValidationError as error:
+                    raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+
+                for summary in response.get('TraceSummaries', []):
+                    trace_summaries.setdefault(summary['Id'], summary)
+
+                if not response.get('NextToken'):
+                    break
+                request['NextToken'] = response['NextToken']
+
+        searched_start = window_start
+        window_end = window_start
+        if trace_summaries or time.monotonic() >= deadline:
+            break
+
+    if time.monotonic() >= deadline:
+        logger.warning("Timed out searching for trace summaries", trace_summaries=len(trace_summaries))
+    logger.info("Trace search", trace_summaries=len(trace_summaries), searched_hours=round((end_datetime - searched_start).total_seconds() / 3600, 1))
+
+    trace_start_time = searched_start.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + searched_start.strftime('%z')
+    return list(trace_summaries.values()), trace_start_time
+
+@tracer.capture_method
+def get_prioritized_filter_expressions(filter_expression):
+    """
+    Returns the filter expressions to search with, in order of preference. 
+    
+    Traces with a fault or error are searched for first, then slow traces (responsetime of more than 
+    XRAY_SLOW_RESPONSE_TIME seconds) and then any trace matching the filter expression.
+
+    Args:
+        filter_expression (str): The X-Ray filter expression.
+
+    Returns:
+        list: The filter expressions.
+    """
+    slow_response_time = os.environ.get('XRAY_SLOW_RESPONSE_TIME', '1')
+    expressions = []
+    if not re.search(r'!OK|\bfault\b|\berror\b', filter_expression):
+        expressions.append(f'({filter_expression}) AND (fault OR error)')
+    if not re.search(r'\bresponsetime\b', filter_expression):
+        expressions.append(f'({filter_expression}) AND responsetime > {slow_response_time}')
+    expressions.append(filter_expression)
+    return expressions
+
+@tracer.capture_method
+def select_trace_summaries(trace_summaries, sample_size):
+    """
+    Selects the trace summaries to fetch, faults first, then errors, then throttles, then the slowest traces.
+
+    Args:
+        trace_summaries (list): The trace summaries returned by get_trace_summaries.
+        sample_size (int): The number of trace summaries to select.
+
+    Returns:
+        list: The selected trace summaries, in priority order.
+    """
+    def priority(summary):
+        return (
+            not summary.get('HasFault', False),
+            not summary.get('HasError', False),
+            not summary.get('HasThrottle', False),
+            -(summary.get('ResponseTime') or summary.get('Duration') or 0)
+        )
+    return sorted(trace_summaries, key=priority)[:sample_size]
+
+@tracer.capture_method
+def get_traces(xray, trace_ids, deadline):
+    """
+    Retrieves traces from the trace cache, or with batch_get_traces, in chunks of up to 5 trace IDs that 
+    are fetched concurrently. Fetched traces are added to the trace cache.
+
+    Chunks that have not started by the deadline are skipped, and chunks in progress stop paging, so that 
+    no requests are left running.
+
+    Args:
+        xray (boto3.client): An X-Ray client.
+        trace_ids (list): The IDs of the traces to retrieve, in priority order.
+        deadline (float): The time.monotonic() value by which the traces must be retrieved.
+
+    Returns:
+        list: The traces, in the order of trace_ids.
+    """
+    def batch_get_traces(chunk):
+        traces = []
+        request = {'TraceIds': chunk}
+        while True:
+            try:
+                response = xray.batch_get_traces(**request)
+            except botocore.exceptions.ClientError as error:
+                logger.exception("Error retrieving trace")
+                raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+            except botocore.exceptions.ParamValidationError as error:
+                raise ValueError('The parameters you provided are incorrect: {}'.format(error))            
+            traces.extend(response.get('Traces', []))
+            if not response.get('NextToken') or time.monotonic() >= deadline:
+                return traces
+            request['NextToken'] = response['NextToken']
+
+    # The same traces are often the latest for several alarms in a row
+    traces_by_id, missing_trace_ids = TraceCache.get_traces(trace_ids)
+
+    chunks = [missing_trace_ids[i:i + MAX_TRACE_IDS_PER_BATCH] for i in range(0, len(missing_trace_ids), MAX_TRACE_IDS_PER_BATCH)]
+    if chunks:
+        executor = ThreadPoolExecutor(max_workers=min(len(chunks), MAX_TRACE_BATCH_WORKERS))
+        futures = [executor.submit(batch_get_traces, chunk) for chunk in chunks]
+        wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        # Requests in progress are waited for, they stop paging at the deadline
+        executor.shutdown(wait=True, cancel_futures=True)
+        skipped_chunks = len([future for future in futures if future.cancelled()])
+        if skipped_chunks:
+            logger.warning("Timed out retrieving traces", chunks=len(chunks), skipped_chunks=skipped_chunks)
+
+        for future in futures:
+            if not future.cancelled():
+                traces = future.result()
+                TraceCache.put_traces(traces)
+                for trace in traces:
+                    traces_by_id[trace['Id']] = trace
+
+    return [traces_by_id[trace_id] for trace_id in trace_ids if trace_id in traces_by_id]
+
+@tracer.capture_method
+def flatten_trace_segments(traces):
+    """
+    Flattens the segments and subsegments of traces into arrays, one element per node.
+
+    Self time is the duration of a node less the duration of its direct subsegments, so it is an 
+    approximation when subsegments run concurrently.
+
+    Args:
+        traces (list): Traces returned by batch_get_traces.
+
+    Returns:
+        dict: NumPy arrays of node names, types, durations, self times and fault, error and throttle flags.
+    """
+    names, types, durations, self_times, faults, errors, throttles = [], [], [], [], [], [], []
+    for trace in traces:
+        for segment in trace.get('Segments', []):
+            segment_doc = get_segment_document(segment)
+            nodes = [(segment_doc, segment_doc.get('origin', 'Segment'))]
+            while nodes:
+                node, node_type = nodes.pop()
+                subsegments = node.get('subsegments', [])
+                nodes.extend((subsegment, subsegment.get('namespace', 'local')) for subsegment in subsegments)
+
+                duration = max(node.get('end_time', 0) - node.get('start_time', 0), 0)
+                downstream = sum(max(subsegment.get('end_time', 0) - subsegment.get('start_time', 0), 0) for subsegment in subsegments)
+                names.append(node.get('name', 'Unknown'))
+                types.append(node_type)
+                durations.append(duration)
+                self_times.append(max(duration - downstream, 0))
+                faults.append(bool(node.get('fault')))
+                errors.append(bool(node.get('error')))
+                throttles.append(bool(node.get('throttle')))
+
+    return {
+        'names': np.array(names, dtype=object),
+        'types': np.array(types, dtype=object),
+        'durations': np.array(durations, dtype=float),
+        'self_times': np.array(self_times, dtype=float),
+        'faults': np.array(faults, dtype=bool),
+        'errors': np.array(errors, dtype=bool),
+        'throttles': np.array(throttles, dtype=bool)
+    }
+
+@tracer.capture_method
+def build_trace_profile(traces):
+    """
+    Aggregates traces into a latency and error profile for each node (service, resource or subsegment).
+
+    Args:
+        traces (list): Traces returned by batch_get_traces.
+
+    Returns:
+        list: A dictionary per node containing the number of calls, fault, error and throttle rates, 
+        latency percentiles and mean self and downstream time in milliseconds. Sorted by fault and 
+        error rate, then p99 latency.
+    """
+    segments = flatten_trace_segments(traces)
+    if not len(segments['names']):
+        return []
+
+    # Group nodes by name and type
+    keys = np.array([f"{name}\n{node_type}" for name, node_type in zip(segments['names'], segments['types'])], dtype=object)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    calls = np.bincount(inverse)
+    fault_rates = np.bincount(inverse, weights=segments['faults']) / calls
+    error_rates = np.bincount(inverse, weights=segments['errors']) / calls
+    throttle_rates = np.bincount(inverse, weights=segments['throttles']) / calls
+    mean_self_times = np.bincount(inverse, weights=segments['self_times']) / calls
+    mean_durations = np.bincount(inverse, weights=segments['durations']) / calls
+
+    # Sort durations within each group so that the groups are contiguous slices
+    order = np.lexsort((segments['durations'], inverse))
+    sorted_durations = segments['durations'][order]
+    boundaries = np.concatenate(([0], np.cumsum(calls)))
+
+    profile = []
+    for i, key in enumerate(unique_keys):
+        name, node_type = key.split('\n', 1)
+        p50, p90, p99 = np.percentile(sorted_durations[boundaries[i]:boundaries[i + 1]], [50, 90, 99]) * 1000
+        profile.append({
+            "Node": name,
+            "Type": node_type,
+            "Calls": int(calls[i]),
+            "FaultRate": round(float(fault_rates[i]), 3),
+            "ErrorRate": round(float(error_rates[i]), 3),
+            "ThrottleRate": round(float(throttle_rates[i]), 3),
+            "P50ms": round(float(p50)),
+            "P90ms": round(float(p90)),
+            "P99ms": round(float(p99)),
+            "SelfMs": round(float(mean_self_times[i] * 1000)),
+            "DownstreamMs": round(float((mean_durations[i] - mean_self_times[i]) * 1000))
+        })
+
+    profile.sort(key=lambda node: (-(node["FaultRate"] + node["ErrorRate"]), -node["P99ms"]))
+    return profile
+
+@tracer.capture_method
+def summarize_traces(traces):
+    """
+    Summarizes traces for the prompt, listing the nodes in each trace that have a fault, error or throttle.
+
+    Args:
+        traces (list): Traces returned by batch_get_traces.
+
+    Returns:
+        list: A dictionary for each trace containing its Id, Duration, Status and the nodes with issues.
+    """
+    sampled_traces = []
+    for trace in traces:
+        issues = []
+        status = "OK"
+        response_code = None
+        for segment in trace.get('Segments', []):
+            segment_doc = get_segment_document(segment)
+            if response_code is None and 'parent_id' not in segment_doc:
+                response_code = segment_doc.get('http', {}).get('response', {}).get('status')
+
+            # Walk the segment and its subsegments
+            nodes = [segment_doc]
+            while nodes:
+                node = nodes.pop()
+                nodes.extend(node.get('subsegments', []))
+                node_status = get_segment_status(node)
+                if node_status == "OK":
+                    continue
+                if status == "OK" or (node_status == "Fault" and status != "Fault"):
+                    status = node_status
+                issue = {"Name": node.get('name', 'Unknown'), "Status": node_status}
+                exceptions = node.get('cause', {}).get('exceptions', []) if isinstance(node.get('cause'), dict) else []
+                if exceptions:
+                    issue["Exceptions"] = list(dict.fromkeys(
+                        f"{exception.get('type', '')}: {exception.get('message', '')}".strip(': ') for exception in exceptions
+                    ))
+                issues.append(issue)
+
+        sampled_traces.append({
+            "Id": trace['Id'],
+            "Duration": trace.get('Duration'),
+            "Status": status,
+            "ResponseCode": response_code,
+            "Issues": issues
+        })
+    return sampled_traces
+
+@tracer.capture_method
+def get_service_graph(xray, trace_start_time, trace_end_time, deadline):
+    """
+    Retrieves the X-Ray service graph for a time range, as a compact list of nodes and edges.
+
+    The time range is widened to whole XRAY_SERVICE_GRAPH_BUCKET second buckets so that alarms in the same 
+    window share a cached graph. A cached graph is reused for XRAY_SERVICE_GRAPH_BUCKET seconds, or for as 
+    long as it is cached if the window had already ended when it was retrieved.
+
+    Args:
+        xray (boto3.client): An X-Ray client.
+        trace_start_time (str): The start time, in ISO format with timezone information.
+        trace_end_time (str): The end time, in ISO format with timezone information.
+        deadline (float): The time.monotonic() value by which retrieving the graph must end.
+
+    Returns:
+        dict: The nodes, by reference ID, and the edges with their request, error and latency statistics.
+    """
+    bucket = int(os.environ.get('XRAY_SERVICE_GRAPH_BUCKET', 300))
+    end_timestamp = datetime.datetime.strptime(trace_end_time, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    start_timestamp = datetime.datetime.strptime(trace_start_time, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    start_timestamp = max(start_timestamp, end_timestamp - MAX_SERVICE_GRAPH_HOURS * 3600)
+
+    # Align the window to the buckets, limited to the maximum time range of the service graph
+    window_end = int(-(-end_timestamp // bucket) * bucket)
+    window_start = max(int(start_timestamp // bucket * bucket), window_end - MAX_SERVICE_GRAPH_HOURS * 3600)
+
+    cache_key = (xray.meta.region_name, window_start, window_end)
+    cached = service_graph_cache.pop(cache_key, None)
+    if cached and (cached['retrieved'] >= window_end + bucket or time.time() - cached['retrieved'] < bucket):
+        service_graph_cache[cache_key] = cached
+        return cached['graph']
+
+    graph = {"nodes": {}, "edges": []}
+    request = {
+        'StartTime': datetime.datetime.fromtimestamp(window_start, tz=datetime.timezone.utc),
+        'EndTime': datetime.datetime.fromtimestamp(window_end, tz=datetime.timezone.utc)
+    }
+    complete = False
+    while time.monotonic() < deadline:
+        try:
+            response = xray.get_service_graph(**request)
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error getting service graph")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+
+        for service in response.get('Services', []):
+            graph["nodes"][service['ReferenceId']] = {
+                "Name": service.get('Name') or service.get('Type', 'Unknown'),
+                "Names": service.get('Names', []),
+                "Type": service.get('Type', 'Unknown')
+            }
+            for edge in service.get('Edges', []):
+                graph["edges"].append(dict(
+                    get_service_graph_edge_statistics(edge),
+                    source=service['ReferenceId'],
+                    target=edge['ReferenceId']
+                ))
+
+        if not response.get('NextToken'):
+            complete = True
+            break
+        request['NextToken'] = response['NextToken']
+
+    logger.info("Service graph", nodes=len(graph["nodes"]), edges=len(graph["edges"]), complete=complete)
+
+    # Only complete graphs are cached, evicting the least recently used graph
+    if complete:
+        service_graph_cache[cache_key] = {"retrieved": time.time(), "graph": graph}
+        if len(service_graph_cache) > MAX_SERVICE_GRAPH_CACHE_ENTRIES:
+            del service_graph_cache[next(iter(service_graph_cache))]
+    return graph
+
+# Not traced, as it is called for every edge of the service graph
+def get_service_graph_edge_statistics(edge):
+    """
+    Returns the number of requests, fault, error and throttle rates and the mean and approximate p99 
+    response time in milliseconds of a service graph edge.
+    """
+    statistics = edge.get('SummaryStatistics', {})
+    requests = statistics.get('TotalCount', 0)
+    error_statistics = statistics.get('ErrorStatistics', {})
+    fault_statistics = statistics.get('FaultStatistics', {})
+
+    p99 = 0
+    histogram = edge.get('ResponseTimeHistogram', [])
+    if histogram:
+        values = np.array([entry['Value'] for entry in histogram], dtype=float)
+        counts = np.array([entry['Count'] for entry in histogram], dtype=float)
+        order = np.argsort(values)
+        cumulative = np.cumsum(counts[order])
+        p99 = values[order][min(np.searchsorted(cumulative, cumulative[-1] * 0.99), len(values) - 1)]
+
+    return {
+        "Requests": requests,
+        "FaultRate": round(fault_statistics.get('TotalCount', 0) / requests, 3) if requests else 0,
+        "ErrorRate": round(error_statistics.get('OtherCount', 0) / requests, 3) if requests else 0,
+        "ThrottleRate": round(error_statistics.get('ThrottleCount', 0) / requests, 3) if requests else 0,
+        "AvgMs": round(statistics.get('TotalResponseTime', 0) / requests * 1000) if requests else 0,
+        "P99ms": round(float(p99) * 1000)
+    }
+
+@tracer.capture_method
+def get_alarm_services(filter_expression, trace_summaries):
+    """
+    Returns the services that an alarm is about, to find them in the service graph.
+
+    The services are taken from the service(id(...)) and name CONTAINS clauses of the filter expression. 
+    If the filter expression does not name a service, the root cause services of the trace summaries are used.
+
+    Args:
+        filter_expression (str): The X-Ray filter expression.
+        trace_summaries (list): The trace summaries returned by get_trace_summaries.
+
+    Returns:
+        list: A dictionary per service with a Name or NameContains and optionally a Type.
+    """
+    services = []
+    for clause in re.findall(r'id\(([^)]*)\)', filter_expression):
+        name = re.search(r'name:\s*"([^"]*)"', clause)
+        service_type = re.search(r'type:\s*"([^"]*)"', clause)
+        if name or service_type:
+            services.append({"Name": name.group(1) if name else None, "Type": service_type.group(1) if service_type else None})
+    for name in re.findall(r'name\s+CONTAINS\s+"([^"]*)"', filter_expression):
+        services.append({"NameContains": name, "Type": None})
+
+    # Filter expressions with only a type, like EC2 instances, are narrowed down by the traces
+    if not any(service.get("Name") or service.get("NameContains") for service in services):
+        for summary in trace_summaries:
+            for root_cause in summary.get('FaultRootCauses', []) + summary.get('ErrorRootCauses', []):
+                if root_cause.get('Services'):
+                    service = root_cause['Services'][-1]
+                    services.append({"Name": service.get('Name'), "Type": service.get('Type')})
+
+    # A type on its own would match every service of that type
+    named_services = [service for service in services if service.get("Name") or service.get("NameContains")]
+    return named_services or services
+
+@tracer.capture_method
+def prune_service_graph(graph, alarm_services):
+    """
+    Prunes the service graph to the services within XRAY_SERVICE_GRAPH_HOPS hops upstream and downstream 
+    of the alarmed services.
+
+    Args:
+        graph (dict): The service graph, as returned by get_service_graph.
+        alarm_services (list): The alarmed services, as returned by get_alarm_services.
+
+    Returns:
+        list: The edges in the neighbourhood, with fault and error edges first and then the slowest, 
+        up to MAX_SERVICE_GRAPH_EDGES.
+    """
+    hops = int(os.environ.get('XRAY_SERVICE_GRAPH_HOPS', 2))
+
+    def is_alarm_service(node):
+        for service in alarm_services:
+            if service.get("Type") and node["Type"] != service["Type"]:
+                continue
+            if service.get("Name") and service["Name"] != node["Name"] and service["Name"] not in node["Names"]:
+                continue
+            if service.get("NameContains") and not any(service["NameContains"] in name for name in [node["Name"]] + node["Names"]):
+                continue
+            return True
+        return False
+
+    seeds = [reference_id for reference_id, node in graph["nodes"].items() if is_alarm_service(node)]
+    if not seeds:
+        return []
+
+    downstream = {}
+    upstream = {}
+    for edge in graph["edges"]:
+        downstream.setdefault(edge["source"], []).append(edge["target"])
+        upstream.setdefault(edge["target"], []).append(edge["source"])
+
+    # Breadth first search in each direction, recording the number of hops to each service
+    def get_distances(adjacency):
+        distances = dict.fromkeys(seeds, 0)
+        frontier = seeds
+        for hop in range(1, hops + 1):
+            frontier = [neighbour for reference_id in frontier for neighbour in adjacency.get(reference_id, []) if neighbour not in distances]
+            distances.update(dict.fromkeys(frontier, hop))
+        return distances
+
+    downstream_distances = get_distances(downstream)
+    upstream_distances = get_distances(upstream)
+
+    edges = []
+    for edge in graph["edges"]:
+        if edge["source"] in downstream_distances and edge["target"] in downstream_distances and downstream_distances[edge["source"]] < hops:
+            direction, hop = "Downstream", downstream_distances[edge["source"]] + 1
+        elif edge["source"] in upstream_distances and edge["target"] in upstream_distances and upstream_distances[edge["target"]] < hops:
+            direction, hop = "Upstream", upstream_distances[edge["target"]] + 1
+        else:
+            continue
+        source = graph["nodes"].get(edge["source"], {"Name": "Unknown", "Type": "Unknown"})
+        target = graph["nodes"].get(edge["target"], {"Name": "Unknown", "Type": "Unknown"})
+        compact_edge = {
+            "Source": f'{source["Name"]} ({source["Type"]})',
+            "Target": f'{target["Name"]} ({target["Type"]})',
+            "Direction": direction,
+            "Hops": hop
+        }
+        compact_edge.update({key: value for key, value in edge.items() if key not in ("source", "target")})
+        edges.append(compact_edge)
+
+    edges.sort(key=lambda edge: (-(edge["FaultRate"] + edge["ErrorRate"] + edge["ThrottleRate"]), -edge["P99ms"]))
+    return edges[:MAX_SERVICE_GRAPH_EDGES]
+
+# Not traced, as it is called for every segment of a trace
+def get_segment_document(segment):
+    """
+    Returns the parsed and compacted document of a segment. Documents are parsed when they are first used 
+    and the compacted document replaces the JSON string, so each segment is parsed only once per invocation.
+    The trace cache holds its own copy of the JSON string.
+    """
+    if 'ParsedDocument' not in segment:
+        segment['ParsedDocument'] = compact_segment_document(json.loads(segment['Document']))
+        del segment['Document']
+    return segment['ParsedDocument']
+
+# Not traced, as it is called for every segment of a trace
+def compact_segment_document(segment_doc):
+    """
+    Returns a copy of a segment document with only the fields used to profile, summarize and render traces.
+    """
+    compact_segment_doc = {}
+    nodes = [(segment_doc, compact_segment_doc)]
+    while nodes:
+        node, compact_node = nodes.pop()
+        compact_node.update((key, node[key]) for key in SEGMENT_DOCUMENT_FIELDS if key in node)
+        response_status = node.get('http', {}).get('response', {}).get('status')
+        if response_status is not None:
+            compact_node['http'] = {'response': {'status': response_status}}
+        if isinstance(node.get('cause'), dict) and node['cause'].get('exceptions'):
+            compact_node['cause'] = {'exceptions': [
+                {key: exception[key] for key in ('type', 'message') if key in exception} for exception in node['cause']['exceptions']
+            ]}
+        if node.get('subsegments'):
+            compact_node['subsegments'] = [{} for _ in node['subsegments']]
+            nodes.extend(zip(node['subsegments'], compact_node['subsegments']))
+    return compact_segment_doc
+
+# Not traced, as it is called for every node of a trace
+def get_segment_status(segment_doc):
+    """
+    Returns the status of a segment or subsegment: Fault, Error, Throttle or OK.
+    """
+    if segment_doc.get('fault'):
+        return "Fault"
+    elif segment_doc.get('error'):
+        return "Error"
+    elif segment_doc.get('throttle'):
+        return "Throttle"
+    return "OK"
+
+@tracer.capture_method
+def get_trace_resources_html(trace_summaries):
+    """
+    Creates an HTML table of the resources in the trace summaries.
+
+    Args:
+        trace_summaries (list): The trace summaries returned by get_trace_summaries.
+
+    Returns:
+        str: An HTML table.
+    """
     # Initialize list for combined data
     combined_data = []
 
     # Extract and combine service IDs with Type AWS::EC2::Instance and their InstanceIds
-    for summary in response["TraceSummaries"]:
+    for summary in trace_summaries:
         instance_ids = [instance["Id"] for instance in summary.get("InstanceIds", [])]
         for service in summary["ServiceIds"]:
             service_name = service.get("Name", "Unknown")
@@ -82,49 +760,41 @@ def process_traces(filter_expression, region, trace_start_time, trace_end_time):
     html_combined = html_combined.replace('<table border="1" class="dataframe">', new_table_tag)
     html_combined = html_combined.replace('<tr style="text-align: right;">','<tr>')
     html_combined = html_combined.replace('<thead>', f'<thead><tr><th colspan="3" style="text-align: center;">Resources in Trace</th></tr>')
-    
-    # Extract the latest trace ID
-    if response["TraceSummaries"]:
-        latest_trace = max(response["TraceSummaries"], key=lambda trace: trace["StartTime"]) 
-        trace_id = latest_trace["Id"]    
-    else:
-        trace_id = None
-    
-    if trace_id:
-        try:
-            response = xray.batch_get_traces(TraceIds=[trace_id])
-        except botocore.exceptions.ClientError as error:
-            logger.exception("Error retrieving trace")
-            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error  
-        except botocore.exceptions.ParamValidationError as error:
-            raise ValueError('The parameters you provided are incorrect: {}'.format(error))            
-        
-        logger.info("Traces", traces=response)
-        
-        # Assuming there is only one trace in the batch
-        trace_data = response['Traces'][0]
-        html = generate_trace_html(response, region, trace_start_time, trace_end_time)  
-        
-        # Minimize the HTML content by removing newlines and redundant whitespace
-        minimized_trace_html_content = html_combined
-        minimized_trace_html_content += ' '.join(html.split())
-        
-        # Log the minimized HTML content to the logs in one line
-        logger.info("Trace HTML", html=minimized_trace_html_content)                
-    else:
-        logger.info("No trace ID found in the summary.")
-        minimized_trace_html_content = "" 
-    
-    return trace_summary, minimized_trace_html_content
+    return html_combined
 
 @tracer.capture_method
-def generate_trace_html(traces_response, region, start_time, end_time):
-    
-    for trace in traces_response.get('Traces', []):
-        trace_id =  trace.get('Id') 
-   
-   
-   # Check if start_time and end_time are string instances and parse them if true
+def get_sampled_traces_html(sampled_traces, region, start_time, end_time):
+    """
+    Creates an HTML table listing the sampled traces with a link to each trace.
+
+    Args:
+        sampled_traces (list): The sampled traces, as returned by summarize_traces.
+        region (str): The AWS region of the traces.
+        start_time (str): The start time, in ISO format with timezone information.
+        end_time (str): The end time, in ISO format with timezone information.
+
+    Returns:
+        str: An HTML table.
+    """
+    start_time_str, end_time_str = get_console_time_range(start_time, end_time)
+    rows = []
+    for sampled_trace in sampled_traces:
+        link = f"https://{region}.console.aws.amazon.com/cloudwatch/home?region={region}#xray:traces/{sampled_trace['Id']}?~(query~()~context~(timeRange~(end~'{end_time_str}~start~'{start_time_str})))"
+        rows.append({
+            "Trace": f'<a rel="noopener" target="_blank" href="{link}">{sampled_trace["Id"]}</a>',
+            "Status": sampled_trace["Status"],
+            "Resp.": sampled_trace["ResponseCode"] or '-',
+            "Dur.": f'{round((sampled_trace["Duration"] or 0) * 1000)}ms',
+            "Issues": '<br>'.join(issue["Name"] for issue in sampled_trace["Issues"][:3])
+        })
+    return get_html_table_with_fields("Sampled traces", rows)
+
+@tracer.capture_method
+def get_console_time_range(start_time, end_time):
+    """
+    Formats a time range for CloudWatch console links.
+    """
+    # Check if start_time and end_time are string instances and parse them if true
     if isinstance(start_time, str):
         start_time = datetime.datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%S.%f%z')
     if isinstance(end_time, str):
@@ -133,6 +803,15 @@ def generate_trace_html(traces_response, region, start_time, end_time):
     # Format start_time and end_time to strings as needed
     start_time_str = start_time.strftime('%Y-%m-%dT%H*3a%M*3a%S.%f')[:-3] +"Z"
     end_time_str = end_time.strftime('%Y-%m-%dT%H*3a%M*3a%S.%f')[:-3] +"Z"
+    return start_time_str, end_time_str
+
+@tracer.capture_method
+def generate_trace_html(traces_response, region, start_time, end_time):
+    
+    for trace in traces_response.get('Traces', []):
+        trace_id =  trace.get('Id') 
+   
+    start_time_str, end_time_str = get_console_time_range(start_time, end_time)
     
     
     link = f"https://{region}.console.aws.amazon.com/cloudwatch/home?region={region}#xray:traces/{trace_id}?~(query~()~context~(timeRange~(end~'{end_time_str}~start~'{start_time_str})))"
@@ -160,15 +839,14 @@ def generate_trace_html(traces_response, region, start_time, end_time):
     for trace in traces_response.get('Traces', []):
         timeline_scale =  trace.get('Duration') 
         for segment in trace.get('Segments', []):
-            segment_doc = json.loads(segment['Document'])
+            segment_doc = get_segment_document(segment)
             earliest_start = min(earliest_start, segment_doc.get('start_time', earliest_start))
             all_segments.append(segment_doc)
 
     # Sort segments by start time
     sorted_segments = sorted(all_segments, key=lambda x: x.get('start_time', 0))
     
-    for segment_doc in sorted_segments:
-        html_output += process_trace_segment(segment_doc, earliest_start, timeline_scale)
+    html_output += render_trace_segments(sorted_segments, earliest_start, timeline_scale)
 
     # HTML boilerplate end
     html_output += """
@@ -177,63 +855,130 @@ def generate_trace_html(traces_response, region, start_time, end_time):
     return html_output
     
 @tracer.capture_method
-def process_trace_segment(segment_doc, earliest_start, timeline_scale, is_subsegment=False):
-    name = segment_doc.get('name', 'Unknown')
-    origin = segment_doc.get('origin', '')
-    start_time = segment_doc.get('start_time', 0)
-    end_time = segment_doc.get('end_time', 0)
-    duration = (end_time - start_time)
+def render_trace_segments(segment_docs, earliest_start, timeline_scale, max_rows=MAX_TRACE_ROWS, max_depth=MAX_TRACE_DEPTH):
+    """
+    Renders segments and their subsegments as HTML table rows.
+
+    The segment tree is walked iteratively, so deeply nested traces cannot exceed the recursion limit. 
+    Subsegments are sorted once per parent, and repeated sibling calls with the same name and status 
+    (e.g. SDK calls in a loop) are collapsed into a single aggregate row. Rendering stops at max_rows 
+    rows and max_depth levels of subsegments, and a final row summarizes what was omitted.
+
+    Args:
+        segment_docs (list): The parsed segment documents, sorted by start time.
+        earliest_start (float): The earliest start time of the segments, the start of the timeline.
+        timeline_scale (float): The duration of the trace, the length of the timeline.
+        max_rows (int, optional): The maximum number of segment and subsegment rows.
+        max_depth (int, optional): The maximum depth of subsegments.
+
+    Returns:
+        str: The HTML table rows.
+    """
+    html_output = []
+    rows = 0
+    omitted_by_depth = 0
+    omitted_by_rows = 0
+    collapsed = 0
+
+    # Each stack entry is a group of sibling nodes with the same name and status, and its depth
+    stack = [([segment_doc], 0) for segment_doc in reversed(segment_docs)]
+    while stack:
+        nodes, depth = stack.pop()
+        if rows >= max_rows:
+            omitted_by_rows += sum(count_trace_nodes(node) for node in nodes)
+            continue
+        rows += 1
+
+        if depth == 0:
+            name = nodes[0].get('name', 'Unknown')
+            origin = nodes[0].get('origin', '')
+            html_output.append(f'<tr><td colspan="5" style="font-weight: bold; padding: 5px; border: 1px solid #ddd;">{name + ("&nbsp;&nbsp;&nbsp;&nbsp;" + origin if origin != "" else "")}</td></tr>')
+        html_output.append(get_trace_segment_row(nodes, depth, earliest_start, timeline_scale))
+
+        if len(nodes) > 1:
+            # The subsegments of collapsed calls are not rendered
+            collapsed += sum(count_trace_nodes(node) for node in nodes) - 1
+            continue
+
+        subsegments = nodes[0].get('subsegments', [])
+        if not subsegments:
+            continue
+        if depth >= max_depth:
+            omitted_by_depth += sum(count_trace_nodes(subsegment) for subsegment in subsegments)
+            continue
+
+        # Group siblings by name and status, ordered by the first call in each group
+        groups = {}
+        for subsegment in sorted(subsegments, key=lambda x: x.get('start_time', 0)):
+            groups.setdefault((subsegment.get('name', 'Unknown'), get_segment_status(subsegment)), []).append(subsegment)
+        stack.extend((group, depth + 1) for group in reversed(list(groups.values())))
+
+    omitted = []
+    if collapsed:
+        omitted.append(f"{collapsed} repeated calls were collapsed")
+    if omitted_by_depth:
+        omitted.append(f"{omitted_by_depth} subsegments deeper than {max_depth} levels were omitted")
+    if omitted_by_rows:
+        omitted.append(f"{omitted_by_rows} segments and subsegments beyond the {max_rows} row limit were omitted")
+    if omitted:
+        html_output.append(f'<tr><td colspan="5" style="padding: 5px; border: 1px solid #ddd; font-size: small;">{", ".join(omitted).capitalize()}.</td></tr>')
+
+    return ''.join(html_output)
+
+# Not traced, as it is called for every node of a trace
+def count_trace_nodes(segment_doc):
+    """
+    Counts a segment or subsegment and all of its nested subsegments.
+    """
+    count = 0
+    nodes = [segment_doc]
+    while nodes:
+        node = nodes.pop()
+        count += 1
+        nodes.extend(node.get('subsegments', []))
+    return count
+
+# Not traced, as it is called for every node or group of repeated calls that is rendered
+def get_trace_segment_row(nodes, depth, earliest_start, timeline_scale):
+    """
+    Renders an HTML table row for a segment or subsegment, or an aggregate row for repeated sibling calls.
+
+    Args:
+        nodes (list): The segment or subsegment, or the repeated calls with the same name and status.
+        depth (int): The depth of the node in the segment tree.
+        earliest_start (float): The start of the timeline.
+        timeline_scale (float): The length of the timeline.
+
+    Returns:
+        str: An HTML table row.
+    """
+    name = nodes[0].get('name', 'Unknown')
+    start_time = min(node.get('start_time', 0) for node in nodes)
+    end_time = max(node.get('end_time', 0) for node in nodes)
+    duration = sum(node.get('end_time', 0) - node.get('start_time', 0) for node in nodes)
     offset = (start_time - earliest_start) / timeline_scale * 100
-    bar_width = duration / timeline_scale * 100
+    bar_width = (end_time - start_time) / timeline_scale * 100
     duration_in_ms = round(duration * 1000)
-    response_code = segment_doc.get('http', {}).get('response', {}).get('status', '-')
+    response_codes = {node.get('http', {}).get('response', {}).get('status', '-') for node in nodes}
+    response_code = response_codes.pop() if len(response_codes) == 1 else '-'
+    if len(nodes) > 1:
+        name = f"{name} &times;{len(nodes)}"
 
     # Set Status:
-    if segment_doc.get('fault'):
-        status = "Fault"
-        color = "#fe6e73"  # Reddish for fault
-    elif segment_doc.get('error'):
-        status = "Error"
-        color = "#c59600"  # Yellowish for error
-    elif segment_doc.get('throttle'):
-        status = "Throttle"
-        color = "#b088f5"  # Purplish for throttle
-    else:
-        status = "OK"
-        color = "#4CAF50"  # Green for OK  
-    
-    html_output = ""
+    status = get_segment_status(nodes[0])
+    color = SEGMENT_STATUS_COLORS[status]
 
     bar_container_style = "position: relative; width: 100%; background-color: #ddd; height: 20px; min-width: 340px;"
     bar_style = f"position: absolute; height: 100%; background-color: {color}; left: {offset}%; width: {bar_width}%;"
     td_style = "padding: 2px; border: 1px solid #ddd; overflow: hidden; white-space: nowrap; text-overflow: ellipsis; font-size: small;"
+    indent = '&nbsp;&nbsp;' * (depth + 2)
 
-    if not is_subsegment:
-        html_output += f"""
-            <tr>
-                <td colspan="5" style="font-weight: bold; padding: 5px; border: 1px solid #ddd;">{name + ('&nbsp;&nbsp;&nbsp;&nbsp;' + origin if origin != '' else '')}</td>
-            </tr>
-        """   
-    
-    html_output += f"""
-        <tr>
-            <td style="{td_style} max-width:155px;" width="155">&nbsp;&nbsp;&nbsp;&nbsp;{name}</td>
-            <td style="{td_style} max-width:40px; color:{color};" width="40">{status}</td>
-            <td style="{td_style} max-width:40px;" width="40"">{response_code}</td>
-            <td style="{td_style} max-width:40px;" width="40"">{duration_in_ms}ms</td>
-            <td style="{td_style}">
-                <div style="{bar_container_style}">
-                    <div style="{bar_style}"></div>
-                </div>
-            </td>
-        </tr>
-    """
-
-    # Process subsegments if they exist
-    subsegments = segment_doc.get('subsegments', [])
-    sorted_subsegments = sorted(subsegments, key=lambda x: x.get('start_time', 0))
-
-    for subsegment in sorted_subsegments:
-        html_output += process_trace_segment(subsegment, earliest_start, timeline_scale, True)
-        
-    return html_output
+    return (
+        '<tr>'
+        f'<td style="{td_style} max-width:155px;" width="155">{indent}{name}</td>'
+        f'<td style="{td_style} max-width:40px; color:{color};" width="40">{status}</td>'
+        f'<td style="{td_style} max-width:40px;" width="40">{response_code}</td>'
+        f'<td style="{td_style} max-width:40px;" width="40">{duration_in_ms}ms</td>'
+        f'<td style="{td_style}"><div style="{bar_container_style}"><div style="{bar_style}"></div></div></td>'
+        '</tr>'
+    )
@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+import json
+import zlib
+import threading
+
+import boto3
+import botocore
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Tracer
+logger = Logger()
+tracer = Tracer()
+
+# Incident state is kept for this long after the window closes, for followers that are still waiting
+INCIDENT_RETENTION_SECONDS = 3600
+
+class LocalIncidentStore:
+    """
+    Keeps incidents in memory. Incidents are only shared by invocations in the same execution environment,
+    so this store is for testing, use DynamoDBIncidentStore to batch alarms across execution environments.
+    """
+    __incidents = {}
+    __current = {}
+    __lock = threading.Lock()
+
+    @staticmethod
+    @tracer.capture_method
+    def join(incident_key, member_id, member, window_seconds):
+        with LocalIncidentStore.__lock:
+            now = time.time()
+            current = LocalIncidentStore.__current.get(incident_key)
+            is_leader = not current or current['window_end'] <= now
+            if is_leader:
+                current = {'incident_id': uuid.uuid4().hex, 'window_end': now + window_seconds}
+                LocalIncidentStore.__current[incident_key] = current
+                LocalIncidentStore.__incidents[current['incident_id']] = {'members': {}, 'analysis': None, 'expires': current['window_end'] + INCIDENT_RETENTION_SECONDS}
+
+            # Drop expired incidents
+            for incident_id in [incident_id for incident_id, incident in LocalIncidentStore.__incidents.items() if incident['expires'] < now]:
+                del LocalIncidentStore.__incidents[incident_id]
+
+            LocalIncidentStore.__incidents[current['incident_id']]['members'][member_id] = dict(member, member_id=member_id, joined=now)
+            return current['incident_id'], current['window_end'], is_leader
+
+    @staticmethod
+    @tracer.capture_method
+    def get_members(incident_key, incident_id):
+        with LocalIncidentStore.__lock:
+            incident = LocalIncidentStore.__incidents.get(incident_id, {'members': {}})
+            return sorted(incident['members'].values(), key=lambda member: member['joined'])
+
+    @staticmethod
+    @tracer.capture_method
+    def put_analysis(incident_key, incident_id, analysis):
+        with LocalIncidentStore.__lock:
+            if incident_id in LocalIncidentStore.__incidents:
+                LocalIncidentStore.__incidents[incident_id]['analysis'] = analysis
+
+    @staticmethod
+    @tracer.capture_method
+    def get_analysis(incident_key, incident_id):
+        with LocalIncidentStore.__lock:
+            return LocalIncidentStore.__incidents.get(incident_id, {}).get('analysis')
+
+class DynamoDBIncidentStore:
+    """
+    Keeps incidents in the DynamoDB table INCIDENT_TABLE_NAME, so that alarms are batched across execution environments.
+
+    The table has a pk partition key and an sk sort key, both strings, and expires items with the expires attribute.
+    For each incident key, the #current item holds the incident that is open, the member#<incident ID># items hold
+    the alarms that joined it and the analysis#<incident ID> item holds the shared analysis. Prompt sections are compressed
+    to stay well within the item size limit.
+    """
+    __client = None
+
+    @staticmethod
+    def client():
+        if not DynamoDBIncidentStore.__client:
+            DynamoDBIncidentStore.__client = boto3.client('dynamodb')
+        return DynamoDBIncidentStore.__client
+
+    @staticmethod
+    @tracer.capture_method
+    def join(incident_key, member_id, member, window_seconds):
+        """
+        Joins the open incident for the incident key, or opens a new incident and becomes its leader.
+
+        Args:
+            incident_key (str): The key of the alarms that are batched together.
+            member_id (str): The ID of the alarm occurrence.
+            member (dict): The alarm_name and prompt_sections of the alarm.
+            window_seconds (int): The number of seconds that a new incident is open for.
+
+        Returns:
+            incident_id (str): The incident ID.
+            window_end (float): The time at which the incident closes.
+            is_leader (bool): Whether this alarm opened the incident, and analyses it when it closes.
+        """
+        dynamodb = DynamoDBIncidentStore.client()
+        table_name = os.environ.get('INCIDENT_TABLE_NAME')
+        try:
+            # The incident is opened by whichever alarm writes the #current item first, once the last incident has closed
+            now = time.time()
+            incident_id, window_end, is_leader = uuid.uuid4().hex, now + window_seconds, True
+            try:
+                dynamodb.put_item(
+                    TableName=table_name,
+                    Item={
+                        'pk': {'S': incident_key},
+                        'sk': {'S': '#current'},
+                        'incident_id': {'S': incident_id},
+                        'window_end': {'N': str(window_end)},
+                        'expires': {'N': str(int(window_end + INCIDENT_RETENTION_SECONDS))}
+                    },
+                    ConditionExpression='attribute_not_exists(pk) OR window_end <= :now',
+                    ExpressionAttributeValues={':now': {'N': str(now)}}
+                )
+            except botocore.exceptions.ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                current = dynamodb.get_item(
+                    TableName=table_name,
+                    Key={'pk': {'S': incident_key}, 'sk': {'S': '#current'}},
+                    ConsistentRead=True
+                )['Item']
+                incident_id, window_end, is_leader = current['incident_id']['S'], float(current['window_end']['N']), False
+
+            dynamodb.put_item(
+                TableName=table_name,
+                Item={
+                    'pk': {'S': incident_key},
+                    'sk': {'S': f'member#{incident_id}#{member_id}'},
+                    'member_id': {'S': member_id},
+                    'alarm_name': {'S': member['alarm_name']},
+                    'prompt_sections': {'B': zlib.compress(json.dumps(member['prompt_sections'], separators=(',', ':'), default=str).encode())},
+                    'joined': {'N': str(time.time())},
+                    'expires': {'N': str(int(window_end + INCIDENT_RETENTION_SECONDS))}
+                }
+            )
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error joining incident")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+        return incident_id, window_end, is_leader
+
+    @staticmethod
+    @tracer.capture_method
+    def get_members(incident_key, incident_id):
+        dynamodb = DynamoDBIncidentStore.client()
+        members = []
+        try:
+            paginator = dynamodb.get_paginator('query')
+            for page in paginator.paginate(
+                TableName=os.environ.get('INCIDENT_TABLE_NAME'),
+                KeyConditionExpression='pk = :pk AND begins_with(sk, :prefix)',
+                ExpressionAttributeValues={':pk': {'S': incident_key}, ':prefix': {'S': f'member#{incident_id}#'}},
+                ConsistentRead=True
+            ):
+                for item in page['Items']:
+                    members.append({
+                        'member_id': item['member_id']['S'],
+                        'alarm_name': item['alarm_name']['S'],
+                        'prompt_sections': json.loads(zlib.decompress(item['prompt_sections']['B'])),
+                        'joined': float(item['joined']['N'])
+                    })
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error getting incident members")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+        return sorted(members, key=lambda member: member['joined'])
+
+    @staticmethod
+    @tracer.capture_method
+    def put_analysis(incident_key, incident_id, analysis):
+        dynamodb = DynamoDBIncidentStore.client()
+        try:
+            dynamodb.put_item(
+                TableName=os.environ.get('INCIDENT_TABLE_NAME'),
+                Item={
+                    'pk': {'S': incident_key},
+                    'sk': {'S': f'analysis#{incident_id}'},
+                    'ai_response': {'B': zlib.compress(analysis['ai_response'].encode())},
+                    'member_ids': {'L': [{'S': member_id} for member_id in analysis['member_ids']]},
+                    'alarm_names': {'L': [{'S': alarm_name} for alarm_name in analysis['alarm_names']]},
+                    'failed': {'BOOL': analysis.get('failed', False)},
+                    'expires': {'N': str(int(time.time() + INCIDENT_RETENTION_SECONDS))}
+                }
+            )
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error putting incident analysis")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+
+    @staticmethod
+    @tracer.capture_method
+    def get_analysis(incident_key, incident_id):
+        dynamodb = DynamoDBIncidentStore.client()
+        try:
+            item = dynamodb.get_item(
+                TableName=os.environ.get('INCIDENT_TABLE_NAME'),
+                Key={'pk': {'S': incident_key}, 'sk': {'S': f'analysis#{incident_id}'}},
+                ConsistentRead=True
+            ).get('Item')
+        except botocore.exceptions.ClientError as error:
+            logger.exception("Error getting incident analysis")
+            raise RuntimeError(f"Unable to fullfil request error encountered as : {error}") from error
+        except botocore.exceptions.ParamValidationError as error:
+            raise ValueError('The parameters you provided are incorrect: {}'.format(error))
+        if not item:
+            return None
+        return {
+            'ai_response': zlib.decompress(item['ai_response']['B']).decode(),
+            'member_ids': [member_id['S'] for member_id in item['member_ids']['L']],
+            'alarm_names': [alarm_name['S'] for alarm_name in item['alarm_names']['L']],
+            'failed': item.get('failed', {}).get('BOOL', False)
+        }
+
+@tracer.capture_method
+def get_incident_store():
+    """
+    Returns the DynamoDB incident store if INCIDENT_TABLE_NAME is set, otherwise the local incident store.
+    """
+    if os.environ.get('INCIDENT_TABLE_NAME'):
+        return DynamoDBIncidentStore
+    return LocalIncidentStore
@@ -18,26 +18,32 @@ import api_gateway_handler
 import rds_handler
 import s3_handler
 import eks_handler
+import metric_filter_handler
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 
 from functions import get_html_table
+from functions import get_information_panel
 from functions_metrics import generate_main_metric_widget
 from functions_metrics import get_metric_data
 from functions import create_test_case
 from functions_metrics import get_metric_array
 from functions_health import describe_events
+from functions_logs import find_metric_filters
 from functions_email import build_email_summary
 from functions_email import get_generic_links
 from functions_email import send_email
 from functions_email import build_html_body
+from functions_email import build_analysis_html_body
 
 from functions_alarm import get_alarm_history
 from functions_cloudformation import get_cloudformation_template
-from functions_bedrock import construct_prompt
-from functions_bedrock import execute_prompt
+from functions_bedrock import build_prompt
+from functions_bedrock import construct_prompt_sections
+from functions_bedrock import get_context_fingerprint
+from functions_incident import analyse_incident
 
 from health_client import ActiveRegionHasChangedError
 
@@ -167,22 +173,26 @@ def alarm_handler(event, context):
                                            namespace, change_time, annotation_time, start_time, end_time, start, end)
 
     else:
-        # Namespace not matched
-        # TO DO: use describe-metric-filters to see if this is a metric filter metric and then get log data.
-        contextual_links = None
-        log_information = None
-        log_events = None
-        resource_information = None
-        resource_information_object = None
-        widget_images = None
-        additional_metrics_with_timestamps_removed = None
-        trace_summary = None
-        trace_html = None
-        notifications = None
-        tags = None
-        namespace_defined = False
-        logger.info("undefined_namespace_dimensions",
-                    extra={"namespace": namespace})
+        # Namespace not matched, check whether the metric is published by a log metric filter
+        metric_filters = find_metric_filters(namespace, metric_name, region)
+        if metric_filters:
+            response = metric_filter_handler.process_metric_filter(metric_filters, metric_name, dimensions, region, account_id,
+                                                                   namespace, change_time, annotation_time, start_time, end_time, start, end)
+        else:
+            contextual_links = None
+            log_information = None
+            log_events = None
+            resource_information = None
+            resource_information_object = None
+            widget_images = None
+            additional_metrics_with_timestamps_removed = None
+            trace_summary = None
+            trace_html = None
+            notifications = None
+            tags = None
+            namespace_defined = False
+            logger.info("undefined_namespace_dimensions",
+                        extra={"namespace": namespace})
 
     # =============================================================================
     # Section: Build Email
@@ -254,17 +264,26 @@ def alarm_handler(event, context):
     if tags:
         max_length = 50  # Maximum length of CloudFormation Value to shorten prompt
         truncated_cloudformation_template = get_cloudformation_template(
-            tags, region, trace_summary, max_length)
+            tags, region, trace_summary, max_length, dimensions)
     else:
         truncated_cloudformation_template = None
 
     # Contruct Bedrock prompt
-    prompt = construct_prompt(alarm_history, message, metric_data, text_summary, health_events, truncated_cloudformation_template,
-                              resource_information_object, log_events, additional_metrics_with_timestamps_removed, trace_summary)
+    prompt_sections = construct_prompt_sections(alarm_history, message, metric_data, text_summary, health_events, truncated_cloudformation_template,
+                                                resource_information_object, log_events, additional_metrics_with_timestamps_removed, trace_summary)
+    prompt = build_prompt(prompt_sections)
     logger.info("bedrock_prompt", prompt=prompt)
 
-    # Execute Bedrock Prompt
-    ai_response = execute_prompt(prompt)
+    # Execute Bedrock Prompt, reusing the analysis of an earlier occurrence of the alarm with similar context,
+    # or sharing a single analysis with related alarms that fire within INCIDENT_WINDOW_SECONDS
+    fingerprint = get_context_fingerprint(message, metric_data, log_events, trace_summary)
+
+    # In two phase mode the context email is sent first, and the analysis follows as a reply
+    two_phase_email = bool(os.environ.get('USE_BEDROCK')) and os.environ.get('TWO_PHASE_EMAIL', 'False') == 'True'
+    if two_phase_email:
+        ai_response = get_information_panel("Analysis in progress", "The Bedrock analysis of this alarm will follow in a reply to this email.")
+    else:
+        ai_response = analyse_incident(message, prompt, prompt_sections, fingerprint)
 
     # =============================================================================
     # Section: Create attachments
@@ -300,7 +319,7 @@ def alarm_handler(event, context):
     BODY_HTML = build_html_body(subject, summary, ai_response, widget_images,
                                 trace_html, additional_information, alarm_details, metric_details)
 
-    send_email(
+    message_id = send_email(
         sender=sender,
         recipient=recipient,
         subject=subject,
@@ -308,3 +327,20 @@ def alarm_handler(event, context):
         body_html=BODY_HTML,
         attachments=attachments
     )
+
+    if two_phase_email:
+        # The context email has been sent, so a failed analysis is reported in the reply rather than raised, 
+        # which would retry the invocation and send the context email again
+        try:
+            ai_response = analyse_incident(message, prompt, prompt_sections, fingerprint, stream=True)
+        except Exception:
+            logger.exception("Error analysing alarm with Bedrock")
+            ai_response = get_information_panel("Analysis failed", "The Bedrock analysis of this alarm could not be completed. See the logs of the Alarm Context Tool function for details.")
+        send_email(
+            sender=sender,
+            recipient=recipient,
+            subject="Re: " + subject,
+            body_text=BODY_TEXT,
+            body_html=build_analysis_html_body(subject, ai_response),
+            in_reply_to=message_id
+        )
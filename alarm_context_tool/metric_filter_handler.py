@@ -0,0 +1,92 @@
+from functions import get_dashboard_button
+from functions import get_html_table_with_fields
+from functions_logs import get_last_10_events
+from functions_logs import get_log_insights_link
+from functions_metrics import build_dashboard
+from functions_metrics import get_metrics_from_dashboard_metrics
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Tracer
+logger = Logger()
+tracer = Tracer()
+
+@tracer.capture_method
+def process_metric_filter(metric_filters, metric_name, dimensions, region, account_id, namespace, change_time, annotation_time, start_time, end_time, start, end):
+    """
+    Processes an alarm on a metric that is published by one or more CloudWatch Logs metric filters.
+
+    Args:
+    - metric_filters: The metric filters that publish the metric, as returned by find_metric_filters.
+    - metric_name: The name of the metric.
+    - dimensions: The dimensions of the metric.
+    - region: The AWS region where the log groups reside.
+    - account_id: The AWS account ID where the log groups reside.
+    - namespace: The CloudWatch namespace of the metric.
+    - change_time: The time of the change in ISO format with timezone information.
+    - annotation_time: The time to use as the annotation in ISO format with timezone information.
+    - start_time: The start time of the query, in ISO format with timezone information.
+    - end_time: The end time of the query, in ISO format with timezone information.
+    - start: The start time of the dashboard, in ISO format with timezone information.
+    - end: The end time of the dashboard, in ISO format with timezone information.
+
+    Returns:
+    - A dictionary
+    """
+    contextual_links = ""
+    log_information = ""
+    log_events = []
+
+    log_inputs = []
+    for metric_filter in metric_filters:
+        log_group_name = metric_filter['logGroupName']
+        log_input = {"logGroupName": log_group_name}
+        log_inputs.append(log_input)
+
+        link = 'https://%s.console.aws.amazon.com/cloudwatch/home?region=%s#logsV2:log-groups/log-group/%s' % (region, region, log_group_name.replace('/', '$252F'))
+        contextual_links += get_dashboard_button("%s log group" % (log_group_name), link)
+
+        # Get the last 10 log events that match the metric filter
+        filter_log_information, filter_log_events = get_last_10_events(log_input, change_time, region, metric_filter['filterPattern'])
+        log_information += filter_log_information
+        log_events.extend(filter_log_events)
+
+    # Log Insights Link
+    log_insights_query = """fields @timestamp, @message, @logStream, @log
+        | sort @timestamp desc
+        | limit 100"""
+    log_insights_link = get_log_insights_link(log_inputs, log_insights_query, region, start_time, end_time)
+    contextual_links += get_dashboard_button("Log Insights", log_insights_link)
+
+    resource_information = get_html_table_with_fields("Metric filters for %s" % (metric_name), metric_filters)
+    resource_information_object = {"MetricFilters": metric_filters}
+
+    # The alarmed metric is already graphed, add the volume of events in each source log group
+    dashboard_metrics = [
+        {
+            "title": "Incoming log events: " + log_input['logGroupName'],
+            "view": "timeSeries",
+            "stacked": False,
+            "stat": "Sum",
+            "period": 60,
+            "metrics": [
+                ["AWS/Logs", "IncomingLogEvents", "LogGroupName", log_input['logGroupName']]
+            ]
+        }
+        for log_input in log_inputs
+    ]
+    widget_images = build_dashboard(dashboard_metrics, annotation_time, start, end, region)
+    additional_metrics_with_timestamps_removed = get_metrics_from_dashboard_metrics(dashboard_metrics, change_time, end, region)
+
+    return {
+        "contextual_links": contextual_links,
+        "log_information": log_information,
+        "log_events": log_events,
+        "resource_information": resource_information,
+        "resource_information_object": resource_information_object,
+        "notifications": None,
+        "widget_images": widget_images,
+        "additional_metrics_with_timestamps_removed": additional_metrics_with_timestamps_removed,
+        "trace_summary": None,
+        "trace": None,
+        "tags": None
+    }
@@ -0,0 +1,160 @@
+import os
+import json
+
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Tracer
+logger = Logger()
+tracer = Tracer()
+
+class TraceCache:
+    """
+    A cache of X-Ray traces by trace ID, persisted across warm invocations.
+
+    Traces are held in memory in a least recently used cache of up to XRAY_TRACE_CACHE_BYTES bytes. If
+    XRAY_TRACE_CACHE_DIR is set, traces evicted from memory are written to that directory, up to
+    XRAY_TRACE_CACHE_DIR_BYTES bytes, and moved back into memory when they are next used.
+
+    The size of a trace is the length of its segment documents, which are cached as the JSON strings returned
+    by batch_get_traces. Copies of the traces are cached and returned, so that the segment documents that are
+    parsed in place when they are used, by get_segment_document, are not held in the cache.
+    """
+    __traces = {}
+    __trace_bytes = {}
+    __memory_bytes = 0
+    __disk_entries = None
+    __disk_bytes = 0
+
+    @staticmethod
+    @tracer.capture_method
+    def get_traces(trace_ids):
+        """
+        Returns the cached traces, moving them to the end of the least recently used order.
+
+        Args:
+            trace_ids (list): The trace IDs.
+
+        Returns:
+            traces (dict): The cached traces by trace ID.
+            missing_trace_ids (list): The trace IDs that are not cached.
+        """
+        traces = {}
+        missing_trace_ids = []
+        for trace_id in trace_ids:
+            trace, trace_bytes = TraceCache.__pop(trace_id)
+            if trace is None:
+                trace, trace_bytes = TraceCache.__read(trace_id)
+            if trace is None:
+                missing_trace_ids.append(trace_id)
+            else:
+                traces[trace_id] = TraceCache.__copy(trace)
+                TraceCache.__add(trace, trace_bytes)
+        logger.info("Trace cache", cached_traces=len(traces), missing_traces=len(missing_trace_ids), cached_bytes=TraceCache.__memory_bytes)
+        return traces, missing_trace_ids
+
+    @staticmethod
+    @tracer.capture_method
+    def put_traces(traces):
+        """
+        Caches traces. Traces with segments that are still in progress are not cached, as they are incomplete.
+
+        Args:
+            traces (list): Traces returned by batch_get_traces.
+        """
+        for trace in traces:
+            if any('"in_progress"' in segment.get('Document', '') for segment in trace.get('Segments', [])):
+                continue
+            TraceCache.__pop(trace['Id'])
+            TraceCache.__add(TraceCache.__copy(trace), sum(len(segment['Document']) for segment in trace.get('Segments', [])))
+
+    @staticmethod
+    def __copy(trace):
+        # The segments are copied, as their documents are replaced when they are parsed
+        return dict(trace, Segments=[dict(segment) for segment in trace.get('Segments', [])])
+
+    @staticmethod
+    def __add(trace, trace_bytes):
+        max_bytes = int(os.environ.get('XRAY_TRACE_CACHE_BYTES', 67108864))
+        if trace_bytes > max_bytes:
+            return
+        TraceCache.__traces[trace['Id']] = trace
+        TraceCache.__trace_bytes[trace['Id']] = trace_bytes
+        TraceCache.__memory_bytes += trace_bytes
+
+        # Evict the least recently used traces, to disk if enabled
+        while TraceCache.__memory_bytes > max_bytes:
+            evicted_trace, _ = TraceCache.__pop(next(iter(TraceCache.__traces)))
+            TraceCache.__write(evicted_trace)
+
+    @staticmethod
+    def __pop(trace_id):
+        trace = TraceCache.__traces.pop(trace_id, None)
+        if trace is None:
+            return None, 0
+        trace_bytes = TraceCache.__trace_bytes.pop(trace_id)
+        TraceCache.__memory_bytes -= trace_bytes
+        return trace, trace_bytes
+
+    @staticmethod
+    def __get_disk_entries():
+        """
+        Returns the sizes of the traces in the cache directory by trace ID, or None if it is disabled.
+        The directory is indexed on first use, as it outlives the process if the runtime is restarted.
+        """
+        cache_dir = os.environ.get('XRAY_TRACE_CACHE_DIR', '')
+        if not cache_dir:
+            return None
+        if TraceCache.__disk_entries is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            files = sorted((entry for entry in os.scandir(cache_dir) if entry.name.endswith('.json')), key=lambda entry: entry.stat().st_mtime)
+            TraceCache.__disk_entries = {entry.name[:-5]: entry.stat().st_size for entry in files}
+            TraceCache.__disk_bytes = sum(TraceCache.__disk_entries.values())
+        return TraceCache.__disk_entries
+
+    @staticmethod
+    def __write(trace):
+        disk_entries = TraceCache.__get_disk_entries()
+        if disk_entries is None:
+            return
+        cache_dir = os.environ.get('XRAY_TRACE_CACHE_DIR', '')
+        max_bytes = int(os.environ.get('XRAY_TRACE_CACHE_DIR_BYTES', 134217728))
+
+        content = json.dumps(trace)
+        if len(content) > max_bytes:
+            return
+
+        # Evict the least recently written traces
+        while disk_entries and TraceCache.__disk_bytes + len(content) > max_bytes:
+            TraceCache.__remove(next(iter(disk_entries)))
+
+        try:
+            with open(os.path.join(cache_dir, f"{trace['Id']}.json"), 'w') as file:
+                file.write(content)
+        except OSError:
+            logger.exception("Error writing trace to the trace cache directory", trace_id=trace['Id'])
+            return
+        disk_entries[trace['Id']] = len(content)
+        TraceCache.__disk_bytes += len(content)
+
+    @staticmethod
+    def __read(trace_id):
+        disk_entries = TraceCache.__get_disk_entries()
+        if not disk_entries or trace_id not in disk_entries:
+            return None, 0
+        try:
+            with open(os.path.join(os.environ.get('XRAY_TRACE_CACHE_DIR', ''), f"{trace_id}.json")) as file:
+                trace = json.load(file)
+        except (OSError, ValueError):
+            logger.exception("Error reading trace from the trace cache directory", trace_id=trace_id)
+            trace = None
+        TraceCache.__remove(trace_id)
+        if trace is None:
+            return None, 0
+        return trace, sum(len(segment['Document']) for segment in trace.get('Segments', []))
+
+    @staticmethod
+    def __remove(trace_id):
+        TraceCache.__disk_bytes -= TraceCache.__disk_entries.pop(trace_id)
+        try:
+            os.remove(os.path.join(os.environ.get('XRAY_TRACE_CACHE_DIR', ''), f"{trace_id}.json"))
+        except OSError:
+            pass
@@ -0,0 +1,65 @@
+"""
+Runs concurrent Bedrock analyses through functions_bedrock.execute_prompt and reports their latency, to
+benchmark concurrency, backoff and streaming against tools/bedrock_stand_in.py:
+
+    python tools/bedrock_stand_in.py --port 8080 --max-concurrency 2
+    python tools/bedrock_load_test.py --endpoint-url http://localhost:8080 --requests 50 --concurrency 10 --stream
+
+Environment variables, such as BEDROCK_MAX_ATTEMPTS or BEDROCK_FALLBACKS, configure the client as
+they do in the Lambda function. The packages in the dependencies layer and AWS Lambda Powertools are needed.
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'alarm_context_tool'))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--endpoint-url', default='http://localhost:8080')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=5)
+    parser.add_argument('--stream', action='store_true', help='Stream the responses')
+    parser.add_argument('--model-id', default='anthropic.claude-3-sonnet-20240229-v1:0')
+    args = parser.parse_args()
+
+    os.environ['BEDROCK_ENDPOINT_URL'] = args.endpoint_url
+    os.environ['BEDROCK_MODEL_ID'] = args.model_id
+    for name, value in {
+        'AWS_ACCESS_KEY_ID': 'stand-in', 'AWS_SECRET_ACCESS_KEY': 'stand-in', 'BEDROCK_REGION': 'us-east-1',
+        'USE_BEDROCK': 'True', 'BEDROCK_MAX_TOKENS': '4000', 'ANTHROPIC_VERSION': 'bedrock-2023-05-31',
+        'BEDROCK_CACHE_TTL': '0', 'POWERTOOLS_LOG_LEVEL': 'WARNING', 'POWERTOOLS_TRACE_DISABLED': 'True'
+    }.items():
+        os.environ.setdefault(name, value)
+
+    from functions_bedrock import execute_prompt
+
+    def analyse(index):
+        start = time.monotonic()
+        try:
+            ai_response = execute_prompt(f'<message>{{"AlarmName":"load-test-{index}"}}</message>', stream=args.stream)
+            if 'Analysis unavailable' in ai_response:
+                return time.monotonic() - start, 'Bedrock was throttled until the deadline'
+            return time.monotonic() - start, None
+        except (RuntimeError, ValueError) as error:
+            return time.monotonic() - start, error
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(analyse, range(args.requests)))
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(latency for latency, error in results if error is None)
+    failures = [error for _, error in results if error is not None]
+    print(f'{args.requests} requests, {args.concurrency} concurrent, {elapsed:.1f}s, {len(failures)} failed')
+    if latencies:
+        def percentile(fraction):
+            return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+        print(f'latency p50 {percentile(0.5):.2f}s, p95 {percentile(0.95):.2f}s, p99 {percentile(0.99):.2f}s, max {latencies[-1]:.2f}s')
+    for error in failures[:5]:
+        print(f'failed: {error}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+A local stand-in for the Bedrock runtime API, for load and latency testing without calling Bedrock.
+
+It implements the InvokeModel, InvokeModelWithResponseStream, Converse and ConverseStream response shapes
+used by functions_bedrock, with a log-normal time to first token, a fixed output token throughput, a
+throttling rate and a concurrency limit. Point the Lambda function at it with BEDROCK_ENDPOINT_URL:
+
+    python tools/bedrock_stand_in.py --port 8080 --throttle-rate 0.2
+    BEDROCK_ENDPOINT_URL=http://localhost:8080 AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test ...
+
+Requests are not authenticated, so any credentials can be used. Only the Python standard library is needed.
+"""
+import re
+import json
+import math
+import time
+import uuid
+import zlib
+import base64
+import struct
+import random
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+PATH_PATTERN = re.compile(r'^/model/(?P<model_id>[^/]+)/(?P<operation>invoke|invoke-with-response-stream|converse|converse-stream)$')
+
+WORDS = ('alarm', 'metric', 'latency', 'error', 'throttle', 'instance', 'function', 'request', 'timeout', 'capacity', 'deployment', 'trace')
+
+def encode_event(headers, payload):
+    """
+    Encodes a message in the binary event stream format used by the streaming operations.
+
+    Args:
+        headers (dict): The header names and string values.
+        payload (bytes): The payload.
+
+    Returns:
+        bytes: The message.
+    """
+    encoded_headers = b''
+    for name, value in headers.items():
+        name, value = name.encode(), value.encode()
+        encoded_headers += struct.pack('!B', len(name)) + name + struct.pack('!BH', 7, len(value)) + value
+    prelude = struct.pack('!II', 16 + len(encoded_headers) + len(payload), len(encoded_headers))
+    message = prelude + struct.pack('!I', zlib.crc32(prelude)) + encoded_headers + payload
+    return message + struct.pack('!I', zlib.crc32(message))
+
+class StandInSettings:
+    """
+    The latency, throughput and throttling settings, and the number of requests in progress.
+    """
+    def __init__(self, args):
+        self.first_token_median = args.first_token_median
+        self.first_token_sigma = args.first_token_sigma
+        self.tokens_per_second = args.tokens_per_second
+        self.output_tokens = args.output_tokens
+        self.throttle_rate = args.throttle_rate
+        self.max_concurrency = args.max_concurrency
+        self.verbose = args.verbose
+        self.random = random.Random(args.seed)
+        self.in_progress = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns whether a request is accepted, or should be throttled.
+        """
+        with self.lock:
+            if self.random.random() < self.throttle_rate:
+                return False
+            if self.max_concurrency and self.in_progress >= self.max_concurrency:
+                return False
+            self.in_progress += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_progress -= 1
+
+    def first_token_seconds(self):
+        with self.lock:
+            return self.random.lognormvariate(math.log(self.first_token_median), self.first_token_sigma)
+
+    def response_words(self, max_tokens):
+        with self.lock:
+            return [self.random.choice(WORDS) for _ in range(min(self.output_tokens, max_tokens))]
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = None
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        match = PATH_PATTERN.match(self.path)
+        if not match:
+            self.send_error_response(404, 'ResourceNotFoundException', f'Unknown path {self.path}')
+            return
+        model_id, operation = urllib.parse.unquote(match.group('model_id')), match.group('operation')
+
+        if not self.settings.acquire():
+            self.send_error_response(429, 'ThrottlingException', 'Too many requests, please wait before trying again.')
+            return
+        try:
+            start = time.monotonic()
+            max_tokens = request.get('max_tokens') or request.get('inferenceConfig', {}).get('maxTokens') or 4096
+            words = self.settings.response_words(max_tokens)
+            input_tokens = len(json.dumps(request)) // 4
+            time.sleep(self.settings.first_token_seconds())
+            if operation in ('invoke', 'converse'):
+                time.sleep(len(words) / self.settings.tokens_per_second)
+                self.send_response_body(operation, model_id, words, input_tokens, start)
+            else:
+                self.send_response_stream(operation, model_id, words, input_tokens, start)
+        finally:
+            self.settings.release()
+
+    def send_error_response(self, status, error_type, message):
+        body = json.dumps({'message': message}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('x-amzn-ErrorType', error_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_response_body(self, operation, model_id, words, input_tokens, start):
+        text = f"<h3>Stand-in analysis</h3><p>{' '.join(words)}</p>"
+        if operation == 'invoke':
+            body = {
+                'id': f'msg_{uuid.uuid4().hex}', 'type': 'message', 'role': 'assistant', 'model': model_id,
+                'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                'usage': {'input_tokens': input_tokens, 'output_tokens': len(words)}
+            }
+        else:
+            body = {
+                'output': {'message': {'role': 'assistant', 'content': [{'text': text}]}}, 'stopReason': 'end_turn',
+                'usage': {'inputTokens': input_tokens, 'outputTokens': len(words), 'totalTokens': input_tokens + len(words)},
+                'metrics': {'latencyMs': int((time.monotonic() - start) * 1000)}
+            }
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_response_stream(self, operation, model_id, words, input_tokens, start):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.amazon.eventstream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send_event(event_type, payload):
+            data = encode_event({':event-type': event_type, ':content-type': 'application/json', ':message-type': 'event'}, json.dumps(payload).encode())
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        def send_chunk(chunk):
+            send_event('chunk', {'bytes': base64.b64encode(json.dumps(chunk).encode()).decode()})
+
+        texts = ['<h3>Stand-in analysis</h3><p>'] + [f'{word} ' for word in words] + ['</p>']
+        if operation == 'invoke-with-response-stream':
+            send_chunk({'type': 'message_start', 'message': {'id': f'msg_{uuid.uuid4().hex}', 'role': 'assistant', 'model': model_id, 'usage': {'input_tokens': input_tokens}}})
+            send_chunk({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+            for text in texts:
+                send_chunk({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})
+                time.sleep(1 / self.settings.tokens_per_second)
+            send_chunk({'type': 'content_block_stop', 'index': 0})
+            send_chunk({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': len(words)}})
+            send_chunk({'type': 'message_stop'})
+        else:
+            send_event('messageStart', {'role': 'assistant'})
+            for text in texts:
+                send_event('contentBlockDelta', {'contentBlockIndex': 0, 'delta': {'text': text}})
+                time.sleep(1 / self.settings.tokens_per_second)
+            send_event('contentBlockStop', {'contentBlockIndex': 0})
+            send_event('messageStop', {'stopReason': 'end_turn'})
+            send_event('metadata', {
+                'usage': {'inputTokens': input_tokens, 'outputTokens': len(words), 'totalTokens': input_tokens + len(words)},
+                'metrics': {'latencyMs': int((time.monotonic() - start) * 1000)}
+            })
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        if self.settings.verbose:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--first-token-median', type=float, default=1.0, help='Median seconds to the first token, default 1.0')
+    parser.add_argument('--first-token-sigma', type=float, default=0.5, help='Sigma of the log-normal time to the first token, default 0.5')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='Output token throughput, default 50')
+    parser.add_argument('--output-tokens', type=int, default=400, help='Output tokens per response, up to the requested maximum, default 400')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests that are throttled, default 0')
+    parser.add_argument('--max-concurrency', type=int, default=0, help='Requests over this concurrency are throttled, default 0 for no limit')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    StandInHandler.settings = StandInSettings(args)
+    server = ThreadingHTTPServer(('localhost', args.port), StandInHandler)
+    print(f'Bedrock stand-in listening on http://localhost:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmarks parsing CloudFormation YAML templates with cfn_flip against parse_cloudformation_template in
+functions_cloudformation, and checks that both produce the same template:
+
+    python tools/benchmark_cfn_yaml.py --resources 1000
+    python tools/benchmark_cfn_yaml.py --template my-stack.yaml
+
+Without --template, a template with the given number of resources is generated. The packages in the
+dependencies layer and AWS Lambda Powertools are needed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'alarm_context_tool'))
+os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'True')
+os.environ.setdefault('POWERTOOLS_LOG_LEVEL', 'WARNING')
+
+RESOURCE_TEMPLATE = '''  Function{index}:
+    Type: AWS::Lambda::Function
+    DependsOn: Role{index}
+    Properties:
+      FunctionName: !Sub "${{AWS::StackName}}-function-{index}"
+      Handler: index.handler
+      Runtime: python3.12
+      MemorySize: 1024
+      Timeout: 30
+      Role: !GetAtt Role{index}.Arn
+      Environment:
+        Variables:
+          TABLE_NAME: !Ref Table{index}
+          STAGE: !If [IsProduction, prod, dev]
+          ENDPOINT: !Join ["", ["https://", !Ref "AWS::Region", ".example.com/", !Select [0, !Split [",", !Ref Endpoints]]]]
+      Code:
+        ZipFile: |
+          import json
+          def handler(event, context):
+              return {{"statusCode": 200, "body": json.dumps(event)}}
+      Tags:
+        - Key: Application
+          Value: alarm-context-tool
+        - Key: Index
+          Value: "{index}"
+  Role{index}:
+    Type: AWS::IAM::Role
+    Properties:
+      AssumeRolePolicyDocument:
+        Version: "2012-10-17"
+        Statement:
+          - Effect: Allow
+            Principal:
+              Service: lambda.amazonaws.com
+            Action: sts:AssumeRole
+      Policies:
+        - PolicyName: table-access
+          PolicyDocument:
+            Statement:
+              - Effect: Allow
+                Action: [dynamodb:GetItem, dynamodb:PutItem, dynamodb:Query]
+                Resource: !GetAtt [Table{index}, Arn]
+  Table{index}:
+    Type: AWS::DynamoDB::Table
+    Properties:
+      BillingMode: PAY_PER_REQUEST
+      AttributeDefinitions:
+        - AttributeName: pk
+          AttributeType: S
+      KeySchema:
+        - AttributeName: pk
+          KeyType: HASH
+'''
+
+def generate_template(resources):
+    header = '''AWSTemplateFormatVersion: 2010-09-09
+Description: A generated template for benchmarking
+Parameters:
+  Endpoints:
+    Type: CommaDelimitedList
+    Default: a,b
+  Environment:
+    Type: String
+    Default: dev
+Conditions:
+  IsProduction: !Equals [!Ref Environment, prod]
+Resources:
+'''
+    outputs = 'Outputs:\n' + ''.join(f'  Function{index}Arn:\n    Value: !GetAtt Function{index}.Arn\n    Export:\n      Name: !Sub "${{AWS::StackName}}-{index}"\n' for index in range(0, resources, 3))
+    return header + ''.join(RESOURCE_TEMPLATE.format(index=index) for index in range(0, resources, 3)) + outputs
+
+def benchmark(name, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    print(f'{name:<40} best {min(timings) * 1000:8.1f} ms, mean {sum(timings) / len(timings) * 1000:8.1f} ms')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--template', help='A YAML template file, instead of a generated template')
+    parser.add_argument('--resources', type=int, default=1000, help='The number of resources in the generated template, default 1000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from cfn_flip import to_json
+    from collections import OrderedDict
+    from functions_cloudformation import CloudFormationLoader
+    from functions_cloudformation import CustomJSONEncoder
+    from functions_cloudformation import parse_cloudformation_template
+
+    if args.template:
+        with open(args.template) as file:
+            template_body = file.read()
+    else:
+        template_body = generate_template(args.resources)
+    print(f'Template of {len(template_body) / 1024:.0f} KB, {"C" if CloudFormationLoader.__mro__[1].__name__.startswith("C") else "pure Python"} YAML loader')
+
+    flipped = benchmark('cfn_flip to_json and json.loads', lambda: json.loads(to_json(template_body), object_pairs_hook=OrderedDict), args.repeat)
+    parsed = benchmark('parse_cloudformation_template, all', lambda: json.loads(json.dumps(parse_cloudformation_template(template_body), cls=CustomJSONEncoder)), args.repeat)
+    benchmark('parse_cloudformation_template, Resources', lambda: parse_cloudformation_template(template_body).get('Resources'), args.repeat)
+
+    if json.dumps(flipped, sort_keys=True) != json.dumps(parsed, sort_keys=True):
+        print('The parsed templates differ')
+        sys.exit(1)
+    print('The parsed templates are the same')
+
+if __name__ == '__main__':
+    main()
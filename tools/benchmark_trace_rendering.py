@@ -0,0 +1,105 @@
+"""
+Benchmarks rendering X-Ray traces with render_trace_segments in functions_xray against the recursive renderer
+it replaced, on synthetic traces with many or deeply nested subsegments:
+
+    python tools/benchmark_trace_rendering.py --subsegments 10000
+    python tools/benchmark_trace_rendering.py --subsegments 1000 --depth 400
+
+Each trace has a Lambda function segment with the given number of SDK call subsegments, each with a child,
+and a chain of subsegments nested --depth levels deep. The packages in the dependencies layer and AWS Lambda
+Powertools are needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'alarm_context_tool'))
+os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'True')
+os.environ.setdefault('POWERTOOLS_LOG_LEVEL', 'WARNING')
+
+SDK_CALLS = ('DynamoDB', 'S3', 'SQS', 'SecretsManager')
+
+def generate_trace(subsegments, depth, seed):
+    """
+    Returns a synthetic trace, in the shape returned by batch_get_traces.
+    """
+    rng = random.Random(seed)
+    start = time.time()
+    end = start
+    calls = []
+    for index in range(subsegments):
+        call_start = start + index * 0.001
+        end = call_start + 0.002
+        calls.append({
+            'id': f'{index:016x}', 'name': rng.choice(SDK_CALLS), 'namespace': 'aws',
+            'start_time': call_start, 'end_time': end, 'fault': index % 500 == 0,
+            'http': {'response': {'status': 500 if index % 500 == 0 else 200}},
+            'subsegments': [{'id': f'{index:015x}a', 'name': 'Marshall', 'start_time': call_start, 'end_time': call_start + 0.001}]
+        })
+
+    # A chain of nested subsegments, such as middleware or recursive calls
+    nested = {}
+    for level in reversed(range(depth)):
+        nested = {'id': f'n{level:015x}', 'name': f'Layer{level % 10}', 'start_time': start, 'end_time': end, 'subsegments': [nested] if nested else []}
+    if nested:
+        calls.append(nested)
+
+    document = {'id': 'root', 'name': 'function', 'origin': 'AWS::Lambda::Function', 'start_time': start, 'end_time': end, 'subsegments': calls}
+    return {'Id': '1-00000000-000000000000000000000000', 'Duration': end - start, 'Segments': [{'Id': 'root', 'Document': json.dumps(document)}]}
+
+def render_recursively(segment_doc, earliest_start, timeline_scale, is_subsegment=False):
+    """
+    The recursive renderer that render_trace_segments replaced, which renders every node.
+    """
+    from functions_xray import SEGMENT_STATUS_COLORS
+    from functions_xray import get_segment_status
+
+    status = get_segment_status(segment_doc)
+    duration = segment_doc.get('end_time', 0) - segment_doc.get('start_time', 0)
+    offset = (segment_doc.get('start_time', 0) - earliest_start) / timeline_scale * 100
+    html_output = ''
+    if not is_subsegment:
+        html_output += f'<tr><td colspan="5">{segment_doc.get("name", "Unknown")}</td></tr>'
+    html_output += (f'<tr><td>{segment_doc.get("name", "Unknown")}</td><td style="color:{SEGMENT_STATUS_COLORS[status]};">{status}</td>'
+                    f'<td>{segment_doc.get("http", {}).get("response", {}).get("status", "-")}</td><td>{round(duration * 1000)}ms</td>'
+                    f'<td><div style="left: {offset}%; width: {duration / timeline_scale * 100}%;"></div></td></tr>')
+    for subsegment in sorted(segment_doc.get('subsegments', []), key=lambda x: x.get('start_time', 0)):
+        html_output += render_recursively(subsegment, earliest_start, timeline_scale, True)
+    return html_output
+
+def benchmark(name, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    print(f'{name:<30} best {min(timings) * 1000:8.1f} ms, mean {sum(timings) / len(timings) * 1000:8.1f} ms, {len(result) / 1024:8.0f} KB of HTML')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--subsegments', type=int, default=10000, help='The number of SDK call subsegments, default 10000')
+    parser.add_argument('--depth', type=int, default=0, help='The depth of an additional chain of nested subsegments, default 0')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    from functions_xray import get_segment_document
+    from functions_xray import render_trace_segments
+
+    trace = generate_trace(args.subsegments, args.depth, args.seed)
+    segment_doc = get_segment_document(trace['Segments'][0])
+    earliest_start, timeline_scale = segment_doc['start_time'], trace['Duration']
+    print(f'Trace of {args.subsegments} subsegments and a chain {args.depth} deep')
+
+    try:
+        benchmark('recursive renderer', lambda: render_recursively(segment_doc, earliest_start, timeline_scale), args.repeat)
+    except RecursionError:
+        print(f'{"recursive renderer":<30} RecursionError')
+    benchmark('render_trace_segments', lambda: render_trace_segments([segment_doc], earliest_start, timeline_scale), args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Checks how fit_prompt_sections in functions_bedrock shares a small prompt between the sections of context of a
+synthetic alarm, with repetitive metric data, many log events, a trace profile and a large CloudFormation template:
+
+    python tools/check_prompt_fitting.py --max-input-tokens 4000
+
+The tokens, status and number of items of each section are printed. The check fails if the log events or the
+trace profile are omitted, or are trimmed to fewer than --min-items items. The packages in the dependencies layer
+and AWS Lambda Powertools are needed.
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'alarm_context_tool'))
+os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', 'True')
+os.environ.setdefault('POWERTOOLS_LOG_LEVEL', 'WARNING')
+
+def generate_context(metric_points, log_events, resources):
+    """
+    Returns the context of a synthetic Lambda function alarm, as passed to construct_prompt_sections.
+    """
+    return {
+        'alarm_history': [{'Timestamp': f'2024-01-01T00:{index % 60:02d}:00Z', 'HistorySummary': 'Alarm updated from OK to ALARM'} for index in range(20)],
+        'message': {'AlarmName': 'checkout-errors', 'NewStateValue': 'ALARM', 'NewStateReason': 'Threshold Crossed: 1 datapoint [1.0] was greater than the threshold (0.0).'},
+        'metric_data': {'Errors': [1.0] * metric_points},
+        'text_summary': 'The Errors metric of the checkout function has been above 0 for 5 minutes. ' * 40,
+        'health_events': None,
+        'truncated_cloudformation_template': {'Resources': {f'Queue{index}': {'Type': 'AWS::SQS::Queue', 'Properties': {'VisibilityTimeout': 30}} for index in range(resources)}},
+        'resource_information_object': {'Configuration': {'FunctionName': 'checkout', 'Runtime': 'python3.12', 'MemorySize': 512, 'Timeout': 30}},
+        'log_events': {'/aws/lambda/checkout': [{'@timestamp': f'2024-01-01 00:00:{index % 60:02d}.000', '@message': f'ERROR PaymentDeclinedException: card {index} was declined by the payment provider'} for index in range(log_events)]},
+        'additional_metrics_with_timestamps_removed': {'Duration': [120.5] * metric_points, 'Throttles': [0.0] * metric_points},
+        'trace_summary': {'TraceProfile': {'RootCauses': [{'Service': 'payments', 'Exception': 'PaymentDeclinedException', 'Count': 42}], 'FaultyNodes': ['checkout', 'payments']}}
+    }
+
+def count_items(information):
+    if isinstance(information, str):
+        return information.count('@message') or information.count('PaymentDeclinedException') or 1
+    return len(information) if isinstance(information, (list, dict)) else 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--max-input-tokens', type=int, default=4000, help='BEDROCK_MAX_INPUT_TOKENS, default 4000')
+    parser.add_argument('--metric-points', type=int, default=500)
+    parser.add_argument('--log-events', type=int, default=300)
+    parser.add_argument('--resources', type=int, default=300)
+    parser.add_argument('--min-items', type=int, default=5, help='The fewest log events that must be kept, default 5')
+    args = parser.parse_args()
+    os.environ['BEDROCK_MAX_INPUT_TOKENS'] = str(args.max_input_tokens)
+
+    from functions_bedrock import build_section
+    from functions_bedrock import estimate_tokens
+    from functions_bedrock import fit_prompt_sections
+    from functions_bedrock import construct_prompt_sections
+
+    sections = construct_prompt_sections(**generate_context(args.metric_points, args.log_events, args.resources))
+    fitted_sections = dict(fit_prompt_sections(sections))
+    for tag_name, information in sections:
+        if tag_name in fitted_sections:
+            fitted = fitted_sections[tag_name]
+            status = 'kept' if fitted == information else 'trimmed'
+            print(f'{tag_name:<45} {status:<8} {estimate_tokens(build_section(tag_name, fitted)):>6} tokens')
+        else:
+            print(f'{tag_name:<45} omitted  {0:>6} tokens')
+
+    failures = []
+    log_events = fitted_sections.get('log_events')
+    if log_events is None or str(log_events).count('PaymentDeclinedException') < args.min_items:
+        failures.append(f'fewer than {args.min_items} log events were kept')
+    if 'PaymentDeclinedException' not in str(fitted_sections.get('trace_summary', '')):
+        failures.append('the trace root cause was not kept')
+    if failures:
+        sys.exit('FAILED: ' + ', '.join(failures))
+    print('OK: the log events and the trace root cause were kept')
+
+if __name__ == '__main__':
+    main()